@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class GraphqlApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'graphql_api'
+
+    def ready(self):
+        from graphql_api import spatial_cache
+        from graphql_api.models import Property
+        post_save.connect(spatial_cache.property_saved, sender=Property, dispatch_uid="spatial_cache_property_saved")
+        post_delete.connect(spatial_cache.property_deleted, sender=Property,
+                            dispatch_uid="spatial_cache_property_deleted")
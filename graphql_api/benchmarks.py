@@ -0,0 +1,149 @@
+import json
+import platform
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+import networkx as nx
+import numpy as np
+
+from graphql_api.constraints import SameLengthOfStay
+from graphql_api.demand_graph import ApplicationNode
+from graphql_api.matching import MatchingAlgorithm
+
+"""
+Matching benchmark on synthetic application populations, run by `manage.py benchmark_matching`.
+
+SHELL TESTING:
+from graphql_api.benchmarks import generate_applications, run_benchmark
+run_benchmark(generate_applications(size=500), ["bounded", "disjoint"])
+"""
+
+Engine = Callable[[List[ApplicationNode]], List[List[int]]]
+
+
+def _matching_engine(**kwargs) -> Engine:
+    def run(applications):
+        algorithm = MatchingAlgorithm(constraints=[SameLengthOfStay()], **kwargs)
+        return algorithm.find_matching_application_sets(applications)
+    return run
+
+
+def legacy_networkx_cycles(applications: List[ApplicationNode]) -> List[List[int]]:
+    """The original algorithm: explicit networkx graph per group and all of its simple cycles"""
+    groups = defaultdict(list)
+    for application in applications:
+        groups[application.length_of_stay].append(application)
+
+    all_cycles = []
+    for group in groups.values():
+        G = nx.DiGraph()
+        G.add_nodes_from([a.id for a in group])
+        city_to_applications = defaultdict(list)
+        for application in group:
+            city_to_applications[application.city_id].append(application.id)
+        for application in group:
+            for city_id in application.preferred_city_ids:
+                G.add_edges_from((application.id, a_id) for a_id in city_to_applications[city_id]
+                                 if a_id != application.id)
+        all_cycles += list(nx.simple_cycles(G))
+    return all_cycles
+
+
+ENGINES: Dict[str, Callable[[], Engine]] = {
+    # exponential in the size of a group, only usable for small populations
+    "networkx": lambda: legacy_networkx_cycles,
+    "bounded": lambda: _matching_engine(workers=1, disjoint=False, top_k=None),
+    "parallel": lambda: _matching_engine(workers=4, disjoint=False, top_k=None),
+    "disjoint": lambda: _matching_engine(workers=1, disjoint=True, top_k=None),
+    "ranked": lambda: _matching_engine(workers=1, disjoint=False, top_k=5),
+}
+
+
+def generate_applications(size: int, cities: int = 50, city_skew: float = 1.0, preferences: int = 3,
+                          groups: int = 4, seed: int = 0) -> List[ApplicationNode]:
+    """
+    Synthetic applications. Cities of properties and preferred cities are drawn from a Zipf-like distribution with
+    exponent `city_skew` (0 means uniform), `groups` is the number of distinct lengths of stay.
+    """
+    generator = random.Random(seed)
+    weights = [1 / (rank ** city_skew) for rank in range(1, cities + 1)]
+    city_ids = list(range(1, cities + 1))
+    applications = []
+    for application_id in range(1, size + 1):
+        preferred = []
+        while len(preferred) < min(preferences, cities):
+            city_id = generator.choices(city_ids, weights)[0]
+            if city_id not in preferred:
+                preferred.append(city_id)
+        applications.append(ApplicationNode(
+            id=application_id,
+            length_of_stay=generator.randrange(groups),
+            city_id=generator.choices(city_ids, weights)[0],
+            preferred_city_ids=tuple(preferred),
+        ))
+    return applications
+
+
+def measure(engine: Engine, applications: List[ApplicationNode], repeat: int = 1) -> dict:
+    """
+    Best wall time of `repeat` runs and peak memory (tracemalloc) of one more run. Memory of worker processes is
+    not traced.
+    """
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        engine(applications)
+        wall_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        cycles = engine(applications)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "wall_time": min(wall_times),
+        "peak_memory": peak_memory,
+        "cycles": len(cycles),
+        "applications_in_cycles": len({application_id for cycle in cycles for application_id in cycle}),
+    }
+
+
+def run_benchmark(applications: List[ApplicationNode], engines: List[str], repeat: int = 1) -> Dict[str, dict]:
+    return {name: measure(ENGINES[name](), applications, repeat) for name in engines}
+
+
+def benchmark_report(parameters: dict, results: Dict[str, dict]) -> dict:
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "networkx": nx.__version__,
+        "parameters": parameters,
+        "results": results,
+    }
+
+
+def save_report(report: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def compare_reports(report: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """Describes engines which are slower or use more memory than in `baseline` by more than `tolerance`"""
+    if report["parameters"] != baseline["parameters"]:
+        return ["parameters differ from the baseline, results are not comparable"]
+    regressions = []
+    for name, result in report["results"].items():
+        previous: Optional[dict] = baseline["results"].get(name)
+        if previous is None:
+            continue
+        for metric in ("wall_time", "peak_memory"):
+            if previous[metric] and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{name}: {metric} {previous[metric]:.4g} -> {result[metric]:.4g}")
+        if result["cycles"] != previous["cycles"]:
+            regressions.append(f"{name}: cycles {previous['cycles']} -> {result['cycles']}")
+    return regressions
@@ -0,0 +1,116 @@
+import csv
+import logging
+import threading
+from typing import List, Optional, Tuple, Union
+
+from graphql_api.kdtree import SphereKDTree
+from work_around import settings
+
+logger = logging.getLogger(__name__)
+
+"""
+Offline resolution of the city of a property: the nearest known city within `OFFLINE_CITY_RADIUS` kilometers.
+
+Known cities are the cities with coordinates and the rows of the optional gazetteer CSV file `CITY_GAZETTEER_PATH`
+(columns name, country, latitude, longitude, e.g. converted from the GeoNames cities export), a gazetteer city is
+created when it's resolved for the first time. No gazetteer is needed to start with: cities found by the remote
+geocoder are stored with their coordinates (and added to the resolver right away), older cities got the mean
+coordinates of their properties by migration 0030. Coordinates follow the convention of the reverse geocoder calls,
+x is the latitude and y the longitude.
+
+SHELL TESTING:
+from graphql_api.city_resolver import city_resolver
+from graphql_api.utils import GeographyPoint
+city_resolver.resolve(GeographyPoint(50.083076, 14.420020))
+"""
+
+# id of a `City` or (name, country, latitude, longitude) of a gazetteer city
+KnownCity = Union[int, Tuple[str, Optional[str], float, float]]
+
+
+class OfflineCityResolver:
+    # cities added after the tree was built are searched linearly, above this number the tree is rebuilt
+    REBUILD_THRESHOLD = 100
+
+    def __init__(self, radius: float, gazetteer_path: str = None):
+        self.radius = radius
+        self.gazetteer_path = gazetteer_path
+        self.lock = threading.Lock()
+        self.tree: Optional[SphereKDTree] = None
+        self.cities: List[KnownCity] = []
+        self.added: List[Tuple[int, float, float]] = []
+
+    def load(self):
+        """(Re)builds the tree of known cities"""
+        from graphql_api.models import City
+        cities, coordinates = [], []
+        known = set()
+        for city_id, name, country, point in City.objects.exclude(coordinates=None) \
+                .values_list("id", "name", "country", "coordinates"):
+            cities.append(city_id)
+            coordinates.append((point.x, point.y))
+            known.add((name, country))
+        if self.gazetteer_path:
+            with open(self.gazetteer_path, newline="") as f:
+                for row in csv.DictReader(f):
+                    if (row["name"], row["country"] or None) not in known:
+                        latitude, longitude = float(row["latitude"]), float(row["longitude"])
+                        cities.append((row["name"], row["country"] or None, latitude, longitude))
+                        coordinates.append((latitude, longitude))
+        tree = SphereKDTree([latitude for latitude, _ in coordinates], [longitude for _, longitude in coordinates])
+        with self.lock:
+            self.tree, self.cities, self.added = tree, cities, []
+        logger.info(f"Offline city resolver loaded {len(cities)} cities.")
+
+    def add(self, city):
+        """Makes a city found by other means (e.g. the remote geocoder) known"""
+        if city.coordinates is None:
+            return
+        with self.lock:
+            self.added.append((city.id, city.coordinates.x, city.coordinates.y))
+            rebuild = len(self.added) > self.REBUILD_THRESHOLD
+        if rebuild:
+            self.load()
+
+    def nearest(self, latitude: float, longitude: float) -> Optional[Tuple[KnownCity, float]]:
+        """Nearest known city and its distance in meters"""
+        if self.tree is None:
+            self.load()
+        with self.lock:
+            tree, cities, added = self.tree, self.cities, list(self.added)
+        found = tree.nearest(latitude, longitude)
+        best = (cities[found[0]], found[1]) if found is not None else None
+        if added:
+            # a throwaway tree of the few added cities
+            added_tree = SphereKDTree([x for _, x, _ in added], [y for _, _, y in added])
+            index, distance = added_tree.nearest(latitude, longitude)
+            if best is None or distance < best[1]:
+                best = (added[index][0], distance)
+        return best
+
+    def resolve(self, coordinates):
+        """`City` nearest to `coordinates` within the radius, None if there is none"""
+        from graphql_api.models import City
+        city_id = self.resolve_ids([coordinates])[0]
+        return City.objects.filter(id=city_id).first() if city_id is not None else None
+
+    def resolve_ids(self, points) -> List[Optional[int]]:
+        """Ids of the cities nearest to `points` within the radius, gazetteer cities are created once per batch"""
+        from graphql_api.models import City
+        from graphql_api.utils import GeographyPoint
+        if not self.radius:
+            return [None] * len(points)
+        cities = []
+        for point in points:
+            found = self.nearest(point.x, point.y)
+            cities.append(found[0] if found is not None and found[1] <= self.radius * 1000 else None)
+        created = {}
+        for city in set(cities):
+            if city is not None and not isinstance(city, int):
+                name, country, latitude, longitude = city
+                created[city], _ = City.objects.get_or_create(
+                    name=name, country=country, defaults={"coordinates": GeographyPoint(latitude, longitude)})
+        return [created[city].id if city in created else city for city in cities]
+
+
+city_resolver = OfflineCityResolver(settings.OFFLINE_CITY_RADIUS, settings.CITY_GAZETTEER_PATH or None)
@@ -0,0 +1,59 @@
+from typing import Any, Dict, Hashable
+
+from graphql_api.demand_graph import ApplicationNode
+
+"""
+Hard constraints of the matching algorithm, configured by `settings.MATCHING_CONSTRAINTS`.
+
+Group constraints partition applications by a categorical key before any graph is built, edge constraints prune
+edges of the demand graph ("`applicant` may get the property offered by `offering`") before they are followed by
+the cycle search. Constraints are sent to matching worker processes, so they have to be picklable.
+"""
+
+
+class GroupConstraint:
+    def get_key(self, application: ApplicationNode) -> Hashable:
+        raise NotImplementedError
+
+    def get_filter(self, application: ApplicationNode) -> Dict[str, Any]:
+        """
+        Queryset filter of `Application` selecting applications with the same key as `application`, which may also be
+        an `Application` instance
+        """
+        raise NotImplementedError
+
+
+class EdgeConstraint:
+    def allows(self, applicant: ApplicationNode, offering: ApplicationNode) -> bool:
+        raise NotImplementedError
+
+
+class SameLengthOfStay(GroupConstraint):
+    def get_key(self, application: ApplicationNode):
+        return application.length_of_stay
+
+    def get_filter(self, application: ApplicationNode):
+        return {"length_of_stay": application.length_of_stay}
+
+
+class SameNumberOfPeople(GroupConstraint):
+    def get_key(self, application: ApplicationNode):
+        return application.number_of_people
+
+    def get_filter(self, application: ApplicationNode):
+        return {"number_of_people": application.number_of_people}
+
+
+class AcceptedPropertyType(EdgeConstraint):
+    """Offered property has one of the property types accepted by the applicant (if the applicant chose any)"""
+
+    def allows(self, applicant: ApplicationNode, offering: ApplicationNode):
+        return not applicant.accepted_property_type_ids or offering.property_type_id is None \
+            or offering.property_type_id in applicant.accepted_property_type_ids
+
+
+class PetFriendly(EdgeConstraint):
+    """Applicant asking for a pet friendly stay only gets properties of pet friendly applications"""
+
+    def allows(self, applicant: ApplicationNode, offering: ApplicationNode):
+        return not applicant.pet_friendly or bool(offering.pet_friendly)
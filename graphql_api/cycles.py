@@ -0,0 +1,243 @@
+import heapq
+import itertools
+import time
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+"""
+Cycle enumeration used by the matching algorithm.
+
+All functions work on a `successors` callable returning the out-neighbours of a node, so they don't depend on the
+way the graph is stored, and generate cycles lazily. The search depth is bounded by `max_length` (number of
+applications in a cycle) which keeps the enumeration polynomial for a fixed bound, while the number of all simple
+cycles grows exponentially with the size of the graph.
+"""
+
+Successors = Callable[[Hashable], Iterable[Hashable]]
+# successors with the weight of the edge (0, 1], ordered from the highest weight
+WeightedSuccessors = Callable[[Hashable], Iterable[Tuple[Hashable, float]]]
+
+
+class SearchBudget:
+    """
+    Limit of a cycle search by wall-clock seconds and/or number of expanded nodes. Searches given a budget stop
+    when it is exhausted and keep what they found so far. The deadline is absolute, so a budget sent to another
+    process keeps it. Expansions are counted in the process, a search split into tasks of other processes gives
+    each task its share of the budget (see `split`).
+    """
+
+    # expansions between two checks of the clock
+    CLOCK_INTERVAL = 64
+
+    def __init__(self, seconds: Optional[float] = None, expansions: Optional[int] = None):
+        self.deadline = time.time() + seconds if seconds else None
+        self.expansions = expansions or None
+        self.expanded = 0
+        self.exhausted = False
+
+    def expand(self) -> bool:
+        """Accounts one expanded node, returns False once the budget is exhausted"""
+        self.expanded += 1
+        if self.expansions is not None and self.expanded > self.expansions:
+            self.exhausted = True
+        elif self.expanded % self.CLOCK_INTERVAL == 0:
+            self.check()
+        return not self.exhausted
+
+    def split(self, parts: int) -> List["SearchBudget"]:
+        """Budgets of `parts` tasks with the same deadline and the remaining expansions divided among them"""
+        budgets = []
+        remaining = None if self.expansions is None else max(self.expansions - self.expanded, 0)
+        for part in range(parts):
+            budget = SearchBudget()
+            budget.deadline = self.deadline
+            if remaining is not None:
+                budget.expansions = remaining // parts + (part < remaining % parts)
+            budgets.append(budget)
+        return budgets
+
+    def check(self) -> bool:
+        """Checks the deadline, returns False once the budget is exhausted"""
+        if self.deadline is not None and time.time() > self.deadline:
+            self.exhausted = True
+        return not self.exhausted
+
+
+def iter_simple_cycles(successors: Successors, nodes: Iterable[Hashable], max_length: Optional[int] = None,
+                       budget: SearchBudget = None, limit: Optional[int] = None,
+                       counts: Dict[Hashable, int] = None) -> Iterator[List[Hashable]]:
+    """
+    Yields every simple cycle with at most `max_length` nodes exactly once, rotated so that it starts with its
+    smallest node. With `max_length=None` (or a bound not smaller than the number of nodes) the cycles are the same
+    as the ones of `networkx.simple_cycles`.
+
+    With a `budget` the cycles are searched from the shortest ones (iterative deepening), so that the cycles found
+    before the budget is exhausted are the shortest ones.
+
+    With a `limit` the cycles are the ones of `limit_cycles_per_node`, but nodes which are part of `limit` cycles
+    already are not expanded anymore, so the search stops instead of enumerating cycles that would be dropped.
+    """
+    nodes = sorted(nodes)
+    allowed = set(nodes)
+    counts = dict(counts or {})
+    lengths = [(None, max_length)] if budget is None else \
+        [(length, length) for length in range(2, (max_length or len(nodes)) + 1)]
+    for min_length, length in lengths:
+        for start in nodes:
+            # only nodes greater than the start are visited, so each cycle is found from its smallest node only
+            yield from _iter_cycles_from(successors, start, length,
+                                         lambda node, start=start: node > start and node in allowed,
+                                         min_length, budget, limit, counts)
+            if budget is not None and budget.exhausted:
+                return
+
+
+def iter_cycles_through(successors: Successors, node: Hashable, max_length: Optional[int] = None,
+                        budget: SearchBudget = None, limit: Optional[int] = None,
+                        counts: Dict[Hashable, int] = None) -> Iterator[List[Hashable]]:
+    """
+    Yields every simple cycle passing through `node` with at most `max_length` nodes, starting with `node`. With a
+    `budget` the shortest cycles are searched first and with a `limit` the search is bounded, as in
+    `iter_simple_cycles`.
+    """
+    counts = dict(counts or {})
+    if budget is None or max_length is None:
+        yield from _iter_cycles_from(successors, node, max_length, lambda _: True, budget=budget, limit=limit,
+                                     counts=counts)
+        return
+    for length in range(2, max_length + 1):
+        yield from _iter_cycles_from(successors, node, length, lambda _: True, length, budget, limit, counts)
+        if budget.exhausted:
+            return
+
+
+def limit_cycles_per_node(cycles: Iterable[List[Hashable]], limit: Optional[int],
+                          counts: Dict[Hashable, int] = None) -> Iterator[List[Hashable]]:
+    """
+    Drops cycles containing a node which is already part of `limit` previously yielded cycles, `counts` are the
+    numbers of cycles the nodes are part of already (e.g. stored recommendations)
+    """
+    if not limit:
+        yield from cycles
+        return
+    counts = dict(counts or {})
+    for cycle in cycles:
+        if any(counts.get(node, 0) >= limit for node in cycle):
+            continue
+        for node in cycle:
+            counts[node] = counts.get(node, 0) + 1
+        yield cycle
+
+
+def find_top_cycles_through(weighted_successors: WeightedSuccessors, node: Hashable, k: int, max_length: int,
+                            can_visit: Callable[[Hashable], bool] = lambda _: True,
+                            budget: SearchBudget = None) -> List[Tuple[float, List]]:
+    """
+    Returns up to `k` best scoring cycles through `node` as (score, cycle) pairs from the best one, the cycles
+    starting with `node`. Score of a cycle is the mean weight of its edges, ties are won by shorter cycles.
+
+    Branches which can't beat the k-th best cycle found so far are pruned: each remaining edge weighs at most 1 and
+    the next one at most the weight of the first (best) edge leaving the current node.
+    """
+    best_weights: Dict[Hashable, float] = {}
+
+    def best_weight(n):
+        if n not in best_weights:
+            best_weights[n] = next((weight for _, weight in weighted_successors(n)), 0.0)
+        return best_weights[n]
+
+    def upper_bound(weights: float) -> float:
+        # path completed to cycles of len(path) to `max_length` nodes, the mean is monotonic in the cycle length,
+        # so only the extremes need to be checked
+        next_weight = best_weight(path[-1])
+        return max((weights + next_weight + cycle_length - len(path)) / cycle_length
+                   for cycle_length in (len(path), max_length))
+
+    # min-heap of (score, -length, tie breaker, cycle)
+    top = []
+    counter = itertools.count()
+    path = [node]
+    on_path = {node}
+    path_weights = [0.0]
+    stack = [iter(weighted_successors(node))]
+    while stack:
+        for successor, weight in stack[-1]:
+            weights = path_weights[-1] + weight
+            if successor == node:
+                if len(path) > 1:
+                    item = (weights / len(path), -len(path), next(counter), list(path))
+                    if len(top) < k:
+                        heapq.heappush(top, item)
+                    elif item[:2] > top[0][:2]:
+                        heapq.heapreplace(top, item)
+                continue
+            if successor in on_path or len(path) >= max_length or not can_visit(successor):
+                continue
+            path.append(successor)
+            if len(top) == k and upper_bound(weights) < top[0][0]:
+                path.pop()
+                continue
+            if budget is not None and not budget.expand():
+                stack.clear()
+                break
+            on_path.add(successor)
+            path_weights.append(weights)
+            stack.append(iter(weighted_successors(successor)))
+            break
+        else:
+            stack.pop()
+            path_weights.pop()
+            on_path.discard(path.pop())
+    return [(score, cycle) for score, _, _, cycle in sorted(top, reverse=True)]
+
+
+def canonical_cycle(cycle: List[Hashable]) -> Tuple[Hashable, ...]:
+    """Rotation of the cycle starting with its smallest node"""
+    start = cycle.index(min(cycle))
+    return tuple(cycle[start:] + cycle[:start])
+
+
+def _iter_cycles_from(successors: Successors, start: Hashable, max_length: Optional[int],
+                      can_visit: Callable[[Hashable], bool], min_length: Optional[int] = None,
+                      budget: SearchBudget = None, limit: Optional[int] = None,
+                      counts: Dict[Hashable, int] = None) -> Iterator[List[Hashable]]:
+    """
+    Cycles through `start`, with a `limit` the numbers of cycles of the nodes are counted in `counts` and nodes
+    which have reached the limit are not visited
+    """
+    min_length = max(min_length or 2, 2)
+    if limit and counts.get(start, 0) >= limit:
+        return
+    path = [start]
+    on_path = {start}
+    # iterative DFS, stack holds the successor iterators of the nodes on the path
+    stack = [iter(successors(start))]
+    while stack:
+        for successor in stack[-1]:
+            if successor == start:
+                if len(path) < min_length:
+                    continue
+                yield list(path)
+                if not limit:
+                    continue
+                for node in path:
+                    counts[node] = counts.get(node, 0) + 1
+                saturated = next((index for index, node in enumerate(path) if counts[node] >= limit), None)
+                if saturated == 0:
+                    return
+                if saturated is not None:
+                    # no more cycles can go through the saturated node, its subtree is left
+                    on_path.difference_update(path[saturated:])
+                    del path[saturated:], stack[saturated:]
+                    break
+            elif successor not in on_path and can_visit(successor) \
+                    and (max_length is None or len(path) < max_length) \
+                    and (not limit or counts.get(successor, 0) < limit):
+                if budget is not None and not budget.expand():
+                    return
+                path.append(successor)
+                on_path.add(successor)
+                stack.append(iter(successors(successor)))
+                break
+        else:
+            stack.pop()
+            on_path.discard(path.pop())
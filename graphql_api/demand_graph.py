@@ -0,0 +1,306 @@
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from graphql_api.cycles import iter_simple_cycles, find_top_cycles_through, canonical_cycle, limit_cycles_per_node, \
+    SearchBudget
+from graphql_api.packing import pack_disjoint_cycles
+
+
+@dataclass(frozen=True)
+class ApplicationNode:
+    """Attributes of an application needed for matching, loaded without model instances"""
+    id: int
+    length_of_stay: int
+    city_id: Optional[int]
+    preferred_city_ids: Tuple[int, ...]
+    pet_friendly: Optional[bool] = None
+    number_of_people: Optional[int] = None
+    property_type_id: Optional[int] = None
+    accepted_property_type_ids: Tuple[int, ...] = ()
+
+
+class DemandGraph:
+    """
+    Graph of applications where application `a` points to application `b` when `b` offers a property in one of
+    the cities preferred by `a`.
+
+    The edges are not stored explicitly, they go through city hubs (application -> preferred city -> applications
+    offering a property there) kept in CSR arrays, so memory and build time are linear in the number of
+    preferences instead of quadratic in the number of applications wanting the same city. Nodes are indices
+    `0..len(graph) - 1` ordered by application id.
+
+    `edge_constraints` (see `graphql_api.constraints`) are checked whenever an edge is expanded. Without them the
+    components and reachability are searched on the hubs as well.
+    """
+
+    def __init__(self, applications: Iterable[ApplicationNode], edge_constraints: Sequence = ()):
+        self.edge_constraints = tuple(edge_constraints)
+        self.applications = applications = sorted(applications, key=lambda a: a.id)
+        self.application_ids = np.array([a.id for a in applications], dtype=np.int64)
+
+        city_ids = sorted({a.city_id for a in applications if a.city_id is not None}
+                          | {c for a in applications for c in a.preferred_city_ids})
+        city_index = {city_id: index for index, city_id in enumerate(city_ids)}
+        self.city_ids = np.array(city_ids, dtype=np.int64)
+
+        # node -> city of its property (-1 when unknown)
+        self.offered_city = np.array([city_index.get(a.city_id, -1) for a in applications], dtype=np.int32)
+        # city -> nodes offering a property in it
+        self.offer_indptr, self.offer_nodes = _group_by(self.offered_city, np.arange(len(applications)),
+                                                        len(city_ids))
+
+        preference_nodes, preference_cities = [], []
+        for node, application in enumerate(applications):
+            # dict keeps the preference order and drops duplicate cities
+            for city_id in dict.fromkeys(application.preferred_city_ids):
+                preference_nodes.append(node)
+                preference_cities.append(city_index[city_id])
+        preference_nodes = np.array(preference_nodes, dtype=np.int32)
+        preference_cities = np.array(preference_cities, dtype=np.int32)
+        # node -> preferred cities in preference order
+        self.preference_indptr, self.preference_cities = _group_by(preference_nodes, preference_cities,
+                                                                   len(applications))
+        # city -> nodes preferring it, used for predecessors
+        self.demand_indptr, self.demand_nodes = _group_by(preference_cities, preference_nodes, len(city_ids))
+
+    def __len__(self):
+        return len(self.application_ids)
+
+    def nodes(self) -> range:
+        return range(len(self))
+
+    def successors(self, node: int) -> Iterator[int]:
+        for city in self.preference_cities[self.preference_indptr[node]:self.preference_indptr[node + 1]].tolist():
+            for successor in self.offer_nodes[self.offer_indptr[city]:self.offer_indptr[city + 1]].tolist():
+                if successor != node and self.allows(node, successor):
+                    yield successor
+
+    def weighted_successors(self, node: int) -> Iterator[Tuple[int, float]]:
+        """Successors with weight 1 / rank of the city the applicant gets among its preferred cities"""
+        start, end = self.preference_indptr[node], self.preference_indptr[node + 1]
+        for rank, city in enumerate(self.preference_cities[start:end].tolist(), 1):
+            for successor in self.offer_nodes[self.offer_indptr[city]:self.offer_indptr[city + 1]].tolist():
+                if successor != node and self.allows(node, successor):
+                    yield successor, 1 / rank
+
+    def predecessors(self, node: int) -> Iterator[int]:
+        city = self.offered_city[node]
+        if city < 0:
+            return
+        for predecessor in self.demand_nodes[self.demand_indptr[city]:self.demand_indptr[city + 1]].tolist():
+            if predecessor != node and self.allows(predecessor, node):
+                yield predecessor
+
+    def allows(self, node: int, successor: int) -> bool:
+        if not self.edge_constraints:
+            return True
+        applicant, offering = self.applications[node], self.applications[successor]
+        return all(constraint.allows(applicant, offering) for constraint in self.edge_constraints)
+
+    def node_of(self, application_id: int) -> Optional[int]:
+        node = int(np.searchsorted(self.application_ids, application_id))
+        if node < len(self) and self.application_ids[node] == application_id:
+            return node
+        return None
+
+    def to_application_ids(self, nodes: Iterable[int]) -> List[int]:
+        return self.application_ids[list(nodes)].tolist()
+
+    def reachable(self, node: int, reverse: bool = False) -> Set[int]:
+        """Nodes reachable from `node` (or reaching it when `reverse`) by a non-empty path"""
+        neighbours = self.predecessors if reverse else self.successors
+        visited = set(neighbours(node))
+        stack = list(visited)
+        if self.edge_constraints:
+            while stack:
+                for neighbour in neighbours(stack.pop()):
+                    if neighbour not in visited:
+                        visited.add(neighbour)
+                        stack.append(neighbour)
+            return visited
+        # without constraints the search goes through the city hubs, every city is expanded once
+        expanded_cities = set()
+        while stack:
+            for city in self._hub_cities(stack.pop(), reverse):
+                if city in expanded_cities:
+                    continue
+                expanded_cities.add(city)
+                for neighbour in self._hub_nodes(city, reverse):
+                    if neighbour not in visited:
+                        visited.add(neighbour)
+                        stack.append(neighbour)
+        return visited
+
+    def strongly_connected_components(self, budget: SearchBudget = None) -> List[List[int]]:
+        """
+        Strongly connected components, each as a sorted list of nodes. The deadline of `budget` is checked
+        meanwhile, an empty list is returned once it has passed.
+
+        Without edge constraints the components are the ones of the hub graph (application -> preferred city ->
+        applications offering a property there) without the cities, which has linearly many edges. A path between
+        two applications through the hubs is a path of the demand graph, only an application preferring the city of
+        its own property reaches itself, which makes no difference to the components.
+        """
+        if self.edge_constraints:
+            return _strongly_connected_components(len(self), self.successors, budget)
+        size = len(self)
+
+        def hub_successors(hub_node: int) -> Iterable[int]:
+            if hub_node < size:
+                return (size + city for city in self._hub_cities(hub_node))
+            return self._hub_nodes(hub_node - size)
+
+        components = _strongly_connected_components(size + len(self.city_ids), hub_successors, budget)
+        return [component for component in ([hub_node for hub_node in component if hub_node < size]
+                                             for component in components) if component]
+
+    def _hub_cities(self, node: int, reverse: bool = False) -> List[int]:
+        """Cities preferred by `node`, or the city of its property when `reverse`"""
+        if reverse:
+            return [int(self.offered_city[node])] if self.offered_city[node] >= 0 else []
+        return self.preference_cities[self.preference_indptr[node]:self.preference_indptr[node + 1]].tolist()
+
+    def _hub_nodes(self, city: int, reverse: bool = False) -> List[int]:
+        """Nodes offering a property in `city`, or preferring it when `reverse`"""
+        if reverse:
+            return self.demand_nodes[self.demand_indptr[city]:self.demand_indptr[city + 1]].tolist()
+        return self.offer_nodes[self.offer_indptr[city]:self.offer_indptr[city + 1]].tolist()
+
+    @property
+    def number_of_hub_edges(self) -> int:
+        return len(self.preference_cities) + len(self.offer_nodes)
+
+    def number_of_edges(self) -> int:
+        """Number of application -> application edges, counted from the hubs unless edge constraints are used"""
+        if self.edge_constraints:
+            return sum(1 for node in self.nodes() for _ in self.successors(node))
+        demand = np.diff(self.demand_indptr)
+        offers = np.diff(self.offer_indptr)
+        # applications preferring the city of their own property have no edge to themselves
+        own_city_preferred = sum(int(self.offered_city[node]) in self.preference_cities[
+            self.preference_indptr[node]:self.preference_indptr[node + 1]].tolist() for node in self.nodes())
+        return int(np.dot(demand, offers)) - own_city_preferred
+
+
+def _strongly_connected_components(size: int, successors: Callable[[int], Iterable[int]],
+                                   budget: SearchBudget = None) -> List[List[int]]:
+    """Strongly connected components of nodes `0..size - 1` (iterative Tarjan's algorithm)"""
+    index = [-1] * size
+    lowlink = [-1] * size
+    counter = steps = 0
+    stack, on_stack = [], set()
+    components = []
+    for root in range(size):
+        if index[root] >= 0:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            if budget is not None and steps % budget.CLOCK_INTERVAL == 0 and not budget.check():
+                return []
+            steps += 1
+            node, node_successors = work[-1]
+            for successor in node_successors:
+                if index[successor] < 0:
+                    index[successor] = lowlink[successor] = counter
+                    counter += 1
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(successors(successor))))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+    return components
+
+
+def _group_by(keys: np.ndarray, values: np.ndarray, number_of_keys: int) -> Tuple[np.ndarray, np.ndarray]:
+    """CSR representation (indptr, values) of `values` grouped by `keys`, negative keys are dropped"""
+    mask = keys >= 0
+    keys, values = keys[mask], values[mask]
+    order = np.argsort(keys, kind="stable")
+    indptr = np.zeros(number_of_keys + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=number_of_keys), out=indptr[1:])
+    return indptr, values[order].astype(np.int32)
+
+
+def iter_component_cycles(applications: List[ApplicationNode], max_length: Optional[int],
+                          edge_constraints: Sequence = (), budget: SearchBudget = None,
+                          max_cycles_per_application: Optional[int] = None) -> Iterator[List[int]]:
+    """
+    Cycles (as application ids) among `applications`, which are expected to form a strongly connected component,
+    at most `max_cycles_per_application` of them containing one application
+    """
+    graph = DemandGraph(applications, edge_constraints)
+    return map(graph.to_application_ids, iter_simple_cycles(graph.successors, graph.nodes(), max_length, budget,
+                                                             max_cycles_per_application))
+
+
+def find_component_top_cycles(applications: List[ApplicationNode], max_length: Optional[int], k: int,
+                              edge_constraints: Sequence = (), budget: SearchBudget = None,
+                              max_cycles_per_application: Optional[int] = None) -> List[List[int]]:
+    """
+    Union of the `k` best ranked cycles (see `find_top_cycles_through`) of every application among `applications`,
+    ordered from the best one, the best `max_cycles_per_application` cycles of an application are kept
+    """
+    graph = DemandGraph(applications, edge_constraints)
+    scores = {}
+    for node in graph.nodes():
+        if budget is not None and budget.exhausted:
+            break
+        for score, cycle in find_top_cycles_through(graph.weighted_successors, node, k, max_length or len(graph),
+                                                    budget=budget):
+            scores[canonical_cycle(cycle)] = score
+    ranked = [cycle for cycle, _ in sorted(scores.items(), key=lambda item: (-item[1], len(item[0]), item[0]))]
+    return [graph.to_application_ids(cycle) for cycle in limit_cycles_per_node(ranked, max_cycles_per_application)]
+
+
+def find_component_cycles(applications: List[ApplicationNode], max_length: Optional[int],
+                          edge_constraints: Sequence = (), disjoint: bool = False,
+                          top_k: Optional[int] = None, budget: SearchBudget = None,
+                          max_cycles_per_application: Optional[int] = None) -> List[List[int]]:
+    """
+    List variant of `iter_component_cycles`. With `top_k` only the best ranked cycles of each application are
+    returned, with `disjoint` only vertex-disjoint cycles covering as many applications as possible, chosen among
+    the cycles within `max_cycles_per_application`.
+    """
+    if budget is not None and not budget.check():
+        return []
+    if top_k:
+        cycles = find_component_top_cycles(applications, max_length, top_k, edge_constraints, budget,
+                                           max_cycles_per_application)
+    else:
+        # bounded by the limit, so that worker processes don't hold and send back cycles which would be dropped
+        cycles = list(iter_component_cycles(applications, max_length, edge_constraints, budget,
+                                            max_cycles_per_application))
+    return pack_disjoint_cycles(cycles) if disjoint else cycles
+
+
+def find_component_cycles_task(applications: List[ApplicationNode], budget: SearchBudget = None,
+                               **kwargs) -> Tuple[List[List[int]], int, bool]:
+    """
+    Task of matching worker processes, `find_component_cycles` with the number of nodes expanded and whether the
+    budget got exhausted, so that the budget of the parent process can account for them
+    """
+    cycles = find_component_cycles(applications, budget=budget, **kwargs)
+    if budget is None:
+        return cycles, 0, False
+    return cycles, budget.expanded, budget.exhausted
@@ -0,0 +1,158 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+import backoff
+import requests
+from opencage.geocoder import ForbiddenError, NotAuthorizedError, OpenCageGeocode, RateLimitExceededError, \
+    UnknownError
+
+from work_around import settings
+
+logger = logging.getLogger(__name__)
+
+"""
+OpenCage client which doesn't let a slow or failing provider stall its callers.
+
+Requests time out after `GEOCODER_TIMEOUT` seconds and failed ones are retried with exponential backoff with full
+jitter, at most `GEOCODER_MAX_TRIES` tries within `GEOCODER_MAX_TIME` seconds. After `GEOCODER_BREAKER_THRESHOLD`
+consecutive failed calls the circuit breaker opens and calls fail fast with `CircuitOpenError`. Once
+`GEOCODER_BREAKER_RESET` seconds have passed, a single trial call is let through, and the breaker closes again if it
+succeeds. Geocoding failures leave properties pending with no city, so a later pass of the geocoding worker resolves
+them.
+
+The breaker and its metrics are per process. The geocoding worker, the only process calling the geocoder, stores
+them in `GeocoderStatus` after every pass, the `geocoder` query reads them from there.
+
+SHELL TESTING:
+from graphql_api.geocoder import geocoder
+geocoder.reverse_geocode(50.083076, 14.420020)
+geocoder.breaker.stats()
+"""
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        """Calls `function` unless the breaker is open, every exception it raises counts as a failure"""
+        self._before_call()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            self._failed()
+            raise
+        self._succeeded()
+        return result
+
+    def retry_in(self) -> Optional[float]:
+        """Seconds until a trial call is let through an open breaker"""
+        if self.state != self.OPEN:
+            return None
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def stats(self) -> Dict[str, object]:
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures, "calls": self.calls,
+                "failures": self.failures, "rejected": self.rejected, "opened": self.opened,
+                "retry_in": self.retry_in()}
+
+    def _before_call(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.trial_running):
+                self.rejected += 1
+                raise CircuitOpenError("The geocoder is unavailable.")
+            self.trial_running = self.state == self.HALF_OPEN
+            self.calls += 1
+
+    def _succeeded(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("Geocoder circuit breaker closed.")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.trial_running = False
+
+    def _failed(self):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    logger.warning(f"Geocoder circuit breaker opened after {self.consecutive_failures} failures.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class GeocodingClient(OpenCageGeocode):
+    """`OpenCageGeocode` with timeouts, bounded retries and a circuit breaker"""
+
+    def __init__(self, key: str, url: str, timeout: float, max_tries: int, max_time: float, breaker: CircuitBreaker,
+                 backoff_factor: float = 0.5):
+        super().__init__(key)
+        self.url = url
+        self.timeout = timeout
+        self.breaker = breaker
+        self.http = requests.Session()
+        self.retries = 0
+        # rate limiting and client errors are not retried
+        self._retrying_request = backoff.on_exception(
+            backoff.expo, (UnknownError, requests.exceptions.RequestException), max_tries=max_tries,
+            max_time=max_time, jitter=backoff.full_jitter, on_backoff=self._on_backoff, factor=backoff_factor
+        )(self._request)
+
+    def _opencage_request(self, params):
+        # replaces the request of the library, which has no timeout and retries for up to two minutes
+        return self.breaker.call(self._retrying_request, params)
+
+    def _on_backoff(self, details):
+        self.retries += 1
+
+    def _request(self, params):
+        response = self.http.get(self.url, params=params, timeout=self.timeout)
+        try:
+            response_json = response.json()
+        except ValueError as e:
+            raise UnknownError(f"Non-JSON result from server, status code {response.status_code}") from e
+        if response.status_code == 401:
+            raise NotAuthorizedError()
+        if response.status_code == 403:
+            raise ForbiddenError()
+        if response.status_code in (402, 429):
+            rate = response_json.get("rate", {})
+            raise RateLimitExceededError(reset_to=int(rate.get("limit", 0)),
+                                         reset_time=datetime.utcfromtimestamp(rate.get("reset", 0)))
+        if response.status_code >= 500:
+            raise UnknownError(f"{response.status_code} status code from API")
+        if "results" not in response_json:
+            raise UnknownError("JSON from API doesn't have a 'results' key")
+        return response_json
+
+
+geocoder = GeocodingClient(settings.OPEN_CAGE_API_KEY, settings.OPEN_CAGE_URL, settings.GEOCODER_TIMEOUT,
+                           settings.GEOCODER_MAX_TRIES, settings.GEOCODER_MAX_TIME,
+                           CircuitBreaker(settings.GEOCODER_BREAKER_THRESHOLD, settings.GEOCODER_BREAKER_RESET))
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Callable, Dict, Optional, Tuple
+
+from django.db.models import Q
+from django.utils import timezone
+
+from graphql_api.city_resolver import city_resolver
+from graphql_api.geocoder import CircuitOpenError
+from work_around import settings
+
+logger = logging.getLogger(__name__)
+
+"""
+Cache of reverse geocoding results keyed by coordinates rounded to `GEOCODING_CACHE_PRECISION` decimal places.
+
+A process-local LRU of `GEOCODING_CACHE_SIZE` entries is backed by the `GeocodingCacheEntry` table shared by all
+processes, entries of both expire after `GEOCODING_CACHE_TTL` seconds. Cities not found by the geocoder are cached
+as well, failed requests are not.
+
+Properties are saved with `geocoding_pending` set and their cities are resolved in batches by
+`geocode_pending_properties`, run by the `run_geocoding_worker` command, so mutations never wait for the geocoder.
+Failed properties are retried with exponential backoff and given up after `GEOCODING_MAX_ATTEMPTS` attempts. While
+the geocoder is unavailable, `resolve_pending_properties_offline` resolves the properties having a known city nearby.
+
+SHELL TESTING:
+from graphql_api.geocoding import geocoding_cache
+geocoding_cache.stats()
+"""
+
+
+class GeocodingCache:
+    def __init__(self, precision: int, ttl: float, size: int):
+        self.precision = precision
+        self.ttl = ttl
+        self.size = size
+        # key -> (city, expiration timestamp), least recently used first
+        self.entries: "OrderedDict[str, Tuple[Optional[object], float]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.database_hits = 0
+        self.misses = 0
+
+    def key(self, coordinates) -> str:
+        return f"{coordinates.x:.{self.precision}f},{coordinates.y:.{self.precision}f}"
+
+    def get_city(self, coordinates, resolve: Callable):
+        """City of `coordinates` from the cache, `resolve(coordinates)` finds it on a miss"""
+        from graphql_api.models import GeocodingCacheEntry
+        key = self.key(coordinates)
+        now = time.time()
+        with self.lock:
+            if key in self.entries and self.entries[key][1] > now:
+                self.entries.move_to_end(key)
+                self.memory_hits += 1
+                return self.entries[key][0]
+
+        entry = GeocodingCacheEntry.objects.select_related("city") \
+            .filter(key=key, created_at__gt=timezone.now() - timedelta(seconds=self.ttl)).first()
+        if entry is not None:
+            with self.lock:
+                self.database_hits += 1
+            self._remember(key, entry.city, entry.created_at.timestamp() + self.ttl)
+            return entry.city
+
+        with self.lock:
+            self.misses += 1
+        city = resolve(coordinates)
+        GeocodingCacheEntry.objects.update_or_create(key=key, defaults={"city": city, "created_at": timezone.now()})
+        self._remember(key, city, now + self.ttl)
+        return city
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"memory_hits": self.memory_hits, "database_hits": self.database_hits, "misses": self.misses,
+                    "size": len(self.entries)}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _remember(self, key: str, city, expires_at: float):
+        with self.lock:
+            self.entries[key] = (city, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+geocoding_cache = GeocodingCache(settings.GEOCODING_CACHE_PRECISION, settings.GEOCODING_CACHE_TTL,
+                                 settings.GEOCODING_CACHE_SIZE)
+
+
+def geocode_pending_properties(batch_size: int, after_id: int = 0) -> Tuple[Optional[int], int]:
+    """
+    Resolves cities of up to `batch_size` pending properties with ids greater than `after_id`. Returns the id of the
+    last property of the batch (None when there was none) and the number of properties updated. Properties whose
+    geocoding failed stay pending until their next attempt is due, see `PropertyManager.record_geocoding_failures`.
+    """
+    from graphql_api.models import Property
+    from graphql_api.utils import get_city
+    pending = list(Property.objects.filter(Q(geocoding_next_attempt_at=None) |
+                                           Q(geocoding_next_attempt_at__lte=timezone.now()),
+                                           geocoding_pending=True, id__gt=after_id).order_by("id")
+                   .only("id", "coordinates")[:batch_size])
+    if not pending:
+        return None, 0
+    geocoded, failed_ids = [], []
+    for pending_property in pending:
+        try:
+            geocoded.append((pending_property, get_city(pending_property.coordinates)))
+        except CircuitOpenError:
+            # degraded mode, the rest of the batch stays pending as well without counting an attempt
+            break
+        except Exception as e:
+            logger.exception(e)
+            failed_ids.append(pending_property.id)
+    if failed_ids:
+        Property.objects.record_geocoding_failures(failed_ids)
+    updated = Property.objects.set_geocoded_cities(geocoded) if geocoded else []
+    return pending[-1].id, len(updated)
+
+
+def resolve_pending_properties_offline(batch_size: int, after_id: int = 0) -> Tuple[Optional[int], int]:
+    """
+    Degraded variant of `geocode_pending_properties` for when the geocoder is unavailable, only the offline
+    `city_resolver` is used. Properties with no known city nearby stay pending without counting a failed attempt.
+    """
+    from graphql_api.models import City, Property
+    pending = list(Property.objects.filter(geocoding_pending=True, id__gt=after_id).order_by("id")
+                   .only("id", "coordinates")[:batch_size])
+    if not pending:
+        return None, 0
+    city_ids = city_resolver.resolve_ids([pending_property.coordinates for pending_property in pending])
+    cities = City.objects.in_bulk({city_id for city_id in city_ids if city_id is not None})
+    geocoded = [(pending_property, cities[city_id]) for pending_property, city_id in zip(pending, city_ids)
+                if city_id is not None]
+    updated = Property.objects.set_geocoded_cities(geocoded) if geocoded else []
+    return pending[-1].id, len(updated)
@@ -0,0 +1,91 @@
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+"""
+KD-tree of points on the sphere for nearest neighbour lookups.
+
+Points are stored as 3D unit vectors, the straight (chord) distance between them grows with their great-circle
+distance, so the nearest point by chord distance is the nearest one on the sphere and axis-aligned splits of the
+3D space give exact pruning.
+"""
+
+EARTH_RADIUS = 6371008.8
+
+
+def to_unit_vectors(latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    phi, lam = np.radians(latitudes), np.radians(longitudes)
+    return np.column_stack((np.cos(phi) * np.cos(lam), np.cos(phi) * np.sin(lam), np.sin(phi)))
+
+
+def chord_to_meters(chord: float) -> float:
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / 2))
+
+
+class SphereKDTree:
+    LEAF_SIZE = 32
+
+    def __init__(self, latitudes, longitudes):
+        self.points = to_unit_vectors(np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float))
+        self.order = np.arange(len(self.points))
+        # nodes: (axis, split, left, right) for inner nodes, (-1, 0, start, end) of `order` for leaves
+        self.nodes: List[Tuple[int, float, int, int]] = []
+        if len(self.points):
+            self._build(0, len(self.points))
+        # points in the order of the leaves, so that a leaf is a contiguous slice
+        self.leaf_points = self.points[self.order]
+
+    def __len__(self):
+        return len(self.points)
+
+    def _build(self, start: int, end: int) -> int:
+        # iterative, the stack holds (node index, start, end) of nodes to be split
+        root = self._add_leaf(start, end)
+        stack = [(root, start, end)]
+        while stack:
+            node, start, end = stack.pop()
+            if end - start <= self.LEAF_SIZE:
+                continue
+            indices = self.order[start:end]
+            axis = int(np.argmax(np.ptp(self.points[indices], axis=0)))
+            middle = (end - start) // 2
+            self.order[start:end] = indices[np.argpartition(self.points[indices, axis], middle)]
+            split = float(self.points[self.order[start + middle], axis])
+            left = self._add_leaf(start, start + middle)
+            right = self._add_leaf(start + middle, end)
+            self.nodes[node] = (axis, split, left, right)
+            stack += [(left, start, start + middle), (right, start + middle, end)]
+        return root
+
+    def _add_leaf(self, start: int, end: int) -> int:
+        self.nodes.append((-1, 0.0, start, end))
+        return len(self.nodes) - 1
+
+    def nearest(self, latitude: float, longitude: float) -> Optional[Tuple[int, float]]:
+        """Index of the nearest point and its distance in meters, None for an empty tree"""
+        if not self.nodes:
+            return None
+        phi, lam = math.radians(latitude), math.radians(longitude)
+        query_coordinates = [math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi)]
+        query = np.array(query_coordinates)
+        best_index, best_distance = -1, math.inf
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_distance:
+                continue
+            axis, split, left, right = self.nodes[node]
+            if axis < 0:
+                differences = self.leaf_points[left:right] - query
+                distances = np.einsum("ij,ij->i", differences, differences)
+                closest = int(np.argmin(distances))
+                if distances[closest] < best_distance:
+                    best_index, best_distance = int(self.order[left + closest]), float(distances[closest])
+                continue
+            difference = query_coordinates[axis] - split
+            near, far = (left, right) if difference < 0 else (right, left)
+            # far side is pushed first, so the near one is searched first
+            stack.append((far, max(bound, difference * difference)))
+            stack.append((near, bound))
+        return best_index, chord_to_meters(math.sqrt(best_distance))
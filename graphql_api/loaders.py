@@ -0,0 +1,101 @@
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from django.db import models
+from django.db.models import prefetch_related_objects
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor, ReverseManyToOneDescriptor, \
+    ReverseOneToOneDescriptor
+from graphene.utils.str_converters import to_snake_case
+
+"""
+Per-request batching of relation lookups, so that nested queries don't run a query per parent object.
+
+Model instances returned by list fields are registered as siblings. The first lookup of a relation of one of them
+fetches it for all of its siblings with one `IN` query (`prefetch_related_objects`), the other lookups are served
+from the prefetched caches. Objects fetched together are registered as siblings as well, so the next level of the
+query is batched the same way.
+
+The loader is created for every request by `WorkAroundGraphQLView.get_context`, relation fields with the default
+resolver are loaded by `RelationLoaderMiddleware`, custom resolvers use `get_loader(info)`.
+"""
+
+
+@lru_cache(maxsize=None)
+def is_relation(model, name: str) -> bool:
+    descriptor = getattr(model, name, None)
+    return isinstance(descriptor, (ForwardManyToOneDescriptor, ReverseOneToOneDescriptor, ReverseManyToOneDescriptor))
+
+
+def is_many(model, relation: str) -> bool:
+    return isinstance(getattr(model, relation), ReverseManyToOneDescriptor)
+
+
+class RelationLoader:
+    def __init__(self):
+        # id of an instance -> instances fetched together with it, which also keeps the instances (and their ids)
+        # alive until the end of the request
+        self.siblings: Dict[int, List[models.Model]] = {}
+        # (id of a list of siblings, relation) already loaded
+        self.loaded: Set[Tuple[int, str]] = set()
+
+    def register(self, instances: Iterable[models.Model]) -> List[models.Model]:
+        """Registers `instances` as siblings, instances already registered keep their siblings"""
+        instances = list(instances)
+        for instance in instances:
+            self.siblings.setdefault(id(instance), instances)
+        return instances
+
+    def load(self, instance: models.Model, relation: str):
+        """Value of `relation` of `instance` (a list for to-many relations), fetched for all of its siblings"""
+        siblings = self.siblings.get(id(instance)) or self.register([instance])
+        if (id(siblings), relation) not in self.loaded:
+            self.loaded.add((id(siblings), relation))
+            # siblings which already have the relation cached (e.g. by `select_related`) are skipped
+            prefetch_related_objects(siblings, relation)
+            self.register(related for sibling in siblings for related in self._related(sibling, relation))
+        related = self._related(instance, relation)
+        return related if is_many(type(instance), relation) else next(iter(related), None)
+
+    def load_path(self, instance: models.Model, path: str) -> List[models.Model]:
+        """Objects reached from `instance` through a `__` separated path of relations, e.g. `properties__applications`"""
+        instances = [instance]
+        for relation in path.split("__"):
+            instances = [related for instance in instances for related in self._loaded_related(instance, relation)]
+        return instances
+
+    def _loaded_related(self, instance: models.Model, relation: str) -> List[models.Model]:
+        self.load(instance, relation)
+        return self._related(instance, relation)
+
+    @staticmethod
+    def _related(instance: models.Model, relation: str) -> List[models.Model]:
+        if is_many(type(instance), relation):
+            return list(getattr(instance, relation).all())
+        related = getattr(instance, relation)
+        return [related] if related is not None else []
+
+
+def get_loader(info) -> RelationLoader:
+    """Loader of the request, a new one when executed outside of `WorkAroundGraphQLView`"""
+    return getattr(info.context, "loader", None) or RelationLoader()
+
+
+class RelationLoaderMiddleware:
+    """Batches relation fields of models which don't have a custom resolver and registers listed instances"""
+
+    def resolve(self, next, root, info, **args):
+        loader: Optional[RelationLoader] = getattr(info.context, "loader", None)
+        if loader is None:
+            return next(root, info, **args)
+
+        if isinstance(root, models.Model):
+            name = to_snake_case(info.field_name)
+            graphene_type = getattr(info.parent_type, "graphene_type", None)
+            if is_relation(type(root), name) and not hasattr(graphene_type, f"resolve_{name}"):
+                loader.load(root, name)
+
+        result = next(root, info, **args)
+        if isinstance(result, models.QuerySet) or \
+                isinstance(result, list) and result and isinstance(result[0], models.Model):
+            return loader.register(result)
+        return result
@@ -0,0 +1,73 @@
+import random
+import time
+
+from django.contrib.gis.db.models.functions import Distance
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from graphql_api.models import Property, User
+from graphql_api.schema import get_closest_properties
+from graphql_api.utils import GeographyPoint
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Creates a synthetic property set and prints query plans and timings of the closest properties query " \
+           "before and after the KNN rewrite. Everything is rolled back unless --keep is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=100000, help="Number of synthetic properties.")
+        parser.add_argument("--spread", type=float, default=5.0,
+                            help="Degrees around the center in which the properties are scattered.")
+        parser.add_argument("--max-distance", type=float, default=20.0, help="Radius of the query in kilometers.")
+        parser.add_argument("--limit", type=int, default=50)
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per query, the best one is reported.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--keep", action="store_true", help="Keep the synthetic properties.")
+
+    def handle(self, *args, size: int, spread: float, max_distance: float, limit: int, repeat: int, seed: int,
+               keep: bool, **options):
+        try:
+            with transaction.atomic():
+                self.create_properties(size, spread, seed)
+                with connection.cursor() as cursor:
+                    cursor.execute(f"ANALYZE {Property._meta.db_table}")
+                self.run(max_distance, limit, repeat)
+                if not keep:
+                    raise Rollback()
+        except Rollback:
+            pass
+
+    def create_properties(self, size: int, spread: float, seed: int):
+        generator = random.Random(seed)
+        user = User.objects.create_user(username=f"benchmark-{time.time_ns()}",
+                                        email=f"benchmark-{time.time_ns()}@example.com")
+        center = GeographyPoint(x=50.083076, y=14.420020)
+        Property.objects.bulk_create((
+            Property(coordinates=GeographyPoint(center.x + generator.uniform(-spread, spread),
+                                                center.y + generator.uniform(-spread, spread)),
+                     user=user, name=f"Benchmark property {i}", usd_worth=1000, photo_id="benchmark",
+                     meters_squared=50, is_available=generator.random() < 0.5)
+            for i in range(size)
+        ), batch_size=5000)
+        self.stdout.write(f"Created {size} properties.")
+
+    def run(self, max_distance: float, limit: int, repeat: int):
+        center = GeographyPoint(x=50.083076, y=14.420020)
+        queries = {
+            # the original query: distance of every row, filtered and ordered by the annotation
+            "before": Property.objects.annotate(distance=Distance("coordinates", center))
+                .filter(distance__lte=max_distance * 1000).order_by("distance")[:limit],
+            "after": get_closest_properties(max_distance=max_distance)[:limit],
+        }
+        for name, queryset in queries.items():
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append(time.perf_counter() - start)
+            self.stdout.write(f"=== {name}: {min(timings) * 1000:.1f} ms")
+            self.stdout.write(queryset.explain(analyze=True, buffers=True))
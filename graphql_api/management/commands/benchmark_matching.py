@@ -0,0 +1,42 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from graphql_api.benchmarks import ENGINES, generate_applications, run_benchmark, benchmark_report, save_report, \
+    compare_reports
+
+
+class Command(BaseCommand):
+    help = "Runs matching engines on a synthetic application population and reports wall time, peak memory and " \
+           "number of found cycles."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=1000, help="Number of applications.")
+        parser.add_argument("--cities", type=int, default=50)
+        parser.add_argument("--city-skew", type=float, default=1.0,
+                            help="Exponent of the Zipf distribution of city popularity, 0 for uniform.")
+        parser.add_argument("--preferences", type=int, default=3, help="Preferred cities per application.")
+        parser.add_argument("--groups", type=int, default=4, help="Number of distinct lengths of stay.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--engines", nargs="+", choices=list(ENGINES), default=["bounded"])
+        parser.add_argument("--repeat", type=int, default=1, help="Timed runs per engine, the best one is reported.")
+        parser.add_argument("--output", help="Save the results as JSON to this path.")
+        parser.add_argument("--compare", help="JSON results of a previous run to check for regressions against.")
+
+    def handle(self, *args, engines, repeat, output, compare, **options):
+        parameters = {key: options[key] for key in ("size", "cities", "city_skew", "preferences", "groups", "seed")}
+        applications = generate_applications(**parameters)
+        report = benchmark_report(parameters, run_benchmark(applications, engines, repeat))
+
+        for name, result in report["results"].items():
+            self.stdout.write(f"{name:>10}: {result['wall_time']:.3f}s, {result['peak_memory'] / 2 ** 20:.1f} MiB, "
+                              f"{result['cycles']} cycles, {result['applications_in_cycles']} applications")
+        if output:
+            save_report(report, output)
+        if compare:
+            with open(compare) as f:
+                regressions = compare_reports(report, json.load(f))
+            for regression in regressions:
+                self.stderr.write(f"Regression {regression}")
+            if not regressions:
+                self.stdout.write("No regressions.")
@@ -0,0 +1,274 @@
+import csv
+import json
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from dateutil.parser import isoparse
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from graphql_api.city_resolver import city_resolver
+from graphql_api.models import Application, ApplicationPreferredCity, City, CommuteType, CommuteTypeApplication, \
+    FacilityType, FacilityTypeApplication, FacilityTypeProperty, LifestyleType, LifestyleTypeApplication, \
+    LifestyleTypeProperty, MatchingJob, Property, PropertyType, PropertyTypeApplication, User
+from graphql_api.spatial_cache import property_cache
+from graphql_api.utils import GeographyPoint, chunked
+
+"""
+Rows are properties, optionally with the application of the property, named like the arguments of the
+`createProperty` and `createApplication` mutations:
+
+{"user_id": 1, "name": "Flat", "coordinates": {"x": 50.08, "y": 14.42}, "usd_worth": 1000, "photo_id": "photo",
+ "meters_squared": 50, "facility_type_ids": [1], "lifestyle_type_ids": [], "application": {"length_of_stay": 6,
+ "move_in_date": "2021-11-01", "pet_friendly": true, "preferred_cities_ids": [2, 3], "lifestyle_types_ids": [],
+ "commute_types_ids": [], "property_types_ids": [], "facility_types_ids": []}}
+
+CSV files have the same columns with `x` and `y` instead of `coordinates`, application columns prefixed with
+`application_` and lists of ids separated by `;`.
+"""
+
+
+class RejectedRow(Exception):
+    pass
+
+
+@dataclass
+class InventoryRow:
+    property: Property
+    facility_type_ids: List[int]
+    lifestyle_type_ids: List[int]
+    application: Optional[Application] = None
+    application_ids: Dict[str, List[int]] = field(default_factory=dict)
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("true", "1", "yes"):
+        return True
+    if str(value).lower() in ("false", "0", "no"):
+        return False
+    raise ValueError(value)
+
+
+def parse_ids(value) -> List[int]:
+    if isinstance(value, str):
+        value = [part for part in value.split(";") if part.strip()]
+    return [int(item) for item in value]
+
+
+def get_value(record: dict, name: str, convert, required: bool = True):
+    value = record.get(name)
+    if value is None or value == "":
+        if required:
+            raise RejectedRow(f"{name} is required")
+        return None
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise RejectedRow(f"{name} is invalid: {value!r}")
+
+
+def validate(instance, exclude: List[str], prefix: str = ""):
+    """
+    Validates `instance` against the constraints of its model (lengths, choices, ...), which bulk inserts skip.
+    Foreign keys in `exclude` are validated per chunk instead of a query per row.
+    """
+    try:
+        instance.full_clean(exclude=exclude, validate_unique=False)
+    except ValidationError as e:
+        raise RejectedRow("; ".join(f"{prefix}{name} is invalid: {' '.join(messages)}"
+                                    for name, messages in e.message_dict.items()))
+
+
+class Command(BaseCommand):
+    help = "Imports properties and their applications from a JSON lines or CSV file in chunks of bulk inserts, " \
+           "cities are resolved offline or left to the geocoding worker and a single matching job is enqueued " \
+           "at the end."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=["auto", "jsonl", "csv"], default="auto",
+                            help="Format of the file, by its extension by default.")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Rows written in one transaction.")
+        parser.add_argument("--rejected", default=None,
+                            help="File to write rejected rows to as JSON lines with the reason of the rejection.")
+        parser.add_argument("--no-matching", action="store_true", help="Don't enqueue matching after the import.")
+
+    def handle(self, *args, path: str, format: str, chunk_size: int, rejected: str, no_matching: bool, **options):
+        if format == "auto":
+            format = "csv" if path.lower().endswith(".csv") else "jsonl"
+        # referenced rows of small tables are validated in memory, users per chunk
+        self.known_ids = {
+            model: set(model.objects.values_list("id", flat=True))
+            for model in (City, PropertyType, FacilityType, LifestyleType, CommuteType)
+        }
+        start = time.monotonic()
+        imported_properties = imported_applications = matchable_applications = rejected_count = pending = 0
+        with open(path, newline="") as f, (open(rejected, "w") if rejected else nullcontext()) as rejected_file:
+            for chunk in chunked(self.read(f, format), chunk_size):
+                rows, rejections = self.parse_chunk(chunk)
+                for line, record, reason in rejections:
+                    self.stderr.write(f"Line {line} rejected: {reason}")
+                    if rejected_file is not None:
+                        rejected_file.write(json.dumps({"line": line, "reason": reason, "row": record}) + "\n")
+                rejected_count += len(rejections)
+                pending += self.write_chunk(rows)
+                if rows:
+                    # bulk inserts don't send `post_save`, the spatial caches of the web processes are reloaded
+                    property_cache.invalidate()
+                imported_properties += len(rows)
+                imported_applications += sum(row.application is not None for row in rows)
+                matchable_applications += sum(row.application is not None and row.property.city_id is not None
+                                              for row in rows)
+                elapsed = max(time.monotonic() - start, 1e-9)
+                self.stdout.write(f"{imported_properties} properties imported, {rejected_count} rows rejected "
+                                  f"({imported_properties / elapsed:.0f} rows/s)")
+
+        elapsed = max(time.monotonic() - start, 1e-9)
+        self.stdout.write(f"Imported {imported_properties} properties and {imported_applications} applications "
+                          f"in {elapsed:.1f}s ({imported_properties / elapsed:.0f} rows/s), "
+                          f"rejected {rejected_count} rows, {pending} properties are waiting for the geocoding "
+                          f"worker.")
+        # applications of properties waiting for geocoding get jobs of their own once their cities are resolved
+        # (skipped while this job is still pending, as it will read them then)
+        if not no_matching and matchable_applications:
+            job = MatchingJob.objects.enqueue()
+            self.stdout.write(f"Enqueued matching job {job.id}.")
+
+    def read(self, f, format: str) -> Iterator[Tuple[int, object]]:
+        """(line number, record) of the rows, invalid JSON lines are passed on as strings"""
+        if format == "csv":
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield reader.line_num, self.from_csv(row)
+            return
+        for line, text in enumerate(f, start=1):
+            if not text.strip():
+                continue
+            try:
+                yield line, json.loads(text)
+            except ValueError:
+                yield line, text
+
+    def from_csv(self, row: Dict[str, str]) -> dict:
+        # values of a row longer than the header are under the None key
+        row.pop(None, None)
+        record = {key: value for key, value in row.items()
+                  if not key.startswith("application_") and key not in ("x", "y")}
+        record["coordinates"] = {"x": row.get("x"), "y": row.get("y")}
+        application = {key[len("application_"):]: value for key, value in row.items()
+                       if key.startswith("application_") and value != ""}
+        if application:
+            record["application"] = application
+        return record
+
+    def parse_chunk(self, chunk: List[Tuple[int, object]]):
+        rows, rejections = [], []
+        parsed = []
+        for line, record in chunk:
+            try:
+                parsed.append((line, record, self.parse(record)))
+            except RejectedRow as e:
+                rejections.append((line, record, str(e)))
+        user_ids = set(User.objects.filter(id__in={row.property.user_id for _, _, row in parsed})
+                       .values_list("id", flat=True))
+        for line, record, row in parsed:
+            if row.property.user_id in user_ids:
+                rows.append(row)
+            else:
+                rejections.append((line, record, f"user {row.property.user_id} does not exist"))
+        return rows, rejections
+
+    def parse(self, record) -> InventoryRow:
+        if not isinstance(record, dict):
+            raise RejectedRow("not a JSON object")
+        coordinates = record.get("coordinates") or {}
+        if not isinstance(coordinates, dict):
+            raise RejectedRow("coordinates is invalid")
+        created_property = Property(
+            user_id=get_value(record, "user_id", int),
+            name=get_value(record, "name", str),
+            description=get_value(record, "description", str, required=False),
+            coordinates=GeographyPoint(get_value(coordinates, "x", float), get_value(coordinates, "y", float)),
+            is_available=get_value(record, "is_available", parse_bool, required=False) or False,
+            usd_worth=get_value(record, "usd_worth", float),
+            photo_id=get_value(record, "photo_id", str),
+            meters_squared=get_value(record, "meters_squared", int),
+            property_type_id=self.get_reference(record, "property_type_id", PropertyType),
+            room_type=get_value(record, "room_type", str, required=False),
+        )
+        validate(created_property, exclude=["user", "property_type", "city"])
+        row = InventoryRow(created_property,
+                           self.get_references(record, "facility_type_ids", FacilityType),
+                           self.get_references(record, "lifestyle_type_ids", LifestyleType))
+        application = record.get("application")
+        if application is not None and not isinstance(application, dict):
+            raise RejectedRow("application is invalid")
+        if application:
+            row.application = Application(
+                length_of_stay=get_value(application, "length_of_stay", int),
+                move_in_date=get_value(application, "move_in_date", isoparse, required=False),
+                pet_friendly=get_value(application, "pet_friendly", parse_bool, required=False),
+                number_of_people=get_value(application, "number_of_people", int, required=False),
+            )
+            validate(row.application, exclude=["property"], prefix="application ")
+            row.application_ids = {
+                name: self.get_references(application, name, model)
+                for name, model in (("preferred_cities_ids", City), ("lifestyle_types_ids", LifestyleType),
+                                    ("commute_types_ids", CommuteType), ("property_types_ids", PropertyType),
+                                    ("facility_types_ids", FacilityType))
+            }
+        return row
+
+    def get_reference(self, record: dict, name: str, model) -> Optional[int]:
+        value = get_value(record, name, int, required=False)
+        if value is not None and value not in self.known_ids[model]:
+            raise RejectedRow(f"{model.__name__} {value} does not exist")
+        return value
+
+    def get_references(self, record: dict, name: str, model) -> List[int]:
+        values = get_value(record, name, parse_ids, required=False) or []
+        unknown = [value for value in values if value not in self.known_ids[model]]
+        if unknown:
+            raise RejectedRow(f"{model.__name__} {unknown[0]} does not exist")
+        return values
+
+    @transaction.atomic
+    def write_chunk(self, rows: List[InventoryRow]) -> int:
+        """Writes the rows, returns the number of properties left to the geocoding worker"""
+        city_ids = city_resolver.resolve_ids([row.property.coordinates for row in rows])
+        for row, city_id in zip(rows, city_ids):
+            row.property.city_id = city_id
+            row.property.geocoding_pending = city_id is None
+        Property.objects.bulk_create([row.property for row in rows])
+        FacilityTypeProperty.objects.bulk_create(
+            FacilityTypeProperty(property_id=row.property.id, facility_type_id=facility_type_id)
+            for row in rows for facility_type_id in row.facility_type_ids
+        )
+        LifestyleTypeProperty.objects.bulk_create(
+            LifestyleTypeProperty(property_id=row.property.id, lifestyle_type_id=lifestyle_type_id)
+            for row in rows for lifestyle_type_id in row.lifestyle_type_ids
+        )
+
+        rows = [row for row in rows if row.application is not None]
+        for row in rows:
+            row.application.property_id = row.property.id
+        Application.objects.bulk_create([row.application for row in rows])
+        ApplicationPreferredCity.objects.bulk_create(
+            ApplicationPreferredCity(application_id=row.application.id, city_id=city_id, order=index + 1)
+            for row in rows for index, city_id in enumerate(row.application_ids["preferred_cities_ids"])
+        )
+        for model, name, field_name in (
+                (LifestyleTypeApplication, "lifestyle_types_ids", "lifestyle_type_id"),
+                (CommuteTypeApplication, "commute_types_ids", "commute_type_id"),
+                (PropertyTypeApplication, "property_types_ids", "property_type_id"),
+                (FacilityTypeApplication, "facility_types_ids", "facility_type_id")):
+            model.objects.bulk_create(
+                model(application_id=row.application.id, **{field_name: related_id})
+                for row in rows for related_id in row.application_ids[name]
+            )
+        return sum(city_id is None for city_id in city_ids)
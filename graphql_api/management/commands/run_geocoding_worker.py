@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from graphql_api.geocoder import geocoder
+from graphql_api.geocoding import geocode_pending_properties, geocoding_cache, resolve_pending_properties_offline
+from graphql_api.models import GeocoderStatus
+
+
+class Command(BaseCommand):
+    help = "Resolves cities of properties saved with a pending city in batches and enqueues matching of their " \
+           "applications. While the geocoder is unavailable only cities known offline are resolved."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Properties resolved per transaction.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to sleep after a pass over the pending properties.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit after a single pass instead of polling.")
+
+    def handle(self, *args, batch_size: int, poll_interval: float, once: bool, **options):
+        while True:
+            self.run_pass(batch_size)
+            # the `geocoder` query reads the figures of this process
+            GeocoderStatus.objects.report(geocoder.breaker.stats(), geocoder.retries, geocoding_cache.stats())
+            if once:
+                return
+            time.sleep(poll_interval)
+
+    def run_pass(self, batch_size: int):
+        # while the geocoder is unavailable, the rest of the properties wait for the breaker to let a trial request
+        # through, properties whose geocoding failed are skipped until the next pass
+        offline = bool(geocoder.breaker.retry_in())
+        after_id, total = 0, 0
+        while True:
+            geocode = resolve_pending_properties_offline if offline else geocode_pending_properties
+            after_id, updated = geocode(batch_size, after_id)
+            if after_id is None:
+                break
+            total += updated
+            if not offline and geocoder.breaker.retry_in():
+                self.stdout.write(f"Geocoder unavailable, retrying in {geocoder.breaker.retry_in():.0f}s, "
+                                  f"resolving known cities only.")
+                offline = True
+        if total:
+            self.stdout.write(f"Geocoded {total} properties.")
@@ -0,0 +1,92 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from graphql_api.cycles import limit_cycles_per_node, SearchBudget
+from graphql_api.matching import MatchingAlgorithm
+from graphql_api.models import Recommendation
+
+
+class Command(BaseCommand):
+    help = "Recomputes recommendations off the request path, printing statistics of every application group."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--group", nargs="+", default=None,
+                            help="Only match these groups, given as comma separated group keys (e.g. `6` for "
+                                 "length of stay of 6 months).")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Stream found cycles to stdout as JSON lines instead of writing recommendations, "
+                                 "statistics go to stderr.")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Number of recommendations written by one bulk insert.")
+        parser.add_argument("--budget", type=float, default=None,
+                            help="Wall-clock seconds after which the search stops and the cycles found so far are "
+                                 "used, MATCHING_BUDGET_SECONDS by default.")
+        parser.add_argument("--budget-expansions", type=int, default=None,
+                            help="Number of expanded nodes after which the search stops, MATCHING_BUDGET_EXPANSIONS "
+                                 "by default.")
+
+    def handle(self, *args, group, dry_run: bool, batch_size: int, budget: float, budget_expansions: int, **options):
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.log = self.stderr if dry_run else self.stdout
+        algorithm = MatchingAlgorithm()
+        if budget is not None or budget_expansions is not None:
+            search_budget = SearchBudget(budget, budget_expansions)
+        else:
+            search_budget = algorithm.create_budget()
+
+        groups = algorithm.group_applications(algorithm.get_matchable_applications())
+        if group is not None:
+            groups = [g for g in groups if self.format_key(algorithm.get_group_by_attributes(g[0])) in group]
+
+        for application_group in groups:
+            # each group is committed on its own, so the locks of reconciliation aren't held for the whole run
+            with transaction.atomic():
+                finished = self.match_group(algorithm, application_group, search_budget)
+            if not finished:
+                self.log.write("Matching budget exhausted, results are partial.")
+                break
+
+    def match_group(self, algorithm: MatchingAlgorithm, application_group, budget: SearchBudget) -> bool:
+        """Matches one group, returns False when the budget got exhausted"""
+        start = time.monotonic()
+        graph = algorithm.build_group_graph(application_group)
+        # the cheapest components first, so that a budget is spent on the most promising ones
+        components = sorted(algorithm.split_graph(graph, budget), key=len)
+        cycles = limit_cycles_per_node(algorithm.iter_cycles_of_components(components, budget),
+                                       algorithm.max_cycles_per_application)
+
+        number_of_cycles = 0
+        changes = ""
+        if self.dry_run:
+            for cycle in cycles:
+                self.stdout.write(json.dumps(cycle))
+                number_of_cycles += 1
+            finished = budget is None or not budget.exhausted
+        else:
+            cycles = list(cycles)
+            number_of_cycles = len(cycles)
+            finished = budget is None or not budget.exhausted
+            # cycles not found within the budget aren't stale, so recommendations are only deleted after a full run
+            group_filter = algorithm.get_group_filter(application_group[0])
+            stale = Recommendation.objects.filter(**{
+                f"recommendation_applications__application__{key}": value for key, value in group_filter.items()
+            }) if finished else None
+            created, deleted = Recommendation.objects.reconcile(cycles, stale, batch_size=self.batch_size,
+                                                                are_broken=algorithm.are_cycles_broken)
+            changes = f" ({created} created, {deleted} deleted)"
+
+        key = self.format_key(algorithm.get_group_by_attributes(application_group[0]))
+        # hub edges, counting the application edges would be quadratic for a popular city
+        self.log.write(f"group {key}: {len(graph)} nodes, {graph.number_of_hub_edges} hub edges, "
+                       f"{len(components)} non-trivial SCCs (largest {max(map(len, components), default=0)}), "
+                       f"{number_of_cycles} cycles{'' if finished else ' (partial)'}{changes}, "
+                       f"{time.monotonic() - start:.2f}s")
+        return finished
+
+    @staticmethod
+    def format_key(key: tuple) -> str:
+        return ",".join(map(str, key))
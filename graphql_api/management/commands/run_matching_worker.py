@@ -0,0 +1,53 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from graphql_api.matching import update_recommendations
+from graphql_api.models import MatchingJob
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Processes queued matching jobs. Jobs are claimed with SKIP LOCKED, jobs left running by a dead worker " \
+           "are claimed again after MATCHING_JOB_TIMEOUT seconds. Recommendations are reconciled under a lock, so " \
+           "several workers don't store a cycle twice."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit as soon as the queue is empty instead of polling.")
+
+    def handle(self, *args, poll_interval: float, once: bool, **options):
+        while True:
+            try:
+                job = MatchingJob.objects.claim_next()
+                if job is not None:
+                    self.process(job)
+                    continue
+            except Exception as e:
+                # e.g. a lost database connection, a claimed job is claimed again after MATCHING_JOB_TIMEOUT
+                logger.exception(e)
+                close_old_connections()
+            if once:
+                return
+            time.sleep(poll_interval)
+
+    def process(self, job: MatchingJob):
+        try:
+            # raises when the application has been deleted since the job was claimed
+            update_recommendations(job.application)
+        except Exception as e:
+            logger.exception(e)
+            finished = job.finish(error=repr(e))
+        else:
+            finished = job.finish()
+        if not finished:
+            self.stdout.write(f"Matching job {job.id} was deleted while running.")
+            return
+        self.stdout.write(f"Matching job {job.id} {job.status} "
+                          f"(waited {(job.started_at - job.created_at).total_seconds():.1f}s, "
+                          f"ran {(job.finished_at - job.started_at).total_seconds():.1f}s)")
@@ -1,65 +1,320 @@
+import logging
 from collections import defaultdict
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Dict, Iterator, List, Optional
 import itertools
 
-import networkx as nx
+from django.db import transaction
+from django.db.models import Count
+from django.utils.module_loading import import_string
 
-from graphql_api.models import Application
+from graphql_api.constraints import GroupConstraint, EdgeConstraint
+from graphql_api.cycles import iter_cycles_through, limit_cycles_per_node, find_top_cycles_through, SearchBudget
+from graphql_api.demand_graph import ApplicationNode, DemandGraph, iter_component_cycles, find_component_cycles, \
+    find_component_cycles_task
+from graphql_api.models import Application, Recommendation, ApplicationPreferredCity, RecommendationApplication, \
+    PropertyTypeApplication
+from graphql_api.packing import pack_disjoint_cycles
+from graphql_api.utils import pairwise
+from work_around import settings
 
 """
 SHELL TESTING:
 from graphql_api.matching import MatchingAlgorithm
 a = MatchingAlgorithm()
 a.find_matching_application_sets()
+a.find_matching_application_sets_through(Application.objects.last())
 """
 
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MatchingResult:
+    cycles: List[List[int]]
+    # the search budget got exhausted, the cycles are the ones found until then
+    partial: bool = False
+
+
 class MatchingAlgorithm:
-    """AI-powered algorithm to compute matchings among applicants"""
+    """
+    AI-powered algorithm to compute matchings among applicants
+
+    :param max_cycle_length: maximal number of applications in one cycle, `None` for unbounded
+    :param max_cycles_per_application: maximal number of returned cycles containing one application, `None` for
+        unbounded
+    :param workers: number of processes searching strongly connected components in parallel, 1 searches them
+        sequentially in the current process
+    :param disjoint: select only vertex-disjoint cycles covering as many applications as possible, so that each
+        application gets at most one recommendation
+    :param top_k: ranked mode, only the `top_k` cycles of each application in which the participants get the most
+        preferred cities are returned, `None` for all cycles
+    :param constraints: hard constraints (`graphql_api.constraints`), group constraints partition the applications,
+        edge constraints prune edges of the graph
+    :param budget_seconds: wall-clock budget of one search, after which the results found so far are returned
+    :param budget_expansions: budget of one search in expanded nodes (divided evenly among the strongly connected
+        components when they are searched in parallel)
+    """
+
+    def __init__(self, max_cycle_length: Optional[int] = settings.MATCHING_MAX_CYCLE_LENGTH,
+                 max_cycles_per_application: Optional[int] = settings.MATCHING_MAX_CYCLES_PER_APPLICATION,
+                 workers: int = settings.MATCHING_WORKERS, disjoint: bool = settings.MATCHING_DISJOINT,
+                 top_k: Optional[int] = settings.MATCHING_TOP_K, constraints: list = None,
+                 budget_seconds: Optional[float] = settings.MATCHING_BUDGET_SECONDS,
+                 budget_expansions: Optional[int] = settings.MATCHING_BUDGET_EXPANSIONS):
+        self.max_cycle_length = max_cycle_length or None
+        self.max_cycles_per_application = max_cycles_per_application or None
+        self.workers = workers
+        self.disjoint = disjoint
+        self.top_k = top_k or None
+        self.budget_seconds = budget_seconds or None
+        self.budget_expansions = budget_expansions or None
+        if constraints is None:
+            constraints = [import_string(path)() for path in settings.MATCHING_CONSTRAINTS]
+        self.group_constraints = [c for c in constraints if isinstance(c, GroupConstraint)]
+        self.edge_constraints = [c for c in constraints if isinstance(c, EdgeConstraint)]
+
+    def get_matchable_applications(self, **filters) -> List[ApplicationNode]:
+        applications = Application.objects.filter(accepted=False, **filters) \
+            .values_list("id", "length_of_stay", "property__city_id", "pet_friendly", "number_of_people",
+                         "property__property_type_id")
+        application_filters = {f"application__{key}": value for key, value in filters.items()}
+        preferences = ApplicationPreferredCity.objects \
+            .filter(application__accepted=False, **application_filters) \
+            .order_by("application_id", "order") \
+            .values_list("application_id", "city_id")
+        accepted_property_types = PropertyTypeApplication.objects \
+            .filter(application__accepted=False, **application_filters) \
+            .values_list("application_id", "property_type_id")
+
+        preferred_city_ids = defaultdict(list)
+        for application_id, city_id in preferences:
+            preferred_city_ids[application_id].append(city_id)
+        accepted_property_type_ids = defaultdict(list)
+        for application_id, property_type_id in accepted_property_types:
+            accepted_property_type_ids[application_id].append(property_type_id)
+        return [ApplicationNode(id=application_id, length_of_stay=length_of_stay, city_id=city_id,
+                                preferred_city_ids=tuple(preferred_city_ids[application_id]),
+                                pet_friendly=pet_friendly, number_of_people=number_of_people,
+                                property_type_id=property_type_id,
+                                accepted_property_type_ids=tuple(accepted_property_type_ids[application_id]))
+                for application_id, length_of_stay, city_id, pet_friendly, number_of_people, property_type_id
+                in applications]
+
+    def create_budget(self) -> Optional[SearchBudget]:
+        if self.budget_seconds is None and self.budget_expansions is None:
+            return None
+        return SearchBudget(self.budget_seconds, self.budget_expansions)
+
+    def find_matching_application_sets(self, applications: List[ApplicationNode] = None) -> List[List[int]]:
+        return self.find_matching_result(applications).cycles
+
+    def find_matching_result(self, applications: List[ApplicationNode] = None) -> MatchingResult:
+        """Cycles among `applications` within the budget of the algorithm and whether the budget got exhausted"""
+        budget = self.create_budget()
+        cycles = list(self.iter_matching_application_sets(applications, budget))
+        return MatchingResult(cycles=cycles, partial=budget is not None and budget.exhausted)
 
-    def __init__(self):
-        pass
+    def iter_matching_application_sets(self, applications: List[ApplicationNode] = None,
+                                       budget: SearchBudget = None) -> Iterator[List[int]]:
+        """Cycles among `applications`, all matchable applications from the database are used by default"""
+        application_groups = self.group_applications(
+            self.get_matchable_applications() if applications is None else applications
+        )
+        return limit_cycles_per_node(self.iter_cycles_of_groups(application_groups, budget),
+                                     self.max_cycles_per_application)
 
-    def find_matching_application_sets(self) -> List[List[str]]:
-        all_applications = Application.objects.prefetch_related(
-            "property__city", "preferred_cities").filter(accepted=False)
+    def iter_cycles_of_groups(self, application_groups: List[List[ApplicationNode]],
+                              budget: SearchBudget = None) -> Iterator[List[int]]:
+        """
+        Cycles of the groups ordered by their smallest application id, with a budget the smallest groups go first.
+        Graphs of the groups are built and split only when the search gets to them, so an exhausted budget doesn't
+        pay for the remaining ones.
+        """
+        application_groups = sorted(application_groups, key=lambda group: (
+            len(group) if budget is not None else 0, min(application.id for application in group)))
+        for application_group in application_groups:
+            if budget is not None and not budget.check():
+                return
+            # cycles can't leave a strongly connected component, so components are searched independently, ordered
+            # by their smallest application id to get the same results regardless of the number of workers. With a
+            # budget the smallest (cheapest to search) components go first.
+            components = sorted(self.split_group(application_group, budget), key=lambda component: (
+                len(component) if budget is not None else 0, component[0].id))
+            yield from self.iter_cycles_of_components(components, budget)
 
+    def iter_cycles_of_components(self, components: List[List[ApplicationNode]],
+                                  budget: SearchBudget = None) -> Iterator[List[int]]:
+        options = dict(max_length=self.max_cycle_length, edge_constraints=self.edge_constraints,
+                       disjoint=self.disjoint, top_k=self.top_k,
+                       max_cycles_per_application=self.max_cycles_per_application)
+        if self.workers > 1:
+            # every task gets its own copy of the budget, so the expansions are divided among them upfront
+            budgets = budget.split(len(components)) if budget is not None else [None] * len(components)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for cycles, expanded, exhausted in executor.map(partial(find_component_cycles_task, **options),
+                                                                components, budgets):
+                    if budget is not None:
+                        budget.expanded += expanded
+                        budget.exhausted = budget.exhausted or exhausted
+                    yield from cycles
+        elif self.disjoint or self.top_k:
+            for component in components:
+                yield from find_component_cycles(component, budget=budget, **options)
+        else:
+            # lazily, so that the cycles don't have to be held in memory
+            for component in components:
+                if budget is not None and not budget.check():
+                    return
+                yield from iter_component_cycles(component, self.max_cycle_length, self.edge_constraints, budget,
+                                                 self.max_cycles_per_application)
+
+    def group_applications(self, applications: List[ApplicationNode]) -> List[List[ApplicationNode]]:
         application_groups = defaultdict(list)
 
-        for app in all_applications:
+        for app in applications:
             group_by = self.get_group_by_attributes(app)
             application_groups[group_by].append(app)
+        return list(application_groups.values())
+
+    def split_group(self, application_group: List[ApplicationNode],
+                    budget: SearchBudget = None) -> List[List[ApplicationNode]]:
+        """
+        Splits the group into strongly connected components, leaving out the ones which can't contain a cycle. No
+        components are returned once the deadline of `budget` has passed.
+        """
+        return self.split_graph(self.build_group_graph(application_group), budget)
+
+    def split_graph(self, graph: DemandGraph, budget: SearchBudget = None) -> List[List[ApplicationNode]]:
+        return [[graph.applications[node] for node in component]
+                for component in graph.strongly_connected_components(budget) if len(component) > 1]
+
+    def find_matching_application_sets_through(self, application: Application) -> List[List[int]]:
+        """
+        Incremental variant of `find_matching_application_sets` returning only the cycles passing through
+        `application`, each rotated so that it starts with it. Only the group of the application is loaded and
+        the search is limited to the applications that can both reach it and be reached from it.
+        """
+        if application.accepted:
+            return []
+        application_group = self.get_matchable_applications(**self.get_group_filter(application))
+        if self.disjoint:
+            # applications already having a pending recommendation can't be part of another one, the
+            # recommendations of the application itself are searched again
+            recommended_ids = set(RecommendationApplication.objects.filter(recommendation__accepted=False)
+                                  .exclude(recommendation__recommendation_applications__application=application)
+                                  .values_list("application_id", flat=True))
+            application_group = [a for a in application_group if a.id not in recommended_ids]
+        return self.find_cycles_through_application(application_group, application.id,
+                                                    self.count_stored_cycles(application))
+
+    def count_stored_cycles(self, application: Application) -> Dict[int, int]:
+        """
+        Numbers of unaccepted recommendations of the applications in the group of `application`, so that the limit
+        of cycles per application holds across incremental runs. Recommendations of `application` itself are left
+        out, its cycles are searched again.
+        """
+        group_filter = {f"application__{key}": value for key, value in self.get_group_filter(application).items()}
+        return dict(RecommendationApplication.objects.filter(recommendation__accepted=False, **group_filter)
+                    .exclude(recommendation__recommendation_applications__application=application)
+                    .values_list("application_id").annotate(count=Count("id")))
+
+    def build_group_graph(self, application_group: List[ApplicationNode]) -> DemandGraph:
+        return DemandGraph(application_group, self.edge_constraints)
+
+    def find_cycles_in_group(self, application_group: List[ApplicationNode]):
+        return list(limit_cycles_per_node(self.iter_cycles_in_group(application_group),
+                                          self.max_cycles_per_application))
+
+    def iter_cycles_in_group(self, application_group: List[ApplicationNode]) -> Iterator[List[int]]:
+        return self.iter_cycles_of_components(self.split_group(application_group))
+
+    def find_cycles_through_application(self, application_group: List[ApplicationNode], application_id: int,
+                                        stored_counts: Dict[int, int] = None):
+        graph = self.build_group_graph(application_group)
+        node = graph.node_of(application_id)
+        if node is None:
+            return []
+        # every cycle through the application stays inside its strongly connected component
+        component = graph.reachable(node) & graph.reachable(node, reverse=True)
+        if not component:
+            return []
+
+        budget = self.create_budget()
+        if self.top_k:
+            top_cycles = find_top_cycles_through(graph.weighted_successors, node, self.top_k,
+                                                 self.max_cycle_length or len(component), component.__contains__,
+                                                 budget)
+            cycles = list(limit_cycles_per_node((graph.to_application_ids(cycle) for _, cycle in top_cycles),
+                                                self.max_cycles_per_application, stored_counts))
+            return pack_disjoint_cycles(cycles) if self.disjoint else cycles
 
-        all_cycles = []
+        def successors(n):
+            return (successor for successor in graph.successors(n) if successor in component)
 
-        for application_group in application_groups.values():
-            cycles = self.find_cycles_in_group(application_group)
-            all_cycles += cycles
+        # the limit bounds the search (applications with enough stored cycles aren't expanded) and so the cycles
+        # to pack
+        counts = {graph.node_of(application_id): count for application_id, count in (stored_counts or {}).items()
+                  if graph.node_of(application_id) is not None}
+        cycles = [graph.to_application_ids(cycle)
+                  for cycle in iter_cycles_through(successors, node, self.max_cycle_length, budget,
+                                                   self.max_cycles_per_application, counts)]
+        return pack_disjoint_cycles(cycles) if self.disjoint else cycles
 
-        return all_cycles
+    def are_cycles_broken(self, cycles: List[List[int]]) -> List[bool]:
+        """
+        Whether stored cycles can't be completed anymore: one of its applications has been matched elsewhere or
+        deleted, or doesn't get the property of the next one (e.g. after the property moved to another city). The
+        applications of all the cycles are loaded together.
+        """
+        applications = {application.id: application for application in self.get_matchable_applications(
+            id__in=sorted({application_id for application_ids in cycles for application_id in application_ids}))}
+        return [self.is_cycle_broken(application_ids, applications) for application_ids in cycles]
 
-    def find_cycles_in_group(self, application_group: List[Application]):
-        G = nx.DiGraph()
-        G.add_nodes_from([a.id for a in application_group])
+    def is_cycle_broken(self, application_ids: List[int], matchable: Dict[int, ApplicationNode]) -> bool:
+        applications = [matchable[application_id] for application_id in set(application_ids)
+                        if application_id in matchable]
+        if len(application_ids) < 2 or len(applications) != len(set(application_ids)) \
+                or len({self.get_group_by_attributes(a) for a in applications}) > 1:
+            return True
+        graph = self.build_group_graph(applications)
+        nodes = [graph.node_of(application_id) for application_id in application_ids]
+        return any(successor not in set(graph.successors(node)) for node, successor in pairwise(nodes + nodes[:1]))
 
-        # maps cities to all applications offering a property in that city
-        property_city_to_applications_map = defaultdict(list)
-        for application in application_group:
-            property_city_to_applications_map[application.property.city_id]\
-                .append(application.id)
+    def get_group_by_attributes(self, application: ApplicationNode):
+        return tuple(constraint.get_key(application) for constraint in self.group_constraints)
 
-        for application in application_group:
-            for city in application.preferred_cities.all():
-                matching_application_ids = [
-                    # just in case
-                    a_id for a_id in property_city_to_applications_map[city.id]
-                    if a_id != application.id
-                ]
-                edges = [(application.id, matching_id) for matching_id in matching_application_ids]
-                G.add_edges_from(edges)
+    def get_group_filter(self, application: Application):
+        """Queryset filter selecting applications sharing the group of `get_group_by_attributes`"""
+        group_filter = {}
+        for constraint in self.group_constraints:
+            group_filter.update(constraint.get_filter(application))
+        return group_filter
 
-        simple_cycles = nx.simple_cycles(G)
-        return list(simple_cycles)
 
-    def get_group_by_attributes(self, application: Application):
-        return application.length_of_stay,
+@transaction.atomic
+def update_recommendations(application: Optional[Application] = None, algorithm: MatchingAlgorithm = None):
+    """
+    Updates recommendations after `application` has been created or changed (e.g. its property moved), its
+    unaccepted recommendations whose cycle is gone are deleted. Without `application` all unaccepted
+    recommendations are reconciled with a matching of all applications, only the changed ones are written.
+    """
+    algorithm = algorithm or MatchingAlgorithm()
+    if application is not None:
+        Recommendation.objects.delete_invalidated()
+        Recommendation.objects.reconcile(
+            algorithm.find_matching_application_sets_through(application),
+            stale=Recommendation.objects.filter(recommendation_applications__application=application),
+            are_broken=algorithm.are_cycles_broken)
+        return
 
+    result = algorithm.find_matching_result()
+    if result.partial:
+        # cycles which haven't been found in time aren't stale, so nothing is deleted
+        logger.warning(f"Matching budget exhausted, using {len(result.cycles)} cycles found so far.")
+    created, deleted = Recommendation.objects.reconcile(
+        result.cycles, stale=None if result.partial else Recommendation.objects.all(),
+        are_broken=algorithm.are_cycles_broken)
+    logger.info(f"Recommendations reconciled: {created} created, {deleted} deleted.")
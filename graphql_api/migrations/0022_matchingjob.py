@@ -0,0 +1,30 @@
+# Generated by Django 3.2.8 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0021_application_number_of_people'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.TextField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('application', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='matching_jobs', to='graphql_api.application')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='matchingjob',
+            index=models.Index(fields=['status', 'created_at'], name='matching_job_status_idx'),
+        ),
+    ]
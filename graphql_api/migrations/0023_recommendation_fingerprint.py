@@ -0,0 +1,40 @@
+# Generated by Django 3.2.8 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+def fill_fingerprints(apps, schema_editor):
+    Recommendation = apps.get_model('graphql_api', 'Recommendation')
+    RecommendationApplication = apps.get_model('graphql_api', 'RecommendationApplication')
+    for recommendation in Recommendation.objects.filter(fingerprint__isnull=True).iterator():
+        members = {
+            member.id: member
+            for member in RecommendationApplication.objects.filter(recommendation=recommendation)
+        }
+        if not members:
+            continue
+        # follow the `recommended` links from the member of the smallest application
+        start = min(members.values(), key=lambda member: member.application_id)
+        cycle = [start.application_id]
+        member = members.get(start.recommended_id)
+        while member is not None and member.id != start.id and len(cycle) < len(members):
+            cycle.append(member.application_id)
+            member = members.get(member.recommended_id)
+        recommendation.fingerprint = ",".join(map(str, cycle))
+        recommendation.save(update_fields=['fingerprint'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0022_matchingjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendation',
+            name='fingerprint',
+            field=models.TextField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+    ]
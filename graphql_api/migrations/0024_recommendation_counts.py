@@ -0,0 +1,37 @@
+# Generated by Django 3.2.8 on 2026-10-18 13:05
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_counts(apps, schema_editor):
+    Recommendation = apps.get_model('graphql_api', 'Recommendation')
+    RecommendationApplication = apps.get_model('graphql_api', 'RecommendationApplication')
+
+    def count(**filters):
+        members = RecommendationApplication.objects.filter(recommendation=models.OuterRef('pk'), **filters) \
+            .order_by().values('recommendation').annotate(count=models.Count('id')).values('count')
+        return Coalesce(models.Subquery(members), 0)
+
+    Recommendation.objects.update(accepted_count=count(accepted=True), total_count=count())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0023_recommendation_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recommendation',
+            name='accepted_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='recommendation',
+            name='total_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.8 on 2026-10-18 15:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0024_recommendation_counts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodingCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('city', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='geocoding_cache_entries', to='graphql_api.city')),
+            ],
+        ),
+    ]
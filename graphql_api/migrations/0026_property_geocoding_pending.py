@@ -0,0 +1,28 @@
+# Generated by Django 3.2.8 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+def mark_pending(apps, schema_editor):
+    Property = apps.get_model("graphql_api", "Property")
+    Property.objects.filter(city=None).update(geocoding_pending=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0025_geocodingcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='geocoding_pending',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='property',
+            index=models.Index(condition=models.Q(('geocoding_pending', True)), fields=['id'], name='property_geocoding_pending_idx'),
+        ),
+        migrations.RunPython(mark_pending, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.8 on 2026-10-18 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0026_property_geocoding_pending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='property',
+            name='geocoding_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='property',
+            name='geocoding_next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
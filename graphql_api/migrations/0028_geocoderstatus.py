@@ -0,0 +1,31 @@
+# Generated by Django 3.2.8 on 2026-10-18 21:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0027_property_geocoding_attempts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocoderStatus',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('breaker_state', models.TextField(default='closed')),
+                ('consecutive_failures', models.IntegerField(default=0)),
+                ('calls', models.IntegerField(default=0)),
+                ('failures', models.IntegerField(default=0)),
+                ('retries', models.IntegerField(default=0)),
+                ('rejected', models.IntegerField(default=0)),
+                ('opened', models.IntegerField(default=0)),
+                ('retry_at', models.DateTimeField(blank=True, null=True)),
+                ('cache_memory_hits', models.IntegerField(default=0)),
+                ('cache_database_hits', models.IntegerField(default=0)),
+                ('cache_misses', models.IntegerField(default=0)),
+                ('reported_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
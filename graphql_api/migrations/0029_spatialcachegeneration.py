@@ -0,0 +1,20 @@
+# Generated by Django 3.2.8 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0028_geocoderstatus'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpatialCacheGeneration',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
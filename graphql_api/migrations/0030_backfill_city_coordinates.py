@@ -0,0 +1,32 @@
+# Generated by Django 3.2.8 on 2026-10-18 22:15
+
+from collections import defaultdict
+
+from django.contrib.gis.geos import Point
+from django.db import migrations
+
+
+def backfill_city_coordinates(apps, schema_editor):
+    """Cities created without coordinates get the mean coordinates of their properties"""
+    City = apps.get_model("graphql_api", "City")
+    Property = apps.get_model("graphql_api", "Property")
+    sums = defaultdict(lambda: [0.0, 0.0, 0])
+    for city_id, point in Property.objects.filter(city__isnull=False, city__coordinates=None) \
+            .values_list("city_id", "coordinates").iterator():
+        city_sums = sums[city_id]
+        city_sums[0] += point.x
+        city_sums[1] += point.y
+        city_sums[2] += 1
+    for city_id, (x, y, count) in sums.items():
+        City.objects.filter(id=city_id).update(coordinates=Point(x / count, y / count, srid=4326))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('graphql_api', '0029_spatialcachegeneration'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_city_coordinates, migrations.RunPython.noop),
+    ]
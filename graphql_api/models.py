@@ -1,10 +1,28 @@
-from typing import List, Union
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 from django.contrib.auth.models import AbstractUser
 from django.contrib.gis.db import models
-from django.db import transaction
+from django.db import connection, transaction
+from django.utils import timezone
 
-from graphql_api.utils import pairwise
+from graphql_api.cycles import canonical_cycle
+from graphql_api.utils import chunked, pairwise
+from work_around import settings
+
+logger = logging.getLogger(__name__)
+
+
+def allocate_ids(model, count: int) -> List[int]:
+    """Takes `count` ids from the primary key sequence of `model`"""
+    if count == 0:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+                       [model._meta.db_table, model._meta.pk.column, count])
+        return [row[0] for row in cursor.fetchall()]
 
 
 class LengthOfStay(models.IntegerChoices):
@@ -39,6 +57,68 @@ class City(models.Model):
         unique_together = ("name", "country")
 
 
+class GeocodingCacheEntry(models.Model):
+    """City of quantized coordinates found by the reverse geocoder, see `graphql_api.geocoding`"""
+    key = models.CharField(max_length=50, unique=True)
+    # null when the geocoder didn't find a city
+    city = models.ForeignKey(City, models.CASCADE, blank=True, null=True, related_name="geocoding_cache_entries")
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class GeocoderStatusManager(models.Manager):
+    def report(self, breaker: Dict[str, object], retries: int, cache: Dict[str, int]) -> "GeocoderStatus":
+        """Stores stats of the circuit breaker and the cache of the geocoding worker process"""
+        retry_in = breaker["retry_in"]
+        status, _ = self.update_or_create(id=1, defaults={
+            "breaker_state": breaker["state"], "consecutive_failures": breaker["consecutive_failures"],
+            "calls": breaker["calls"], "failures": breaker["failures"], "retries": retries,
+            "rejected": breaker["rejected"], "opened": breaker["opened"],
+            "retry_at": timezone.now() + timedelta(seconds=retry_in) if retry_in is not None else None,
+            "cache_memory_hits": cache["memory_hits"], "cache_database_hits": cache["database_hits"],
+            "cache_misses": cache["misses"], "reported_at": timezone.now(),
+        })
+        return status
+
+
+class GeocoderStatus(models.Model):
+    """
+    Geocoder health as last reported by the geocoding worker, the only process calling the geocoder. A single row,
+    with several workers the counters are those of the one which reported last.
+    """
+    objects = GeocoderStatusManager()
+
+    breaker_state = models.TextField(default="closed")
+    consecutive_failures = models.IntegerField(default=0)
+    calls = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0)
+    retries = models.IntegerField(default=0)
+    rejected = models.IntegerField(default=0)
+    opened = models.IntegerField(default=0)
+    # when the open breaker lets a trial request through
+    retry_at = models.DateTimeField(blank=True, null=True)
+    cache_memory_hits = models.IntegerField(default=0)
+    cache_database_hits = models.IntegerField(default=0)
+    cache_misses = models.IntegerField(default=0)
+    reported_at = models.DateTimeField(blank=True, null=True)
+
+
+class SpatialCacheGenerationManager(models.Manager):
+    def current(self) -> int:
+        return self.filter(id=1).values_list("value", flat=True).first() or 0
+
+    def bump(self):
+        """Makes the spatial caches of all processes reload their cells, see `graphql_api.spatial_cache`"""
+        self.get_or_create(id=1)
+        self.filter(id=1).update(value=models.F("value") + 1)
+
+
+class SpatialCacheGeneration(models.Model):
+    """Counter bumped by writes of properties which don't send signals (e.g. bulk imports), a single row"""
+    objects = SpatialCacheGenerationManager()
+
+    value = models.IntegerField(default=0)
+
+
 class User(AbstractUser):
     email = models.EmailField(unique=True)
 
@@ -106,7 +186,59 @@ class PropertyTypeApplication(models.Model):
     application = models.ForeignKey(Application, models.CASCADE)
 
 
+class PropertyManager(models.Manager):
+    @transaction.atomic
+    def set_geocoded_cities(self, geocoded: List[Tuple["Property", Optional[City]]]) -> List["Property"]:
+        """
+        Sets cities found for pending properties and enqueues matching of their applications. Properties whose
+        coordinates have changed since they were read are left pending. Returns the updated properties.
+        """
+        locked = {
+            property_id: coordinates
+            for property_id, coordinates in self.select_for_update().filter(
+                id__in=[pending_property.id for pending_property, _ in geocoded], geocoding_pending=True
+            ).values_list("id", "coordinates")
+        }
+        updated, by_city = [], defaultdict(list)
+        for pending_property, city in geocoded:
+            if pending_property.id in locked and locked[pending_property.id] == pending_property.coordinates:
+                pending_property.city, pending_property.geocoding_pending = city, False
+                updated.append(pending_property)
+                by_city[city.id if city is not None else None].append(pending_property.id)
+        for city_id, property_ids in by_city.items():
+            self.filter(id__in=property_ids).update(city_id=city_id, geocoding_pending=False, geocoding_attempts=0,
+                                                    geocoding_next_attempt_at=None)
+        if updated:
+            MatchingJob.objects.enqueue_for_properties([updated_property.id for updated_property in updated])
+        return updated
+
+    @transaction.atomic
+    def record_geocoding_failures(self, property_ids: List[int]) -> int:
+        """
+        Postpones the next geocoding attempt of the pending properties with exponential backoff, properties which
+        have failed `GEOCODING_MAX_ATTEMPTS` times are given up and left with no city. Returns the number of given
+        up properties.
+        """
+        by_attempts = defaultdict(list)
+        for property_id, attempts in self.select_for_update().filter(id__in=property_ids, geocoding_pending=True) \
+                .values_list("id", "geocoding_attempts"):
+            by_attempts[attempts + 1].append(property_id)
+        given_up = 0
+        for attempts, failed_ids in by_attempts.items():
+            if attempts >= settings.GEOCODING_MAX_ATTEMPTS:
+                logger.warning(f"Geocoding of properties {failed_ids} given up after {attempts} attempts.")
+                given_up += self.filter(id__in=failed_ids).update(
+                    geocoding_pending=False, geocoding_attempts=attempts, geocoding_next_attempt_at=None)
+                continue
+            delay = min(settings.GEOCODING_RETRY_DELAY * 2 ** (attempts - 1), settings.GEOCODING_RETRY_MAX_DELAY)
+            self.filter(id__in=failed_ids).update(geocoding_attempts=attempts,
+                                                  geocoding_next_attempt_at=timezone.now() + timedelta(seconds=delay))
+        return given_up
+
+
 class Property(models.Model):
+    objects = PropertyManager()
+
     coordinates = models.PointField(geography=True)
     user = models.ForeignKey(User, models.CASCADE, related_name="properties")
     name = models.CharField(max_length=100)
@@ -122,6 +254,15 @@ class Property(models.Model):
     lifestyle_types = models.ManyToManyField("graphql_api.LifestyleType", through="LifestyleTypeProperty",
                                              related_name="properties")
     city = models.ForeignKey(City, models.SET_NULL, blank=True, null=True, related_name="properties")
+    # the city is yet to be resolved by the geocoding worker
+    geocoding_pending = models.BooleanField(default=False)
+    # failed geocoding attempts and when the worker may try again, see `record_geocoding_failures`
+    geocoding_attempts = models.IntegerField(default=0)
+    geocoding_next_attempt_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["id"], condition=models.Q(geocoding_pending=True),
+                                name="property_geocoding_pending_idx")]
 
 
 class FacilityTypeProperty(models.Model):
@@ -140,29 +281,108 @@ class LifestyleTypeProperty(models.Model):
     property = models.ForeignKey(Property, models.SET_NULL, blank=True, null=True)
 
 
+# key of the advisory lock serializing `RecommendationManager.reconcile`
+RECONCILE_LOCK_ID = 4242001
+
+
+def cycle_fingerprint(application_ids: List[Union[str, int]]) -> str:
+    """Identifies a cycle of applications regardless of the application it starts with"""
+    return ",".join(map(str, canonical_cycle([int(application_id) for application_id in application_ids])))
+
+
 class RecommendationManager(models.Manager):
-    @transaction.atomic
     def create_recommendation(self, application_ids: List[Union[str, int]]):
-        if len(application_ids) < 2:
+        return self.create_recommendations([application_ids])[0]
+
+    @transaction.atomic
+    def create_recommendations(self, cycles: Iterable[List[Union[str, int]]], batch_size: int = 1000):
+        """
+        Creates a recommendation for each cycle of application ids in a few statements per batch. Ids of the
+        recommendation applications are allocated upfront, so that the `recommended` links are inserted together
+        with the rows (foreign keys are checked at commit).
+        """
+        cycles = [list(application_ids) for application_ids in cycles]
+        if any(len(application_ids) < 2 for application_ids in cycles):
             raise Exception("At least 2 application ids needed for a recommendation.")
-        recommendation = self.create()
-        recommendation_applications = [
-            RecommendationApplication.objects.create(application_id=application_id, recommendation=recommendation)
-            for application_id in application_ids
-        ]
-        for recommendation_application, next_recommendation_application in pairwise(recommendation_applications):
-            recommendation_application.recommended = next_recommendation_application
-            recommendation_application.save()
-        recommendation_applications[-1].recommended = recommendation_applications[0]
-        recommendation_applications[-1].save()
+        recommendations = self.bulk_create([Recommendation(fingerprint=cycle_fingerprint(application_ids),
+                                                           total_count=len(application_ids))
+                                            for application_ids in cycles], batch_size=batch_size)
+
+        ids = iter(allocate_ids(RecommendationApplication, sum(map(len, cycles))))
+        recommendation_applications = []
+        for recommendation, application_ids in zip(recommendations, cycles):
+            members = [RecommendationApplication(id=next(ids), recommendation=recommendation,
+                                                 application_id=application_id)
+                       for application_id in application_ids]
+            for member, next_member in pairwise(members + members[:1]):
+                member.recommended_id = next_member.id
+            recommendation_applications += members
+        RecommendationApplication.objects.bulk_create(recommendation_applications, batch_size=batch_size)
+
+        return recommendations
 
-        return recommendation
+    @transaction.atomic
+    def reconcile(self, cycles: Iterable[List[Union[str, int]]], stale: Optional[models.QuerySet] = None,
+                  batch_size: int = 1000,
+                  are_broken: Callable[[List[List[int]]], List[bool]] = None) -> Tuple[int, int]:
+        """
+        Stores recommendations of `cycles` which aren't stored yet and deletes unaccepted recommendations of `stale`
+        whose cycle is not among `cycles` anymore, recommendations of the other cycles are kept as they are
+        (including partial acceptances). Partially accepted recommendations missing from `cycles` (e.g. because of
+        the limit of cycles per application) are deleted only when `are_broken` tells their cycle can't be completed
+        anymore, it's called with batches of cycles. Returns numbers of created and deleted recommendations.
+
+        Concurrent reconciliations are serialized by an advisory lock held until the end of the transaction, so
+        that they don't store the same cycle twice.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", [RECONCILE_LOCK_ID])
+        wanted = {}
+        for application_ids in cycles:
+            wanted.setdefault(cycle_fingerprint(application_ids), application_ids)
+
+        deleted = 0
+        if stale is not None:
+            stale_ids = []
+            partially_accepted = []
+            for recommendation_id, fingerprint, accepted_count in stale.filter(accepted=False) \
+                    .values_list("id", "fingerprint", "accepted_count").distinct():
+                if fingerprint in wanted:
+                    continue
+                if accepted_count:
+                    partially_accepted.append((recommendation_id, [
+                        int(application_id) for application_id in (fingerprint or "").split(",") if application_id]))
+                else:
+                    stale_ids.append(recommendation_id)
+            if are_broken is not None:
+                for batch in chunked(partially_accepted, batch_size):
+                    stale_ids += [recommendation_id for (recommendation_id, _), broken
+                                  in zip(batch, are_broken([application_ids for _, application_ids in batch]))
+                                  if broken]
+            for batch in chunked(stale_ids, batch_size):
+                deleted += self.filter(id__in=batch).delete()[1].get(self.model._meta.label, 0)
+
+        stored = set()
+        for batch in chunked(wanted, batch_size):
+            stored.update(self.filter(fingerprint__in=batch).values_list("fingerprint", flat=True))
+        created = self.create_recommendations([application_ids for fingerprint, application_ids in wanted.items()
+                                               if fingerprint not in stored], batch_size=batch_size)
+        return len(created), deleted
+
+    def delete_invalidated(self):
+        """Deletes unaccepted recommendations containing an application that has already been matched elsewhere"""
+        return self.filter(accepted=False, recommendation_applications__application__accepted=True).delete()
 
 
 class Recommendation(models.Model):
     objects = RecommendationManager()
 
     accepted = models.BooleanField(default=False)
+    # `cycle_fingerprint` of the application ids
+    fingerprint = models.TextField(blank=True, null=True, db_index=True)
+    # numbers of accepted and all recommendation applications, kept by `create_recommendations` and `accept`
+    accepted_count = models.IntegerField(default=0)
+    total_count = models.IntegerField(default=0)
 
 
 class RecommendationApplication(models.Model):
@@ -173,21 +393,129 @@ class RecommendationApplication(models.Model):
 
     @transaction.atomic
     def accept(self):
+        """
+        Accepts the recommendation for the application, once all of its applications accepted, the recommendation is
+        accepted and all other recommendations of its applications are deleted.
+
+        Applications of the recommendation are locked (in the order of their ids), so acceptances of recommendations
+        sharing an application are serialized and the last one accepting sees all the others.
+        """
+        application_ids = list(Application.objects.select_for_update(of=("self",))
+                               .filter(recommendation_applications__recommendation_id=self.recommendation_id)
+                               .order_by("id").values_list("id", flat=True))
+        if not Recommendation.objects.select_for_update().filter(id=self.recommendation_id).exists():
+            raise Exception("The recommendation is no longer available.")
+
+        if RecommendationApplication.objects.filter(id=self.id, accepted=False).update(accepted=True):
+            Recommendation.objects.filter(id=self.recommendation_id) \
+                .update(accepted_count=models.F("accepted_count") + 1)
         self.accepted = True
-        self.save()
-        if self.recommendation.recommendation_applications.filter(accepted=False).exists():
+        # accepted only if none of its applications is left, which can be true for one of the acceptances only
+        completed = Recommendation.objects \
+            .filter(id=self.recommendation_id, accepted=False, accepted_count__gte=models.F("total_count")) \
+            .update(accepted=True)
+        if self._meta.get_field("recommendation").is_cached(self):
+            self.recommendation.refresh_from_db(fields=["accepted", "accepted_count"])
+        if not completed:
             return
-        self.recommendation.accepted = True
-        self.recommendation.save()
 
-        applications_of_recommendation = \
-            Application.objects.filter(recommendation_applications__recommendation=self.recommendation)
-        applications_of_recommendation.update(accepted=True)
-
-        Recommendation.objects.exclude(id=self.recommendation.id) \
-            .filter(recommendation_applications__application_id__in=applications_of_recommendation.values_list("id", flat=True)) \
-            .delete()
+        Application.objects.filter(id__in=application_ids).update(accepted=True)
+        self.delete_conflicting_recommendations()
+
+    def delete_conflicting_recommendations(self):
+        """Deletes other recommendations of the applications of this recommendation in a single statement"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH conflicting AS (
+                    SELECT DISTINCT other.recommendation_id
+                    FROM {RecommendationApplication._meta.db_table} other
+                    JOIN {RecommendationApplication._meta.db_table} own ON own.application_id = other.application_id
+                    WHERE own.recommendation_id = %(id)s AND other.recommendation_id <> %(id)s
+                ), deleted_applications AS (
+                    DELETE FROM {RecommendationApplication._meta.db_table}
+                    WHERE recommendation_id IN (SELECT recommendation_id FROM conflicting)
+                )
+                DELETE FROM {Recommendation._meta.db_table} WHERE id IN (SELECT recommendation_id FROM conflicting)
+            """, {"id": self.recommendation_id})
 
     class Meta:
         unique_together = ("recommendation", "application")
 
+
+class MatchingJobStatus(models.TextChoices):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class MatchingJobManager(models.Manager):
+    def enqueue(self, application: Application = None):
+        """Enqueues matching of `application` or of all applications when `None`"""
+        return self.create(application=application)
+
+    def enqueue_for_properties(self, property_ids: List[int]):
+        """
+        Enqueues matching of the applications of the properties, or of all applications if not incremental. Nothing
+        is enqueued for applications which already have a pending job or when matching of all applications is
+        pending, as those jobs haven't read the applications yet.
+        """
+        pending = self.filter(status=MatchingJobStatus.PENDING)
+        if pending.filter(application=None).exists():
+            return []
+        if not settings.MATCHING_INCREMENTAL:
+            return [self.enqueue()]
+        return self.bulk_create(
+            MatchingJob(application_id=application_id)
+            for application_id in Application.objects.filter(property_id__in=property_ids)
+            .exclude(id__in=pending.exclude(application=None).values("application_id")).values_list("id", flat=True)
+        )
+
+    def waiting(self):
+        """
+        Pending jobs and running jobs whose worker is presumed dead, as they have been running for longer than
+        `MATCHING_JOB_TIMEOUT` seconds
+        """
+        return self.filter(models.Q(status=MatchingJobStatus.PENDING)
+                           | models.Q(status=MatchingJobStatus.RUNNING,
+                                      started_at__lt=timezone.now() - timedelta(seconds=settings.MATCHING_JOB_TIMEOUT)))
+
+    @transaction.atomic
+    def claim_next(self):
+        """Marks the oldest waiting job as running and returns it, jobs claimed by other workers are skipped"""
+        job = self.select_for_update(skip_locked=True).filter(id__in=self.waiting().values("id")) \
+            .order_by("created_at", "id").first()
+        if job is None:
+            return None
+        job.status = MatchingJobStatus.RUNNING
+        job.started_at = timezone.now()
+        job.save(update_fields=["status", "started_at"])
+        return job
+
+    def lag(self):
+        """Time for which the oldest waiting job has been waiting"""
+        oldest = self.waiting().order_by("created_at").first()
+        return timezone.now() - oldest.created_at if oldest is not None else None
+
+
+class MatchingJob(models.Model):
+    objects = MatchingJobManager()
+
+    application = models.ForeignKey(Application, models.CASCADE, blank=True, null=True,
+                                    related_name="matching_jobs")
+    status = models.TextField(choices=MatchingJobStatus.choices, default=MatchingJobStatus.PENDING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+
+    def finish(self, error: str = None) -> bool:
+        """Marks the job as finished, returns False when it has been deleted meanwhile (with its application)"""
+        self.status = MatchingJobStatus.DONE if error is None else MatchingJobStatus.FAILED
+        self.error = error
+        self.finished_at = timezone.now()
+        return MatchingJob.objects.filter(id=self.id) \
+            .update(status=self.status, error=self.error, finished_at=self.finished_at) > 0
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"], name="matching_job_status_idx")]
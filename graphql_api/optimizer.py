@@ -0,0 +1,128 @@
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Iterator, List, Set, Tuple
+
+from django.db import models
+from django.db.models import Prefetch
+from graphene.utils.str_converters import to_snake_case
+from graphql import FieldNode, FragmentSpreadNode, GraphQLObjectType, InlineFragmentNode, SelectionSetNode, \
+    get_named_type
+
+"""
+Applies `select_related`, `prefetch_related` and `only` to querysets of root resolvers according to the fields
+selected by the query, so that related objects are fetched in a fixed number of queries and unused columns are not
+loaded.
+
+Fields are mapped to model fields by name. Fields with a custom resolver which don't map to a model field declare
+the model fields they need in `field_dependencies` of their type, e.g. `{"progress": ("accepted_count",)}`. When a
+selected field can't be mapped, all columns of its model are loaded.
+"""
+
+
+@dataclass
+class QueryPlan:
+    only: Set[str] = field(default_factory=set)
+    select_related: Set[str] = field(default_factory=set)
+    prefetch_related: List[Prefetch] = field(default_factory=list)
+
+
+def optimize(queryset: models.QuerySet, info) -> models.QuerySet:
+    """Optimizes `queryset` returned by the resolver of `info` for the selected fields"""
+    return _optimize(queryset, info.field_nodes[0].selection_set, get_named_type(info.return_type), info)
+
+
+def optimize_connection(queryset: models.QuerySet, info, required: Tuple[str, ...] = ()) -> models.QuerySet:
+    """
+    Optimizes `queryset` of the resolver of a connection field for the fields selected on `edges { node }`,
+    `required` fields are loaded in any case
+    """
+    connection_type = get_named_type(info.return_type)
+    node_type = get_named_type(get_named_type(connection_type.fields["edges"].type).fields["node"].type)
+    selections = [
+        selection
+        for name, edges in _selected_fields(info.field_nodes[0].selection_set, info) if name == "edges"
+        for name, node in _selected_fields(edges.selection_set, info) if name == "node"
+        for selection in node.selection_set.selections
+    ]
+    if not selections:
+        return queryset
+    return _optimize(queryset, SelectionSetNode(selections=selections), node_type, info, required)
+
+
+@lru_cache(maxsize=None)
+def _model_fields(model) -> Dict[str, models.Field]:
+    """Fields of `model` by the name of their attribute (accessor name for reverse relations)"""
+    return {
+        model_field.get_accessor_name() if model_field.auto_created and not model_field.concrete else model_field.name:
+            model_field
+        for model_field in model._meta.get_fields()
+    }
+
+
+def _selected_fields(selection_set: SelectionSetNode, info) -> Iterator[Tuple[str, FieldNode]]:
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            if not selection.name.value.startswith("__"):
+                yield selection.name.value, selection
+        elif isinstance(selection, FragmentSpreadNode):
+            yield from _selected_fields(info.fragments[selection.name.value].selection_set, info)
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _selected_fields(selection.selection_set, info)
+
+
+def _merged_fields(selection_set: SelectionSetNode, info) -> Iterator[Tuple[str, FieldNode]]:
+    """
+    Selected fields with the selections of fields selected more than once (under aliases or by fragments) merged, as
+    a relation can be prefetched only once
+    """
+    nodes: Dict[str, List[FieldNode]] = {}
+    for name, node in _selected_fields(selection_set, info):
+        nodes.setdefault(name, []).append(node)
+    for name, same_nodes in nodes.items():
+        selections = tuple(selection for node in same_nodes if node.selection_set is not None
+                           for selection in node.selection_set.selections)
+        yield name, FieldNode(name=same_nodes[0].name,
+                              selection_set=SelectionSetNode(selections=selections) if selections else None)
+
+
+def _optimize(queryset: models.QuerySet, selection_set: SelectionSetNode, graphql_type: GraphQLObjectType, info,
+              required: Tuple[str, ...] = ()) -> models.QuerySet:
+    if selection_set is None:
+        return queryset
+    plan = QueryPlan(only=set(required))
+    _plan(plan, queryset.model, selection_set, graphql_type, info, "")
+    if plan.select_related:
+        queryset = queryset.select_related(*plan.select_related)
+    if plan.prefetch_related:
+        queryset = queryset.prefetch_related(*plan.prefetch_related)
+    return queryset.only(*plan.only)
+
+
+def _plan(plan: QueryPlan, model, selection_set: SelectionSetNode, graphql_type: GraphQLObjectType, info,
+          prefix: str):
+    """Adds what `selection_set` needs from `model`, reached through the `prefix` lookup, to `plan`"""
+    dependencies = getattr(getattr(graphql_type, "graphene_type", None), "field_dependencies", {})
+    model_fields = _model_fields(model)
+    for graphql_name, node in _merged_fields(selection_set, info):
+        name = to_snake_case(graphql_name)
+        model_field = model_fields.get(name)
+        if name in dependencies:
+            plan.only.update(prefix + dependency for dependency in dependencies[name])
+        elif model_field is None:
+            # unknown field, the resolver may use anything
+            plan.only.update(prefix + f.name for f in model._meta.concrete_fields)
+        elif not model_field.is_relation:
+            plan.only.add(prefix + name)
+        elif model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+            plan.only.add(prefix + name)
+            if node.selection_set is not None:
+                plan.select_related.add(prefix + name)
+                _plan(plan, model_field.related_model, node.selection_set,
+                      get_named_type(graphql_type.fields[graphql_name].type), info, f"{prefix}{name}__")
+        else:
+            # reverse relations and many-to-many, the related objects need the foreign key to be matched to their
+            # parents
+            required = (model_field.field.name,) if model_field.one_to_many or model_field.one_to_one else ()
+            related_queryset = _optimize(model_field.related_model._default_manager.all(), node.selection_set,
+                                         get_named_type(graphql_type.fields[graphql_name].type), info, required)
+            plan.prefetch_related.append(Prefetch(prefix + name, queryset=related_queryset))
@@ -0,0 +1,92 @@
+from collections import defaultdict
+from typing import Dict, FrozenSet, Hashable, List, Sequence
+
+"""
+Selection of vertex-disjoint cycles covering as many applications as possible, so that every application ends up
+in at most one recommendation. The problem is NP-hard, components of mutually overlapping cycles are therefore
+solved exactly only up to `EXACT_PACKING_LIMIT` cycles and greedily above it.
+"""
+
+EXACT_PACKING_LIMIT = 25
+
+
+def pack_disjoint_cycles(cycles: Sequence[List[Hashable]],
+                         exact_limit: int = EXACT_PACKING_LIMIT) -> List[List[Hashable]]:
+    """Returns vertex-disjoint cycles of `cycles` covering as many nodes as possible, in their original order"""
+    selected = []
+    for component in _overlapping_components(cycles):
+        if len(component) <= exact_limit:
+            selected += _pack_exact(cycles, component)
+        else:
+            selected += _pack_greedy(cycles, component)
+    return [cycles[index] for index in sorted(selected)]
+
+
+def _overlapping_components(cycles: Sequence[List[Hashable]]) -> List[List[int]]:
+    """Groups indices of cycles connected by sharing a node (union-find over the nodes)"""
+    parent: Dict[Hashable, Hashable] = {}
+
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for cycle in cycles:
+        root = find(cycle[0])
+        for node in cycle[1:]:
+            parent[find(node)] = root
+
+    components = defaultdict(list)
+    for index, cycle in enumerate(cycles):
+        components[find(cycle[0])].append(index)
+    return list(components.values())
+
+
+def _pack_greedy(cycles: Sequence[List[Hashable]], component: List[int]) -> List[int]:
+    # longer cycles first, among equally long ones those blocking the fewest other cycles
+    cycles_per_node = defaultdict(int)
+    for index in component:
+        for node in cycles[index]:
+            cycles_per_node[node] += 1
+    ordered = sorted(component, key=lambda i: (-len(cycles[i]), sum(cycles_per_node[n] for n in cycles[i]), i))
+
+    covered = set()
+    selected = []
+    for index in ordered:
+        if covered.isdisjoint(cycles[index]):
+            covered.update(cycles[index])
+            selected.append(index)
+    return selected
+
+
+def _pack_exact(cycles: Sequence[List[Hashable]], component: List[int]) -> List[int]:
+    node_sets: Dict[int, FrozenSet[Hashable]] = {index: frozenset(cycles[index]) for index in component}
+    best_selected = _pack_greedy(cycles, component)
+    best_covered = sum(len(node_sets[index]) for index in best_selected)
+
+    def search(candidates: List[int], selected: List[int], covered: int):
+        nonlocal best_selected, best_covered
+        if not candidates:
+            if covered > best_covered:
+                best_selected, best_covered = list(selected), covered
+            return
+        candidates_per_node = defaultdict(list)
+        for index in candidates:
+            for node in node_sets[index]:
+                candidates_per_node[node].append(index)
+        # bound: every node still coverable gets covered
+        if covered + len(candidates_per_node) <= best_covered:
+            return
+        # branch on the node with the fewest candidate cycles: covered by one of them or left uncovered
+        node = min(candidates_per_node, key=lambda n: (len(candidates_per_node[n]), str(n)))
+        for index in candidates_per_node[node]:
+            selected.append(index)
+            search([i for i in candidates if node_sets[i].isdisjoint(node_sets[index])], selected,
+                   covered + len(node_sets[index]))
+            selected.pop()
+        search([i for i in candidates if node not in node_sets[i]], selected, covered)
+
+    search(list(component), [], 0)
+    return best_selected
@@ -0,0 +1,104 @@
+import base64
+import binascii
+import json
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence
+
+from django.db import models
+from django.db.models import Q
+from graphene.relay import PageInfo
+
+from graphql_api.loaders import get_loader
+from graphql_api.optimizer import optimize_connection
+from work_around import settings
+
+"""
+Relay connections with keyset pagination.
+
+A page is selected by a condition on the ordering keys of the last seen row (e.g. `id > 42`) instead of an offset,
+so the database seeks to the page through an index and pages deep into the results are as cheap as the first one.
+Cursors are the encoded key values of a row, the last key has to be unique (`id`).
+"""
+
+
+@dataclass
+class Page:
+    items: List[models.Model]
+    has_previous_page: bool
+    has_next_page: bool
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+def decode_cursor(cursor: str, keys: Sequence[str]) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise Exception("Invalid cursor.")
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise Exception("Invalid cursor.")
+    return values
+
+
+def key_values(instance: models.Model, keys: Sequence[str]) -> List[Any]:
+    # distances are compared in meters
+    return [getattr(value, "m", value) for value in (getattr(instance, key) for key in keys)]
+
+
+def beyond(keys: Sequence[str], values: Sequence[Any], descending: bool = False) -> Q:
+    """Rows following `values` in the lexicographic order of `keys` (preceding them when `descending`)"""
+    lookup = "lt" if descending else "gt"
+    condition = Q()
+    for i, key in enumerate(keys):
+        condition |= Q(**dict(zip(keys[:i], values[:i])), **{f"{key}__{lookup}": values[i]})
+    return condition
+
+
+def get_page_size(size: Optional[int]) -> int:
+    if size is None:
+        return settings.PAGINATION_DEFAULT_PAGE_SIZE
+    if size < 0:
+        raise Exception("Page size can't be negative.")
+    return min(size, settings.PAGINATION_MAX_PAGE_SIZE)
+
+
+def paginate(queryset: models.QuerySet, keys: Sequence[str], first: int = None, after: str = None, last: int = None,
+             before: str = None) -> Page:
+    """Page of `queryset` ordered by `keys`, with the semantics of the Relay connection arguments"""
+    if first is not None and last is not None:
+        raise Exception("Only one of `first` and `last` can be given.")
+    backward = last is not None or (before is not None and first is None)
+    size = get_page_size(last if backward else first)
+
+    if after is not None:
+        queryset = queryset.filter(beyond(keys, decode_cursor(after, keys)))
+    if before is not None:
+        queryset = queryset.filter(beyond(keys, decode_cursor(before, keys), descending=True))
+    queryset = queryset.order_by(*(f"-{key}" if backward else key for key in keys))
+
+    # one more row tells whether there is another page
+    items = list(queryset[:size + 1])
+    has_more = len(items) > size
+    items = items[:size]
+    if backward:
+        return Page(items[::-1], has_previous_page=has_more, has_next_page=before is not None)
+    return Page(items, has_previous_page=after is not None, has_next_page=has_more)
+
+
+def resolve_connection(connection_type, queryset: models.QuerySet, info, keys: Sequence[str] = ("id",), **args):
+    """Connection of `connection_type` with a page of `queryset`, `args` are the Relay connection arguments"""
+    columns = {model_field.attname: model_field.name for model_field in queryset.model._meta.concrete_fields}
+    queryset = optimize_connection(queryset, info, tuple(columns[key] for key in keys if key in columns))
+    page = paginate(queryset, keys, **args)
+    # nodes of the page are siblings for the relation loader
+    get_loader(info).register(page.items)
+
+    edges = [connection_type.Edge(node=item, cursor=encode_cursor(key_values(item, keys))) for item in page.items]
+    return connection_type(edges=edges, page_info=PageInfo(
+        start_cursor=edges[0].cursor if edges else None,
+        end_cursor=edges[-1].cursor if edges else None,
+        has_previous_page=page.has_previous_page,
+        has_next_page=page.has_next_page,
+    ))
@@ -3,17 +3,23 @@ import typing
 import graphene
 from dateutil.parser import isoparse
 from django.contrib.gis.db import models
-from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.db.models.functions import GeometryDistance
+from django.contrib.gis.measure import D
 from django.db import transaction
+from django.utils import timezone
 from graphene import Field, Mutation, Boolean, String, Int, Float, ID, List
 from graphene_django import DjangoObjectType
 from graphene_django.converter import convert_django_field
 from graphene_django.debug import DjangoDebug
 
-from graphql_api.matching import MatchingAlgorithm
+from graphql_api.loaders import get_loader
+from graphql_api.optimizer import optimize
+from graphql_api.pagination import resolve_connection
+from graphql_api.spatial_cache import property_cache, property_saved
 from graphql_api.models import User, Property, LifestyleType, FacilityType, LengthOfStay, RoomType, City, PropertyType, \
-    Application, CommuteType, ApplicationPreferredCity, RecommendationApplication, Recommendation
-from graphql_api.utils import GeographyPoint, get_city
+    Application, CommuteType, ApplicationPreferredCity, RecommendationApplication, Recommendation, MatchingJob, \
+    MatchingJobStatus, GeocoderStatus
+from graphql_api.utils import GeographyPoint
 from work_around import settings
 
 
@@ -63,13 +69,12 @@ class ProgressType(graphene.ObjectType):
 
 
 class RecommendationType(DjangoObjectType):
+    field_dependencies = {"progress": ("accepted_count", "total_count")}
     progress = graphene.NonNull(ProgressType)
 
     @staticmethod
     def resolve_progress(parent: Recommendation, info):
-        done = parent.recommendation_applications.filter(accepted=True).count()
-        total = parent.recommendation_applications.count()
-        return ProgressType(done=done, total=total)
+        return ProgressType(done=parent.accepted_count, total=parent.total_count)
 
     class Meta:
         model = Recommendation
@@ -81,11 +86,13 @@ class RecommendationApplicationType(DjangoObjectType):
 
 
 class UserType(DjangoObjectType):
+    # loaded by the relation loader
+    field_dependencies = {"applications": ()}
     applications = graphene.List(graphene.NonNull(lambda: ApplicationType))
 
     @staticmethod
     def resolve_applications(parent: User, info):
-        return Application.objects.filter(property__user=parent)
+        return get_loader(info).load_path(parent, "properties__applications")
 
     class Meta:
         model = User
@@ -113,6 +120,7 @@ class CommuteTypeType(DjangoObjectType):
 
 
 class PropertyObjectType(DjangoObjectType):
+    field_dependencies = {"distance": ()}
     room_type = graphene.String()
     distance = graphene.Float(required=False, description="Distance from queried value (if queried) in kilometers.")
 
@@ -124,7 +132,8 @@ class PropertyObjectType(DjangoObjectType):
     def resolve_distance(parent, info):
         if not hasattr(parent, "distance"):
             return None
-        return parent.distance.m / 1000
+        # meters, either a float of the KNN distance or a `Distance` measure
+        return getattr(parent.distance, "m", parent.distance) / 1000
 
     class Meta:
         model = Property
@@ -135,6 +144,115 @@ class CityType(DjangoObjectType):
         model = City
 
 
+class MatchingJobType(DjangoObjectType):
+    field_dependencies = {"lag": ("created_at", "started_at")}
+    status = graphene.String(required=True)
+    lag = graphene.Float(description="Seconds the job waited in the queue (so far if not started yet).")
+
+    @staticmethod
+    def resolve_status(parent: MatchingJob, info):
+        return parent.status
+
+    @staticmethod
+    def resolve_lag(parent: MatchingJob, info):
+        return ((parent.started_at or timezone.now()) - parent.created_at).total_seconds()
+
+    class Meta:
+        model = MatchingJob
+
+
+class UserConnection(graphene.relay.Connection):
+    class Meta:
+        node = UserType
+
+
+class ApplicationConnection(graphene.relay.Connection):
+    class Meta:
+        node = ApplicationType
+
+
+class PropertyConnection(graphene.relay.Connection):
+    class Meta:
+        node = PropertyObjectType
+
+
+class CityConnection(graphene.relay.Connection):
+    class Meta:
+        node = CityType
+
+
+class RecommendationApplicationConnection(graphene.relay.Connection):
+    class Meta:
+        node = RecommendationApplicationType
+
+
+def get_point(coordinates: PointInputType = None):
+    return GeographyPoint(x=50.083076, y=14.420020) if coordinates is None else coordinates.get_point()
+
+
+def get_cached_closest_properties(info, coordinates: PointInputType = None, max_distance: float = None,
+                                  is_available: bool = None, limit: int = None):
+    """Closest properties answered by the spatial cache, None if it can't answer them"""
+    point = get_point(coordinates)
+    closest = property_cache.closest(point.x, point.y, limit, max_distance * 1000 if max_distance is not None else None,
+                                     is_available)
+    if closest is None:
+        return None
+    properties = optimize(Property.objects.filter(id__in=[property_id for _, property_id in closest]), info) \
+        .in_bulk()
+    for distance, property_id in closest:
+        if property_id in properties:
+            properties[property_id].distance = distance
+    return [properties[property_id] for _, property_id in closest if property_id in properties]
+
+
+def get_closest_properties(coordinates: PointInputType = None, max_distance: float = None, is_available: bool = None):
+    """
+    Properties ordered by the distance from `coordinates`. The KNN distance operator (`<->`) and `ST_DWithin` are
+    answered by the spatial index of `coordinates`, so the distance isn't computed for the whole table.
+    """
+    coordinates = get_point(coordinates)
+    # geography value, so that the operator of the geography index is used
+    point = models.Value(coordinates, output_field=models.PointField(geography=True))
+    properties = Property.objects.annotate(distance=GeometryDistance('coordinates', point)) \
+        .order_by('distance')
+    if max_distance is not None:
+        properties = properties.filter(coordinates__dwithin=(coordinates, D(km=max_distance)))
+    if is_available is not None:
+        properties = properties.filter(is_available=is_available)
+    return properties
+
+
+def get_recommended_applications(user_id: str):
+    """Recommendation applications recommended to applications of the user, one per recommended application"""
+    return RecommendationApplication.objects \
+        .filter(recommendationapplication__application__property__user_id=user_id) \
+        .order_by("application_id").distinct("application_id")
+
+
+class MatchingQueueType(graphene.ObjectType):
+    pending = graphene.Int(required=True)
+    running = graphene.Int(required=True)
+    failed = graphene.Int(required=True)
+    lag = graphene.Float(description="Seconds the oldest pending job has been waiting.")
+
+
+class GeocoderType(graphene.ObjectType):
+    breaker_state = graphene.String(required=True, description="closed, open or half_open")
+    consecutive_failures = graphene.Int(required=True)
+    calls = graphene.Int(required=True)
+    failures = graphene.Int(required=True)
+    retries = graphene.Int(required=True)
+    rejected = graphene.Int(required=True, description="Calls failed fast by the open breaker.")
+    opened = graphene.Int(required=True, description="Number of times the breaker opened.")
+    retry_in = graphene.Float(description="Seconds until the open breaker lets a trial request through.")
+    cache_memory_hits = graphene.Int(required=True)
+    cache_database_hits = graphene.Int(required=True)
+    cache_misses = graphene.Int(required=True)
+    pending_properties = graphene.Int(required=True, description="Properties waiting for their city.")
+    reported_at = graphene.DateTime(description="When the geocoding worker reported the figures, null if never.")
+
+
 class Query(graphene.ObjectType):
     debug = graphene.Field(DjangoDebug, name='_debug') if settings.DEBUG else None
     health = graphene.Field(HealthType, required=True)
@@ -143,7 +261,9 @@ class Query(graphene.ObjectType):
     closest_properties = graphene.List(graphene.NonNull(PropertyObjectType), required=True,
                                        coordinates=PointInputType(),
                                        max_distance=graphene.Float(description="Maximal distance in kilometers"),
-                                       is_available=graphene.Boolean())
+                                       is_available=graphene.Boolean(),
+                                       limit=Int(description="Maximal number of properties, "
+                                                             "CLOSEST_PROPERTIES_LIMIT by default."))
     lifestyle_types = graphene.List(graphene.NonNull(LifestyleTypeType), required=True)
     facility_types = graphene.List(graphene.NonNull(FacilityTypeType), required=True)
     property_types = graphene.List(graphene.NonNull(PropertyTypeType), required=True)
@@ -153,6 +273,19 @@ class Query(graphene.ObjectType):
     available_cities = graphene.List(graphene.NonNull(CityType))
     recommended_applications = graphene.List(graphene.NonNull(RecommendationApplicationType), required=True,
                                              user_id=ID(required=True))
+    # paginated variants of the lists above
+    users_connection = graphene.relay.ConnectionField(UserConnection, required=True)
+    applications_connection = graphene.relay.ConnectionField(ApplicationConnection, required=True, user_id=Int())
+    closest_properties_connection = graphene.relay.ConnectionField(
+        PropertyConnection, required=True, coordinates=PointInputType(),
+        max_distance=graphene.Float(description="Maximal distance in kilometers"), is_available=graphene.Boolean())
+    available_cities_connection = graphene.relay.ConnectionField(CityConnection, required=True)
+    recommended_applications_connection = graphene.relay.ConnectionField(RecommendationApplicationConnection,
+                                                                         required=True, user_id=ID(required=True))
+    matching_job = graphene.Field(MatchingJobType, job_id=ID(required=True))
+    matching_queue = graphene.Field(MatchingQueueType, required=True)
+    geocoder = graphene.Field(GeocoderType, required=True,
+                              description="Geocoder health as last reported by the geocoding worker.")
 
     @staticmethod
     def resolve_health(root, info):
@@ -160,24 +293,22 @@ class Query(graphene.ObjectType):
 
     @staticmethod
     def resolve_users(root, info):
-        return User.objects.all()
+        return optimize(User.objects.all(), info)
 
     @staticmethod
     def resolve_applications(root, info, user_id: Int):
-        return Application.objects.filter(property__user_id=user_id).all()
+        return optimize(Application.objects.filter(property__user_id=user_id), info)
 
     @staticmethod
     def resolve_closest_properties(root, info, coordinates: PointInputType = None, max_distance: float = None,
-                                   is_available: bool = None):
-
-        coordinates = GeographyPoint(x=50.083076, y=14.420020) if coordinates is None else coordinates.get_point()
-        properties = Property.objects.annotate(distance=Distance('coordinates', coordinates)) \
-            .order_by('distance')
-        if max_distance is not None:
-            properties = properties.filter(distance__lte=max_distance * 1000)
-        if is_available is not None:
-            properties = properties.filter(is_available=is_available)
-        return properties
+                                   is_available: bool = None, limit: int = None):
+        limit = max(min(settings.CLOSEST_PROPERTIES_LIMIT if limit is None else limit,
+                        settings.PAGINATION_MAX_PAGE_SIZE), 0)
+        if settings.SPATIAL_CACHE_ENABLED:
+            properties = get_cached_closest_properties(info, coordinates, max_distance, is_available, limit)
+            if properties is not None:
+                return properties
+        return optimize(get_closest_properties(coordinates, max_distance, is_available), info)[:limit]
 
     @staticmethod
     def resolve_lifestyle_types(root, info):
@@ -205,7 +336,7 @@ class Query(graphene.ObjectType):
 
     @staticmethod
     def resolve_available_cities(root, info):
-        return City.objects.filter(properties__is_available=True).distinct()
+        return optimize(City.objects.filter(properties__is_available=True).distinct(), info)
 
     @staticmethod
     def resolve_recommended_applications(root, info, user_id: str):
@@ -215,6 +346,60 @@ class Query(graphene.ObjectType):
         return {recommendation_application.recommended.application_id: recommendation_application.recommended
                 for recommendation_application in recommendation_applications}.values()
 
+    @staticmethod
+    def resolve_users_connection(root, info, **kwargs):
+        return resolve_connection(UserConnection, User.objects.all(), info, **kwargs)
+
+    @staticmethod
+    def resolve_applications_connection(root, info, user_id: int = None, **kwargs):
+        applications = Application.objects.all()
+        if user_id is not None:
+            applications = applications.filter(property__user_id=user_id)
+        return resolve_connection(ApplicationConnection, applications, info, **kwargs)
+
+    @staticmethod
+    def resolve_closest_properties_connection(root, info, coordinates: PointInputType = None,
+                                              max_distance: float = None, is_available: bool = None, **kwargs):
+        return resolve_connection(PropertyConnection, get_closest_properties(coordinates, max_distance, is_available),
+                                  info, keys=("distance", "id"), **kwargs)
+
+    @staticmethod
+    def resolve_available_cities_connection(root, info, **kwargs):
+        return resolve_connection(CityConnection, City.objects.filter(properties__is_available=True).distinct(),
+                                  info, **kwargs)
+
+    @staticmethod
+    def resolve_recommended_applications_connection(root, info, user_id: str, **kwargs):
+        return resolve_connection(RecommendationApplicationConnection, get_recommended_applications(user_id), info,
+                                  keys=("application_id",), **kwargs)
+
+    @staticmethod
+    def resolve_matching_job(root, info, job_id: str):
+        return MatchingJob.objects.filter(id=job_id).first()
+
+    @staticmethod
+    def resolve_matching_queue(root, info):
+        counts = dict(MatchingJob.objects.values_list("status").annotate(count=models.Count("id")))
+        lag = MatchingJob.objects.lag()
+        return MatchingQueueType(pending=counts.get(MatchingJobStatus.PENDING, 0),
+                                 running=counts.get(MatchingJobStatus.RUNNING, 0),
+                                 failed=counts.get(MatchingJobStatus.FAILED, 0),
+                                 lag=lag.total_seconds() if lag is not None else None)
+
+    @staticmethod
+    def resolve_geocoder(root, info):
+        # the web process never calls the geocoder, the figures are the ones of the geocoding worker
+        status = GeocoderStatus.objects.filter(id=1).first() or GeocoderStatus()
+        retry_in = max((status.retry_at - timezone.now()).total_seconds(), 0.0) \
+            if status.retry_at is not None and status.breaker_state == "open" else None
+        return GeocoderType(breaker_state=status.breaker_state, consecutive_failures=status.consecutive_failures,
+                            calls=status.calls, failures=status.failures, retries=status.retries,
+                            rejected=status.rejected, opened=status.opened, retry_in=retry_in,
+                            cache_memory_hits=status.cache_memory_hits,
+                            cache_database_hits=status.cache_database_hits, cache_misses=status.cache_misses,
+                            pending_properties=Property.objects.filter(geocoding_pending=True).count(),
+                            reported_at=status.reported_at)
+
 
 class SuccessMixin:
     success = Boolean(required=True)
@@ -261,8 +446,9 @@ class CreateProperty(Mutation, SuccessMixin):
                **kwargs):
         facility_types = FacilityType.objects.filter(id__in=facility_type_ids)
         lifestyle_types = LifestyleType.objects.filter(id__in=lifestyle_type_ids)
+        # the city is resolved by the geocoding worker, see `graphql_api.geocoding`
         created_property = Property.objects.create(**kwargs, coordinates=coordinates.get_point(),
-                                                   city=get_city(coordinates))
+                                                   geocoding_pending=True)
         created_property.facility_types.set(facility_types)
         created_property.lifestyle_types.set(lifestyle_types)
         return CreateProperty(created_property=created_property)
@@ -284,11 +470,17 @@ class UpdateProperty(Mutation, SuccessMixin):
     @transaction.atomic
     def mutate(root, info, property_id, coordinates=None, **kwargs):
         property_queryset = Property.objects.filter(id=property_id)
+        values = {key: value for key, value in kwargs.items() if value is not None}
         if coordinates is not None:
-            kwargs.update(coordinates=coordinates.get_point(), city=get_city(coordinates))
+            # the city is resolved by the geocoding worker, see `graphql_api.geocoding`
+            values.update(coordinates=coordinates.get_point(), city=None, geocoding_pending=True,
+                          geocoding_attempts=0, geocoding_next_attempt_at=None)
 
-        property_queryset.update(**{key: value for key, value in kwargs.values() if value is not None})
-        return UpdateProperty(property=property_queryset.get())
+        property_queryset.update(**values)
+        updated_property = property_queryset.get()
+        # queryset updates don't send `post_save`
+        property_saved(Property, updated_property)
+        return UpdateProperty(property=updated_property)
 
 
 class DeleteProperty(Mutation, SuccessMixin):
@@ -315,6 +507,7 @@ class CreateApplication(Mutation, SuccessMixin):
         facility_types_ids = graphene.List(graphene.NonNull(ID), required=True)
 
     created_application = Field(ApplicationType)
+    matching_job = Field(MatchingJobType)
 
     @staticmethod
     @transaction.atomic
@@ -336,12 +529,9 @@ class CreateApplication(Mutation, SuccessMixin):
         created_application.property_types.set(PropertyType.objects.filter(id__in=property_types_ids))
         created_application.facility_types.set(FacilityType.objects.filter(id__in=facility_types_ids))
 
-        Recommendation.objects.filter(accepted=False).delete()
-
-        for application_ids in MatchingAlgorithm().find_matching_application_sets():
-            Recommendation.objects.create_recommendation(application_ids)
+        matching_job = MatchingJob.objects.enqueue(created_application if settings.MATCHING_INCREMENTAL else None)
 
-        return CreateApplication(created_application=created_application)
+        return CreateApplication(created_application=created_application, matching_job=matching_job)
 
 
 class Login(graphene.Mutation, SuccessMixin):
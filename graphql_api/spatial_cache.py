@@ -0,0 +1,229 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.contrib.gis.measure import D
+from django.db import transaction
+from django.db.models import Q
+
+from graphql_api.utils import GeographyPoint
+from work_around import settings
+
+"""
+In-process grid index of property locations answering `closest_properties` without a spatial query.
+
+Properties are bucketed into square cells of `SPATIAL_CACHE_CELL_SIZE` degrees. Cells are loaded from the database
+on the first lookup touching them (one indexed `ST_DWithin` query per ring of cells), kept fresh by the `Property`
+signals connected in `GraphqlApiConfig.ready`, reloaded after `SPATIAL_CACHE_TTL` seconds (writes of other processes
+and queryset updates don't send signals) and evicted least recently used first once the cache holds more than
+`SPATIAL_CACHE_MAX_PROPERTIES` properties. Writes which don't send signals (bulk imports) bump the
+`SpatialCacheGeneration` counter by `invalidate`, the caches of all processes check it every
+`SPATIAL_CACHE_SYNC_INTERVAL` seconds and are cleared when it has changed.
+
+Coordinates are treated as PostGIS treats a geography point (x is the longitude) and distances are great-circle
+distances on the sphere used by the `<->` operator.
+
+SHELL TESTING:
+from graphql_api.spatial_cache import property_cache
+property_cache.closest(50.083076, 14.420020, limit=10)
+"""
+
+EARTH_RADIUS = 6371008.8
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+Cell = Tuple[int, int]
+# id, x, y, is_available
+CachedProperty = Tuple[int, float, float, bool]
+
+
+def sphere_distance(x1: float, y1: float, x2: float, y2: float) -> float:
+    """Great-circle distance in meters between two points given in degrees"""
+    phi1, phi2 = math.radians(y1), math.radians(y2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(x2 - x1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+@dataclass
+class CachedCell:
+    properties: Dict[int, CachedProperty]
+    loaded_at: float
+
+
+class SpatialCache:
+    def __init__(self, cell_size: float, max_properties: int, ttl: float, max_rings: int,
+                 sync_interval: float = 1.0):
+        self.cell_size = cell_size
+        self.max_properties = max_properties
+        self.ttl = ttl
+        self.max_rings = max_rings
+        self.sync_interval = sync_interval
+        self.generation: Optional[int] = None
+        self.synced_at = -math.inf
+        # least recently used first
+        self.cells: "OrderedDict[Cell, CachedCell]" = OrderedDict()
+        self.cell_of: Dict[int, Cell] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def cell(self, x: float, y: float) -> Cell:
+        return math.floor(x / self.cell_size), math.floor(y / self.cell_size)
+
+    def closest(self, x: float, y: float, limit: int, max_distance: float = None,
+                is_available: bool = None) -> Optional[List[Tuple[float, int]]]:
+        """
+        (distance in meters, id) of up to `limit` properties closest to (x, y) within `max_distance` meters, from the
+        closest one. None when the answer would need more than `max_rings` rings of cells around (x, y).
+        """
+        self._sync()
+        center_x, center_y = self.cell(x, y)
+        candidates = []
+        for ring in range(self.max_rings + 1):
+            for cell_properties in self._get_cells(self._ring(center_x, center_y, ring)):
+                for property_id, property_x, property_y, available in cell_properties:
+                    if is_available is not None and available != is_available:
+                        continue
+                    distance = sphere_distance(x, y, property_x, property_y)
+                    if max_distance is None or distance <= max_distance:
+                        candidates.append((distance, property_id))
+            candidates.sort()
+            # every property closer than `covered` lies in the rings searched so far
+            covered = self._covered_distance(x, y, center_x, center_y, ring)
+            if (max_distance is not None and covered >= max_distance) \
+                    or (len(candidates) >= limit and (limit == 0 or candidates[limit - 1][0] <= covered)):
+                self.hits += 1
+                return candidates[:limit]
+        self.misses += 1
+        return None
+
+    def property_changed(self, property_id: int, x: float, y: float, is_available: bool):
+        with self.lock:
+            self.property_deleted(property_id)
+            cell = self.cell(x, y)
+            if cell in self.cells:
+                self.cells[cell].properties[property_id] = (property_id, x, y, is_available)
+                self.cell_of[property_id] = cell
+                self.size += 1
+
+    def property_deleted(self, property_id: int):
+        with self.lock:
+            cell = self.cell_of.pop(property_id, None)
+            if cell is not None and self.cells[cell].properties.pop(property_id, None) is not None:
+                self.size -= 1
+
+    def clear(self):
+        with self.lock:
+            self.cells.clear()
+            self.cell_of.clear()
+            self.size = 0
+
+    def invalidate(self):
+        """Clears the caches of all processes, after writes which don't send `Property` signals"""
+        from graphql_api.models import SpatialCacheGeneration
+        SpatialCacheGeneration.objects.bump()
+        self.clear()
+
+    def _sync(self):
+        now = time.monotonic()
+        if now - self.synced_at < self.sync_interval:
+            return
+        self.synced_at = now
+        generation = self._load_generation()
+        with self.lock:
+            if generation != self.generation:
+                self.clear()
+                self.generation = generation
+
+    def _load_generation(self) -> int:
+        from graphql_api.models import SpatialCacheGeneration
+        return SpatialCacheGeneration.objects.current()
+
+    def _ring(self, center_x: int, center_y: int, ring: int) -> List[Cell]:
+        if ring == 0:
+            return [(center_x, center_y)]
+        return [(center_x + dx, center_y + dy) for dx in range(-ring, ring + 1) for dy in range(-ring, ring + 1)
+                if max(abs(dx), abs(dy)) == ring]
+
+    def _covered_distance(self, x: float, y: float, center_x: int, center_y: int, ring: int) -> float:
+        """Lower bound of the distance from (x, y) to any point outside of the searched block of cells"""
+        x0, x1 = (center_x - ring) * self.cell_size, (center_x + ring + 1) * self.cell_size
+        y0, y1 = (center_y - ring) * self.cell_size, (center_y + ring + 1) * self.cell_size
+        widest_latitude = min(max(abs(y0), abs(y1)), 90.0)
+        by_latitude = min(y - y0, y1 - y) * METERS_PER_DEGREE
+        by_longitude = min(x - x0, x1 - x) * METERS_PER_DEGREE * math.cos(math.radians(widest_latitude))
+        # margin for the curvature of great circles
+        return 0.99 * min(by_latitude, by_longitude)
+
+    def _get_cells(self, cells: List[Cell]) -> List[List[CachedProperty]]:
+        """
+        Properties of the cells, copied under the lock as the signal handlers of other threads change the cached
+        cells meanwhile
+        """
+        now = time.monotonic()
+        with self.lock:
+            found = {cell: list(self.cells[cell].properties.values()) for cell in cells
+                     if cell in self.cells and now - self.cells[cell].loaded_at <= self.ttl}
+            for cell in found:
+                self.cells.move_to_end(cell)
+        missing = [cell for cell in cells if cell not in found]
+        if missing:
+            loaded = self._load(missing)
+            # copied before the cells are shared with the signal handlers
+            for cell, properties in loaded.items():
+                found[cell] = list(properties.values())
+            self._store(loaded, now)
+        return list(found.values())
+
+    def _load(self, cells: Iterable[Cell]) -> Dict[Cell, Dict[int, CachedProperty]]:
+        from graphql_api.models import Property
+        loaded = {cell: {} for cell in cells}
+        condition = Q()
+        for cell_x, cell_y in loaded:
+            x, y = (cell_x + 0.5) * self.cell_size, (cell_y + 0.5) * self.cell_size
+            # circle around the cell, the properties of the neighbouring cells are filtered out below
+            radius = max(sphere_distance(x, y, x + dx * self.cell_size / 2, y + dy * self.cell_size / 2)
+                         for dx in (-1, 1) for dy in (-1, 1))
+            condition |= Q(coordinates__dwithin=(GeographyPoint(x, y), D(m=radius * 1.01)))
+        for property_id, coordinates, is_available in \
+                Property.objects.filter(condition).values_list("id", "coordinates", "is_available"):
+            cell = self.cell(coordinates.x, coordinates.y)
+            if cell in loaded:
+                loaded[cell][property_id] = (property_id, coordinates.x, coordinates.y, is_available)
+        return loaded
+
+    def _store(self, loaded: Dict[Cell, Dict[int, CachedProperty]], loaded_at: float):
+        with self.lock:
+            for cell, properties in loaded.items():
+                self._evict(cell)
+                self.cells[cell] = CachedCell(properties, loaded_at)
+                self.cell_of.update((property_id, cell) for property_id in properties)
+                self.size += len(properties)
+            while self.size > self.max_properties and self.cells:
+                self._evict(next(iter(self.cells)))
+
+    def _evict(self, cell: Cell):
+        cached_cell = self.cells.pop(cell, None)
+        if cached_cell is not None:
+            for property_id in cached_cell.properties:
+                self.cell_of.pop(property_id, None)
+            self.size -= len(cached_cell.properties)
+
+
+property_cache = SpatialCache(settings.SPATIAL_CACHE_CELL_SIZE, settings.SPATIAL_CACHE_MAX_PROPERTIES,
+                              settings.SPATIAL_CACHE_TTL, settings.SPATIAL_CACHE_MAX_RINGS,
+                              settings.SPATIAL_CACHE_SYNC_INTERVAL)
+
+
+def property_saved(sender, instance, **kwargs):
+    # applied once committed, so that rolled back changes don't get into the cache
+    values = (instance.id, instance.coordinates.x, instance.coordinates.y, instance.is_available)
+    transaction.on_commit(lambda: property_cache.property_changed(*values))
+
+
+def property_deleted(sender, instance, **kwargs):
+    property_id = instance.id
+    transaction.on_commit(lambda: property_cache.property_deleted(property_id))
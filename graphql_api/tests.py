@@ -1,3 +1,1317 @@
-from django.test import TestCase
+import itertools
+import json
+import operator
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import networkx as nx
+import requests
+from django.apps import apps as django_apps
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from graphql_api.constraints import AcceptedPropertyType, SameLengthOfStay
+from graphql_api.cycles import SearchBudget, canonical_cycle, find_top_cycles_through, iter_cycles_through, \
+    iter_simple_cycles, limit_cycles_per_node
+from graphql_api.demand_graph import ApplicationNode, DemandGraph, find_component_cycles, \
+    find_component_top_cycles, iter_component_cycles
+from graphql_api.geocoder import CircuitBreaker, CircuitOpenError, GeocodingClient
+from graphql_api.city_resolver import OfflineCityResolver, city_resolver
+from graphql_api.geocoding import GeocodingCache, geocode_pending_properties, resolve_pending_properties_offline
+from graphql_api.matching import MatchingAlgorithm, update_recommendations
+from graphql_api.models import Application, ApplicationPreferredCity, City, GeocoderStatus, GeocodingCacheEntry, \
+    MatchingJob, MatchingJobStatus, Property, PropertyType, PropertyTypeApplication, Recommendation, \
+    RecommendationApplication, SpatialCacheGeneration, User
+from graphql_api.packing import EXACT_PACKING_LIMIT, pack_disjoint_cycles
+from graphql_api.pagination import beyond, encode_cursor, key_values, paginate
+from graphql_api.spatial_cache import SpatialCache, sphere_distance
+from graphql_api.utils import GeographyPoint
+from work_around import settings
+
+
+def run_concurrently(functions):
+    """Runs `functions` in threads started at the same moment, returns the exceptions they raised"""
+    barrier = threading.Barrier(len(functions))
+    errors = []
+
+    def run(function):
+        try:
+            barrier.wait()
+            function()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(function,)) for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+@skipUnlessDBFeature("has_select_for_update")
+class AcceptRecommendationConcurrencyTest(TransactionTestCase):
+    def setUp(self):
+        user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        self.applications = []
+        for i in range(8):
+            city = City.objects.create(name=f"City {i}")
+            created_property = Property.objects.create(coordinates=GeographyPoint(14.42, 50.08), user=user,
+                                                       name=f"Property {i}", usd_worth=1000, photo_id="photo",
+                                                       meters_squared=50, city=city)
+            self.applications.append(Application.objects.create(property=created_property, length_of_stay=6))
+
+    def create_recommendation(self, applications):
+        return Recommendation.objects.create_recommendation([application.id for application in applications])
+
+    def test_all_members_accepting_at_once(self):
+        for _ in range(5):
+            Application.objects.update(accepted=False)
+            recommendation = self.create_recommendation(self.applications)
+            conflicting = self.create_recommendation(self.applications[:2])
+            members = list(recommendation.recommendation_applications.all())
+
+            errors = run_concurrently([member.accept for member in members])
+
+            self.assertEqual(errors, [])
+            recommendation.refresh_from_db()
+            self.assertTrue(recommendation.accepted)
+            self.assertEqual((recommendation.accepted_count, recommendation.total_count), (8, 8))
+            self.assertFalse(recommendation.recommendation_applications.filter(accepted=False).exists())
+            self.assertFalse(Application.objects.filter(accepted=False).exists())
+            self.assertFalse(Recommendation.objects.filter(id=conflicting.id).exists())
+            recommendation.delete()
+
+    def test_competing_recommendations_completing_at_once(self):
+        for _ in range(5):
+            Application.objects.update(accepted=False)
+            first = self.create_recommendation(self.applications[:4])
+            second = self.create_recommendation(self.applications[3:])
+            members = list(RecommendationApplication.objects.filter(recommendation__in=[first, second]))
+
+            errors = run_concurrently([member.accept for member in members])
+
+            # the one completed first deletes the other, its remaining acceptances fail
+            accepted = list(Recommendation.objects.filter(accepted=True))
+            self.assertEqual(len(accepted), 1)
+            self.assertEqual(Recommendation.objects.filter(id__in=[first.id, second.id]).count(), 1)
+            self.assertEqual(Application.objects.filter(accepted=True).count(),
+                             accepted[0].recommendation_applications.count())
+            self.assertTrue(all("no longer available" in str(error) for error in errors))
+            accepted[0].delete()
+
+
+@skipUnlessDBFeature("has_select_for_update_skip_locked")
+class MatchingJobClaimConcurrencyTest(TransactionTestCase):
+    def test_locked_job_is_skipped(self):
+        jobs = [MatchingJob.objects.enqueue() for _ in range(2)]
+        claimed = {}
+        locked, released = threading.Event(), threading.Event()
+
+        def claim_and_hold():
+            with transaction.atomic():
+                claimed["first"] = MatchingJob.objects.claim_next()
+                locked.set()
+                # the claimed job stays locked (and pending for the others) until the other worker has claimed
+                released.wait(10)
+
+        def claim():
+            locked.wait(10)
+            claimed["second"] = MatchingJob.objects.claim_next()
+            released.set()
+
+        self.assertEqual(run_concurrently([claim_and_hold, claim]), [])
+        self.assertEqual((claimed["first"].id, claimed["second"].id), (jobs[0].id, jobs[1].id))
+
+    def test_each_job_is_claimed_once(self):
+        jobs = [MatchingJob.objects.enqueue() for _ in range(20)]
+        claimed = []
+
+        def work():
+            job = MatchingJob.objects.claim_next()
+            while job is not None:
+                claimed.append(job.id)
+                job = MatchingJob.objects.claim_next()
+
+        self.assertEqual(run_concurrently([work] * 4), [])
+        self.assertEqual(sorted(claimed), [job.id for job in jobs])
+
+
+class RelationLoaderTest(TestCase):
+    QUERY = """
+        query {
+            users {
+                applications {
+                    property { name city { name } }
+                    recommendationApplications { recommendation { progress { done total } } }
+                }
+            }
+        }
+    """
+
+    def create_users(self, count: int):
+        city = City.objects.create(name=f"City {User.objects.count()}")
+        for _ in range(count):
+            i = User.objects.count()
+            user = User.objects.create_user(username=f"user{i}", email=f"user{i}@example.com", password="password")
+            applications = []
+            for j in range(2):
+                created_property = Property.objects.create(coordinates=GeographyPoint(14.42, 50.08), user=user,
+                                                           name=f"Property {i} {j}", usd_worth=1000,
+                                                           photo_id="photo", meters_squared=50, city=city)
+                applications.append(Application.objects.create(property=created_property, length_of_stay=6))
+            Recommendation.objects.create_recommendation([application.id for application in applications])
+
+    def execute(self):
+        response = self.client.post("/graphql/", json.dumps({"query": self.QUERY}), content_type="application/json")
+        self.assertNotIn("errors", response.json())
+        return response.json()["data"]["users"]
+
+    def test_query_count_does_not_depend_on_number_of_users(self):
+        self.create_users(2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.execute()), 2)
+
+        self.create_users(8)
+        with self.assertNumQueries(len(queries)):
+            users = self.execute()
+        self.assertEqual(len(users), 10)
+        self.assertEqual(users[-1]["applications"][0]["recommendationApplications"][0]["recommendation"]["progress"],
+                         {"done": 0, "total": 2})
+
+
+class QueryOptimizerTest(TestCase):
+    def create_users(self, count: int):
+        for _ in range(count):
+            i = User.objects.count()
+            user = User.objects.create_user(username=f"user{i}", email=f"user{i}@example.com", password="password")
+            city = City.objects.create(name=f"City {i}")
+            for j in range(2):
+                created_property = Property.objects.create(coordinates=GeographyPoint(14.42, 50.08), user=user,
+                                                           name=f"Property {i} {j}", description=f"Description {i}",
+                                                           usd_worth=1000, photo_id="photo", meters_squared=50,
+                                                           city=city, is_available=True)
+                application = Application.objects.create(property=created_property, length_of_stay=6)
+                ApplicationPreferredCity.objects.create(application=application, city=city, order=1)
+
+    def execute(self, query: str):
+        response = self.client.post("/graphql/", json.dumps({"query": query}), content_type="application/json")
+        self.assertNotIn("errors", response.json())
+        return response.json()["data"]
+
+    def execute_growing(self, query: str):
+        """Result of `query` for 8 users, checking that it runs as many queries as for 2 users"""
+        self.create_users(2)
+        with CaptureQueriesContext(connection) as queries:
+            self.execute(query)
+        self.create_users(6)
+        # a column deferred by `only` but read by a resolver would be fetched by a query per object
+        with self.assertNumQueries(len(queries)) as queries:
+            data = self.execute(query)
+        return data, [captured["sql"] for captured in queries.captured_queries]
+
+    def test_nested_forward_relations(self):
+        data, queries = self.execute_growing("""
+            query {
+                users {
+                    username
+                    properties {
+                        name
+                        city { name }
+                        applications { lengthOfStay property { description city { name } } }
+                    }
+                }
+            }
+        """)
+
+        self.assertEqual(len(data["users"]), 8)
+        self.assertEqual(data["users"][-1]["properties"][0], {
+            "name": "Property 7 0", "city": {"name": "City 7"},
+            "applications": [{"lengthOfStay": "6 months",
+                              "property": {"description": "Description 7", "city": {"name": "City 7"}}}],
+        })
+        # unselected columns aren't loaded
+        self.assertNotIn('"email"', queries[0])
+
+    def test_many_to_many_relation(self):
+        data, _ = self.execute_growing("query { users { properties { applications { preferredCities { name } } } } }")
+
+        self.assertEqual(data["users"][-1]["properties"][1]["applications"][0]["preferredCities"], [{"name": "City 7"}])
+
+    def test_connection_field(self):
+        data, _ = self.execute_growing("""
+            query {
+                applicationsConnection(first: 50) {
+                    edges {
+                        node { id lengthOfStay property { name description city { name } } preferredCities { name } }
+                    }
+                }
+            }
+        """)
+
+        nodes = [edge["node"] for edge in data["applicationsConnection"]["edges"]]
+        self.assertEqual(len(nodes), 16)
+        self.assertEqual(nodes[-1]["property"], {"name": "Property 7 1", "description": "Description 7",
+                                                 "city": {"name": "City 7"}})
+        self.assertEqual(nodes[-1]["preferredCities"], [{"name": "City 7"}])
+
+    def test_fragments_and_aliases(self):
+        # the same relation selected by a fragment and under an alias is prefetched once with the merged selections
+        data, _ = self.execute_growing("""
+            query {
+                users { ...UserFields located: properties { city { name } } }
+            }
+            fragment UserFields on UserType {
+                username
+                properties { name ... on PropertyObjectType { isAvailable } }
+            }
+        """)
+
+        user = data["users"][-1]
+        self.assertEqual(user["username"], "user7")
+        self.assertEqual(user["properties"], [{"name": "Property 7 0", "isAvailable": True},
+                                              {"name": "Property 7 1", "isAvailable": True}])
+        self.assertEqual(user["located"], [{"city": {"name": "City 7"}}] * 2)
+
+
+class MatchingDataMixin:
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        self.cities = [City.objects.create(name=f"City {i}") for i in range(3)]
+
+    def create_application(self, city: City, preferred_city: City, length_of_stay: int = 6) -> Application:
+        created_property = Property.objects.create(coordinates=GeographyPoint(14.42, 50.08), user=self.user,
+                                                   name=f"Property in {city.name}", usd_worth=1000,
+                                                   photo_id="photo", meters_squared=50, city=city)
+        application = Application.objects.create(property=created_property, length_of_stay=length_of_stay)
+        ApplicationPreferredCity.objects.create(application=application, city=preferred_city, order=1)
+        return application
+
+
+class UpdateRecommendationsTest(MatchingDataMixin, TestCase):
+
+    def test_moved_property_loses_its_cycle(self):
+        for disjoint in (False, True):
+            with self.subTest(disjoint=disjoint):
+                algorithm = MatchingAlgorithm(disjoint=disjoint, workers=1)
+                first = self.create_application(self.cities[0], self.cities[1])
+                second = self.create_application(self.cities[1], self.cities[0])
+                update_recommendations(second, algorithm)
+                recommendation = Recommendation.objects.get(recommendation_applications__application=first)
+
+                # the property of `second` moves, so `first` doesn't want it anymore
+                Property.objects.filter(id=second.property_id).update(city=self.cities[2])
+                update_recommendations(second, algorithm)
+
+                self.assertFalse(Recommendation.objects.filter(id=recommendation.id).exists())
+                self.assertFalse(Recommendation.objects.exists())
+
+                # moved back, the cycle is found again
+                Property.objects.filter(id=second.property_id).update(city=self.cities[1])
+                update_recommendations(second, algorithm)
+                self.assertEqual(Recommendation.objects.get().recommendation_applications.count(), 2)
+                Recommendation.objects.all().delete()
+                Application.objects.all().delete()
+
+    def test_partial_run_keeps_stale_recommendations(self):
+        applications = [self.create_application(self.cities[i], self.cities[(i + 1) % 3]) for i in range(3)]
+        # not a cycle, so stale after a full run
+        stale = Recommendation.objects.create_recommendation([applications[0].id, applications[2].id])
+
+        update_recommendations(algorithm=MatchingAlgorithm(workers=1, budget_seconds=None, budget_expansions=1))
+        self.assertTrue(Recommendation.objects.filter(id=stale.id).exists())
+
+        update_recommendations(algorithm=MatchingAlgorithm(workers=1, budget_seconds=None, budget_expansions=None))
+        self.assertFalse(Recommendation.objects.filter(id=stale.id).exists())
+        self.assertEqual(Recommendation.objects.get().recommendation_applications.count(), 3)
+
+
+class MatchingConstraintsTest(MatchingDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        house, flat = PropertyType.objects.create(name="House"), PropertyType.objects.create(name="Flat")
+        first = self.create_application(self.cities[0], self.cities[1])
+        PropertyTypeApplication.objects.create(application=first, property_type=house)
+        second = self.create_application(self.cities[1], self.cities[0])
+        Property.objects.filter(id=second.property_id).update(property_type=flat)
+        self.cycle = [first.id, second.id]
+
+    def test_only_length_of_stay_is_matched_by_default(self):
+        algorithm = MatchingAlgorithm(workers=1)
+
+        self.assertEqual([type(constraint) for constraint in algorithm.group_constraints + algorithm.edge_constraints],
+                         [SameLengthOfStay])
+        # the accepted property types are ignored
+        self.assertEqual(list(map(canonical_cycle, algorithm.find_matching_application_sets())), [self.cycle])
+
+    def test_accepted_property_types_are_opted_in(self):
+        algorithm = MatchingAlgorithm(workers=1, constraints=[SameLengthOfStay(), AcceptedPropertyType()])
+
+        self.assertEqual(algorithm.find_matching_application_sets(), [])
+
+
+class MatchingJobQueueTest(MatchingDataMixin, TestCase):
+    def test_oldest_job_is_claimed_first(self):
+        jobs = [MatchingJob.objects.enqueue() for _ in range(3)]
+        MatchingJob.objects.filter(id=jobs[2].id).update(created_at=timezone.now() - timedelta(minutes=1))
+
+        claimed = [MatchingJob.objects.claim_next() for _ in range(4)]
+
+        self.assertEqual([job and job.id for job in claimed], [jobs[2].id, jobs[0].id, jobs[1].id, None])
+        self.assertEqual(claimed[0].status, MatchingJobStatus.RUNNING)
+        self.assertIsNotNone(claimed[0].started_at)
+
+    def test_abandoned_job_is_claimed_again(self):
+        job = MatchingJob.objects.enqueue()
+        self.assertEqual(MatchingJob.objects.claim_next().id, job.id)
+        self.assertIsNone(MatchingJob.objects.claim_next())
+
+        # its worker died without finishing it
+        MatchingJob.objects.filter(id=job.id).update(
+            started_at=timezone.now() - timedelta(seconds=settings.MATCHING_JOB_TIMEOUT + 1))
+
+        self.assertEqual(MatchingJob.objects.claim_next().id, job.id)
+        self.assertIsNone(MatchingJob.objects.claim_next())
+        self.assertTrue(MatchingJob.objects.get(id=job.id).finish())
+        self.assertEqual(MatchingJob.objects.get(id=job.id).status, MatchingJobStatus.DONE)
+
+    def test_pending_applications_are_not_enqueued_again(self):
+        first = self.create_application(self.cities[0], self.cities[1])
+        second = self.create_application(self.cities[1], self.cities[0])
+        property_ids = [first.property_id, second.property_id]
+
+        self.assertEqual(len(MatchingJob.objects.enqueue_for_properties(property_ids)), 2)
+        self.assertEqual(MatchingJob.objects.enqueue_for_properties(property_ids), [])
+
+        # a claimed job may have read the applications already
+        MatchingJob.objects.filter(application=first).update(status=MatchingJobStatus.RUNNING)
+        self.assertEqual([job.application_id for job in MatchingJob.objects.enqueue_for_properties(property_ids)],
+                         [first.id])
+
+    def test_pending_full_matching_covers_all_applications(self):
+        application = self.create_application(self.cities[0], self.cities[1])
+        MatchingJob.objects.enqueue()
+
+        self.assertEqual(MatchingJob.objects.enqueue_for_properties([application.property_id]), [])
+        with mock.patch.object(settings, "MATCHING_INCREMENTAL", False):
+            self.assertEqual(MatchingJob.objects.enqueue_for_properties([application.property_id]), [])
+        self.assertEqual(MatchingJob.objects.count(), 1)
+
+
+class ReconcileTest(MatchingDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # a, b and c in a cycle through the 3 cities
+        self.a, self.b, self.c = [self.create_application(self.cities[i], self.cities[(i + 1) % 3]).id
+                                  for i in range(3)]
+
+    def fingerprints(self):
+        return set(Recommendation.objects.values_list("fingerprint", flat=True))
+
+    def test_unchanged_cycles_are_kept(self):
+        recommendation = Recommendation.objects.create_recommendation([self.a, self.b])
+
+        self.assertEqual(Recommendation.objects.reconcile([[self.b, self.a]], stale=Recommendation.objects.all()),
+                         (0, 0))
+        self.assertEqual(list(Recommendation.objects.values_list("id", flat=True)), [recommendation.id])
+
+    def test_new_cycles_are_created(self):
+        Recommendation.objects.create_recommendation([self.a, self.b])
+
+        self.assertEqual(Recommendation.objects.reconcile([[self.a, self.b], [self.b, self.c], [self.c, self.b]],
+                                                          stale=Recommendation.objects.all(), batch_size=1), (1, 0))
+        self.assertEqual(self.fingerprints(), {f"{self.a},{self.b}", f"{self.b},{self.c}"})
+
+    def test_stale_cycles_are_deleted(self):
+        for application_ids in ([self.a, self.b], [self.b, self.c], [self.a, self.c]):
+            Recommendation.objects.create_recommendation(application_ids)
+
+        self.assertEqual(Recommendation.objects.reconcile([[self.a, self.b]], stale=Recommendation.objects.all(),
+                                                          batch_size=1), (0, 2))
+        self.assertEqual(self.fingerprints(), {f"{self.a},{self.b}"})
+
+    def test_without_stale_nothing_is_deleted(self):
+        Recommendation.objects.create_recommendation([self.a, self.b])
+
+        self.assertEqual(Recommendation.objects.reconcile([[self.a, self.c]]), (1, 0))
+        self.assertEqual(self.fingerprints(), {f"{self.a},{self.b}", f"{self.a},{self.c}"})
+
+    def test_partially_accepted_cycles_are_deleted_once_broken(self):
+        cycles = [[self.a, self.b], [self.b, self.c], [self.a, self.c]]
+        for application_ids in cycles:
+            Recommendation.objects.create_recommendation(application_ids)
+        Recommendation.objects.update(accepted_count=1)
+        batches = []
+
+        def are_broken(batch):
+            batches.append(batch)
+            return [application_ids != [self.a, self.c] for application_ids in batch]
+
+        self.assertEqual(Recommendation.objects.reconcile([], stale=Recommendation.objects.all(), batch_size=2,
+                                                          are_broken=are_broken), (0, 2))
+        self.assertEqual(self.fingerprints(), {f"{self.a},{self.c}"})
+        self.assertEqual(sorted(map(len, batches)), [1, 2])
+
+    def test_broken_cycles_are_checked_together(self):
+        algorithm = MatchingAlgorithm(workers=1)
+        Application.objects.filter(id=self.c).update(accepted=True)
+        cycles = [[self.a, self.b, self.c], [self.a, self.b], [self.b, self.c, self.a], [self.a, 0]]
+
+        # the applications of all the cycles are loaded at once
+        with self.assertNumQueries(3):
+            broken = algorithm.are_cycles_broken(cycles)
+
+        self.assertEqual(broken, [True, True, True, True])
+        Application.objects.filter(id=self.c).update(accepted=False)
+        self.assertEqual(algorithm.are_cycles_broken(cycles), [False, True, False, True])
+
+
+class RunMatchingTest(MatchingDataMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.cities.append(City.objects.create(name="City 3"))
+        # pairs swapping their cities, in groups of their own if the length of stay is a group constraint
+        self.applications = [self.create_application(self.cities[offset + i], self.cities[offset + 1 - i],
+                                                     length_of_stay)
+                             for offset, length_of_stay in ((0, 6), (2, 12)) for i in range(2)]
+        self.stale = Recommendation.objects.create_recommendation([self.applications[0].id, self.applications[2].id])
+
+    def run_matching(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command("run_matching", *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_groups_are_reconciled(self):
+        stdout, _ = self.run_matching()
+
+        self.assertFalse(Recommendation.objects.filter(id=self.stale.id).exists())
+        self.assertEqual(sorted(sorted(recommendation.recommendation_applications.values_list("application_id",
+                                                                                              flat=True))
+                                for recommendation in Recommendation.objects.all()),
+                         [[self.applications[0].id, self.applications[1].id],
+                          [self.applications[2].id, self.applications[3].id]])
+        self.assertIn("hub edges", stdout)
+        self.assertIn("created", stdout)
+
+    def test_dry_run_writes_nothing(self):
+        stdout, stderr = self.run_matching("--dry-run")
+
+        self.assertEqual(sorted(sorted(json.loads(line)) for line in stdout.splitlines()),
+                         [[self.applications[0].id, self.applications[1].id],
+                          [self.applications[2].id, self.applications[3].id]])
+        self.assertIn("hub edges", stderr)
+        self.assertEqual(list(Recommendation.objects.values_list("id", flat=True)), [self.stale.id])
+
+    def test_partial_run_keeps_stale_recommendations(self):
+        stdout, _ = self.run_matching("--budget-expansions", "1")
+
+        self.assertIn("Matching budget exhausted", stdout)
+        self.assertTrue(Recommendation.objects.filter(id=self.stale.id).exists())
+
+
+class GeocoderStatusTest(TestCase):
+    QUERY = """
+        query {
+            geocoder { breakerState failures calls rejected opened retryIn cacheMisses pendingProperties reportedAt }
+        }
+    """
+
+    def execute(self):
+        response = self.client.post("/graphql/", json.dumps({"query": self.QUERY}), content_type="application/json")
+        self.assertNotIn("errors", response.json())
+        return response.json()["data"]["geocoder"]
+
+    def test_figures_reported_by_worker(self):
+        self.assertEqual(self.execute()["reportedAt"], None)
+
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        for _ in range(3):
+            with self.assertRaises(Exception):
+                breaker.call(operator.truediv, 1, 0)
+        cache = GeocodingCache(precision=3, ttl=60, size=10)
+        cache.misses = 4
+        GeocoderStatus.objects.report(breaker.stats(), 1, cache.stats())
+
+        figures = self.execute()
+        self.assertEqual({key: figures[key] for key in ("breakerState", "failures", "calls", "rejected", "opened",
+                                                         "cacheMisses", "pendingProperties")},
+                         {"breakerState": "open", "failures": 2, "calls": 2, "rejected": 1, "opened": 1,
+                          "cacheMisses": 4, "pendingProperties": 0})
+        self.assertTrue(0 < figures["retryIn"] <= 60)
+        self.assertIsNotNone(figures["reportedAt"])
+
+    def test_worker_reports_after_pass(self):
+        call_command("run_geocoding_worker", "--once", stdout=StringIO())
+        self.assertIsNotNone(GeocoderStatus.objects.get().reported_at)
+
+
+class GeocodingCacheTest(TestCase):
+    def setUp(self):
+        self.city = City.objects.create(name="Prague")
+        self.resolved = []
+        self.cache = GeocodingCache(precision=3, ttl=60, size=2)
+
+    def resolve(self, coordinates):
+        self.resolved.append(coordinates)
+        return self.city if coordinates.x > 0 else None
+
+    def get_city(self, x: float, y: float, cache: GeocodingCache = None):
+        return (cache or self.cache).get_city(SimpleNamespace(x=x, y=y), self.resolve)
+
+    def test_memory_and_database_layers(self):
+        self.assertEqual(self.get_city(14.42, 50.08), self.city)
+        # rounded to the same key
+        self.assertEqual(self.get_city(14.4201, 50.0801), self.city)
+        self.assertEqual(len(self.resolved), 1)
+        self.assertEqual(GeocodingCacheEntry.objects.get().key, "14.420,50.080")
+
+        # another process only shares the database
+        other = GeocodingCache(precision=3, ttl=60, size=2)
+        self.assertEqual(self.get_city(14.42, 50.08, other), self.city)
+        self.assertEqual(self.get_city(14.42, 50.08, other), self.city)
+
+        self.assertEqual(len(self.resolved), 1)
+        self.assertEqual(self.cache.stats(), {"memory_hits": 1, "database_hits": 0, "misses": 1, "size": 1})
+        self.assertEqual(other.stats(), {"memory_hits": 1, "database_hits": 1, "misses": 0, "size": 1})
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for x in (1, 2, 1, 3):
+            self.get_city(x, 50)
+
+        self.assertEqual(list(self.cache.entries), ["1.000,50.000", "3.000,50.000"])
+        self.get_city(2, 50)
+        self.assertEqual(self.cache.stats()["database_hits"], 1)
+        self.assertEqual(len(self.resolved), 3)
+
+    def test_expired_entries_are_resolved_again(self):
+        self.get_city(14.42, 50.08)
+        key = self.cache.key(SimpleNamespace(x=14.42, y=50.08))
+        self.cache.entries[key] = (self.city, time.time() - 1)
+        GeocodingCacheEntry.objects.update(created_at=timezone.now() - timedelta(seconds=61))
+
+        self.assertEqual(self.get_city(14.42, 50.08), self.city)
+
+        self.assertEqual(len(self.resolved), 2)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+        self.assertEqual(GeocodingCacheEntry.objects.count(), 1)
+
+    def test_cities_not_found_are_cached(self):
+        self.assertIsNone(self.get_city(-14.42, 50.08))
+        self.assertIsNone(self.get_city(-14.42, 50.08))
+        self.assertIsNone(self.get_city(-14.42, 50.08, GeocodingCache(precision=3, ttl=60, size=2)))
+
+        self.assertEqual(len(self.resolved), 1)
+        self.assertIsNone(GeocodingCacheEntry.objects.get().city)
+
+    def test_failed_lookups_are_not_cached(self):
+        def fail(coordinates):
+            raise requests.ConnectionError()
+
+        with self.assertRaises(requests.ConnectionError):
+            self.cache.get_city(SimpleNamespace(x=14.42, y=50.08), fail)
+
+        self.assertFalse(GeocodingCacheEntry.objects.exists())
+        self.assertEqual(self.get_city(14.42, 50.08), self.city)
+        self.assertEqual(len(self.resolved), 1)
+
+
+class GeocodingRetryTest(TestCase):
+    def test_failed_property_backs_off_and_is_given_up(self):
+        user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        pending_property = Property.objects.create(coordinates=GeographyPoint(14.42, 50.08), user=user,
+                                                   name="Property", usd_worth=1000, photo_id="photo",
+                                                   meters_squared=50, geocoding_pending=True)
+        delays = []
+        for attempt in range(1, settings.GEOCODING_MAX_ATTEMPTS):
+            before = timezone.now()
+            Property.objects.record_geocoding_failures([pending_property.id])
+            pending_property.refresh_from_db()
+            self.assertEqual(pending_property.geocoding_attempts, attempt)
+            self.assertTrue(pending_property.geocoding_pending)
+            delays.append((pending_property.geocoding_next_attempt_at - before).total_seconds())
+            # not due yet, the worker skips it
+            self.assertEqual(geocode_pending_properties(10), (None, 0))
+        self.assertEqual(delays, sorted(delays))
+        self.assertLessEqual(delays[-1], settings.GEOCODING_RETRY_MAX_DELAY + 1)
+
+        self.assertEqual(Property.objects.record_geocoding_failures([pending_property.id]), 1)
+        pending_property.refresh_from_db()
+        self.assertFalse(pending_property.geocoding_pending)
+        self.assertIsNone(pending_property.city)
+
+
+class OfflineGeocodingTest(TestCase):
+    def test_only_known_cities_are_resolved(self):
+        user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        city = City.objects.create(name="Prague", coordinates=GeographyPoint(50.083, 14.420))
+        city_resolver.load()
+        self.addCleanup(city_resolver.load)
+        nearby, remote = [
+            Property.objects.create(coordinates=coordinates, user=user, name="Property", usd_worth=1000,
+                                    photo_id="photo", meters_squared=50, geocoding_pending=True)
+            for coordinates in (GeographyPoint(50.08, 14.42), GeographyPoint(-33.87, 151.21))
+        ]
+
+        self.assertEqual(resolve_pending_properties_offline(10), (remote.id, 1))
+
+        nearby.refresh_from_db()
+        remote.refresh_from_db()
+        self.assertEqual((nearby.city, nearby.geocoding_pending), (city, False))
+        self.assertEqual((remote.city, remote.geocoding_pending, remote.geocoding_attempts), (None, True, 0))
+
+
+class KnownCitiesTest(TestCase):
+    def test_cities_without_coordinates_are_backfilled(self):
+        backfill_city_coordinates = import_module("graphql_api.migrations.0030_backfill_city_coordinates") \
+            .backfill_city_coordinates
+        user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        city, located = City.objects.create(name="Prague"), City.objects.create(name="Brno",
+                                                                                coordinates=GeographyPoint(49.2, 16.6))
+        for x, y, property_city in ((50.07, 14.41, city), (50.09, 14.43, city), (49.1, 16.5, located)):
+            Property.objects.create(coordinates=GeographyPoint(x, y), user=user, name="Property", usd_worth=1000,
+                                    photo_id="photo", meters_squared=50, city=property_city)
+
+        backfill_city_coordinates(django_apps, None)
+
+        city.refresh_from_db()
+        located.refresh_from_db()
+        self.assertAlmostEqual(city.coordinates.x, 50.08)
+        self.assertAlmostEqual(city.coordinates.y, 14.42)
+        self.assertEqual((located.coordinates.x, located.coordinates.y), (49.2, 16.6))
+        # known to the resolver without a gazetteer
+        resolver = OfflineCityResolver(radius=15)
+        self.assertEqual(resolver.resolve(GeographyPoint(50.1, 14.4)), city)
+        self.assertEqual(resolver.resolve(GeographyPoint(49.21, 16.61)), located)
+        self.assertIsNone(resolver.resolve(GeographyPoint(48.2, 16.37)))
+
+    def test_geocoded_cities_are_known_at_once(self):
+        resolver = OfflineCityResolver(radius=15)
+        self.assertIsNone(resolver.resolve(GeographyPoint(50.08, 14.42)))
+
+        city = City.objects.create(name="Prague", coordinates=GeographyPoint(50.083, 14.420))
+        resolver.add(city)
+
+        self.assertEqual(resolver.resolve(GeographyPoint(50.08, 14.42)), city)
+
+
+class ImportInventoryTest(TestCase):
+    def test_rows_violating_model_constraints_are_rejected(self):
+        user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        row = {"user_id": user.id, "name": "Flat", "coordinates": {"x": 50.08, "y": 14.42}, "usd_worth": 1000,
+               "photo_id": "photo", "meters_squared": 50, "application": {"length_of_stay": 6}}
+        rows = [row, {**row, "name": "x" * 101}, {**row, "photo_id": "x" * 51}, {**row, "room_type": "castle"},
+                {**row, "application": {"length_of_stay": 7}}]
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl") as f:
+            f.write("\n".join(json.dumps(row) for row in rows))
+            f.flush()
+            stderr = StringIO()
+            call_command("import_inventory", f.name, "--no-matching", stdout=StringIO(), stderr=stderr)
+
+        self.assertEqual(list(Property.objects.values_list("name", flat=True)), ["Flat"])
+        self.assertEqual(Application.objects.count(), 1)
+        # the spatial caches of the other processes are cleared
+        self.assertEqual(SpatialCacheGeneration.objects.current(), 1)
+        rejections = stderr.getvalue().splitlines()
+        self.assertEqual(len(rejections), 4)
+        for line, field_name in zip(range(2, 6), ("name", "photo_id", "room_type", "application length_of_stay")):
+            self.assertTrue(rejections[line - 2].startswith(f"Line {line} rejected: {field_name} is invalid"))
+
+
+class ImportMatchingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", email="user@example.com", password="password")
+        City.objects.create(name="Prague", coordinates=GeographyPoint(50.083, 14.420))
+        city_resolver.load()
+        self.addCleanup(city_resolver.load)
+
+    def import_rows(self, *coordinates):
+        rows = [{"user_id": self.user.id, "name": "Flat", "coordinates": {"x": x, "y": y}, "usd_worth": 1000,
+                 "photo_id": "photo", "meters_squared": 50, "application": {"length_of_stay": 6}}
+                for x, y in coordinates]
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl") as f:
+            f.write("\n".join(json.dumps(row) for row in rows))
+            f.flush()
+            call_command("import_inventory", f.name, stdout=StringIO(), stderr=StringIO())
+
+    def test_matching_is_enqueued_for_resolved_cities(self):
+        self.import_rows((50.08, 14.42), (-33.87, 151.21))
+
+        self.assertEqual(list(MatchingJob.objects.values_list("application_id", flat=True)), [None])
+        # the remote property is geocoded while the job is pending, the job matches it as well
+        remote = Property.objects.get(geocoding_pending=True)
+        Property.objects.set_geocoded_cities([(remote, City.objects.create(name="Sydney"))])
+        self.assertEqual(MatchingJob.objects.count(), 1)
+
+    def test_applications_waiting_for_geocoding_are_not_matched(self):
+        self.import_rows((-33.87, 151.21))
+
+        self.assertFalse(MatchingJob.objects.exists())
+        remote = Property.objects.get()
+        Property.objects.set_geocoded_cities([(remote, City.objects.create(name="Sydney"))])
+        self.assertEqual(list(MatchingJob.objects.values_list("application_id", flat=True)),
+                         [remote.applications.get().id])
+
+
+class FakeGeocoderHandler(BaseHTTPRequestHandler):
+    # (status code, delay in seconds) of the next responses, the last one is repeated
+    responses = [(200, 0)]
+    requests = 0
+
+    def do_GET(self):
+        handler = type(self)
+        status, delay = handler.responses[min(handler.requests, len(handler.responses) - 1)]
+        handler.requests += 1
+        time.sleep(delay)
+        body = {"results": [{"geometry": {"lat": 50.08, "lng": 14.42},
+                             "components": {"city": "Prague", "country": "Czechia"}}]} if status == 200 else {}
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(body).encode())
+        except ConnectionError:
+            # the client has timed out
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class GeocodingClientTest(SimpleTestCase):
+    def setUp(self):
+        FakeGeocoderHandler.responses = [(200, 0)]
+        FakeGeocoderHandler.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGeocoderHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.5)
+        self.client = GeocodingClient("key", f"http://127.0.0.1:{self.server.server_port}/", timeout=0.2,
+                                      max_tries=3, max_time=5, breaker=self.breaker, backoff_factor=0.01)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_server_errors_are_retried(self):
+        FakeGeocoderHandler.responses = [(500, 0), (503, 0), (200, 0)]
+
+        result = self.client.reverse_geocode(50.08, 14.42)
+
+        self.assertEqual(result[0]["components"]["city"], "Prague")
+        self.assertEqual(FakeGeocoderHandler.requests, 3)
+        self.assertEqual(self.client.retries, 2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_slow_provider_opens_breaker(self):
+        FakeGeocoderHandler.responses = [(200, 0.5)]
+
+        for _ in range(2):
+            start = time.monotonic()
+            with self.assertRaises(requests.exceptions.Timeout):
+                self.client.reverse_geocode(50.08, 14.42)
+            self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(FakeGeocoderHandler.requests, 6)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError):
+            self.client.reverse_geocode(50.08, 14.42)
+        self.assertEqual(FakeGeocoderHandler.requests, 6)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_breaker_closes_after_successful_trial(self):
+        FakeGeocoderHandler.responses = [(500, 0)] * 6 + [(200, 0)]
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                self.client.reverse_geocode(50.08, 14.42)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.5)
+        self.client.reverse_geocode(50.08, 14.42)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.stats()["opened"], 1)
+
+
+def random_demand_graph(generator: random.Random) -> DemandGraph:
+    cities = range(generator.randint(1, 4))
+    return DemandGraph([
+        ApplicationNode(id=i, length_of_stay=6, city_id=generator.choice(cities),
+                        preferred_city_ids=tuple(generator.sample(cities, generator.randint(0, len(cities)))))
+        for i in range(generator.randint(2, 8))
+    ])
+
+
+class InMemorySpatialCache(SpatialCache):
+    """Grid cache of properties {id: (x, y, is_available)} kept in memory instead of the database"""
+
+    def __init__(self, properties, **kwargs):
+        super().__init__(**{"cell_size": 1.0, "max_properties": 1000, "ttl": 60, "max_rings": 3, **kwargs})
+        self.properties = properties
+        self.loads = []
+        self.stored_generation = 0
+
+    def _load(self, cells):
+        self.loads.append(list(cells))
+        loaded = {cell: {} for cell in cells}
+        for property_id, (x, y, is_available) in self.properties.items():
+            if self.cell(x, y) in loaded:
+                loaded[self.cell(x, y)][property_id] = (property_id, x, y, is_available)
+        return loaded
+
+    def _load_generation(self):
+        return self.stored_generation
+
+
+class SpatialCacheTest(SimpleTestCase):
+    def test_same_as_brute_force(self):
+        generator = random.Random(4)
+        properties = {i: (generator.uniform(0, 10), generator.uniform(40, 50), generator.random() < 0.5)
+                      for i in range(200)}
+        cache = InMemorySpatialCache(properties, cell_size=0.5, max_rings=40, max_properties=10 ** 6)
+        for _ in range(100):
+            x, y = generator.uniform(0, 10), generator.uniform(40, 50)
+            limit = generator.randint(0, 10)
+            max_distance = generator.choice([None, generator.uniform(0, 300000)])
+            is_available = generator.choice([None, True, False])
+            expected = sorted(
+                (sphere_distance(x, y, px, py), property_id) for property_id, (px, py, available) in properties.items()
+                if (is_available is None or available == is_available)
+                and (max_distance is None or sphere_distance(x, y, px, py) <= max_distance)
+            )[:limit]
+            self.assertEqual(cache.closest(x, y, limit, max_distance, is_available), expected)
+
+    def test_search_stops_at_covered_ring(self):
+        cache = InMemorySpatialCache({1: (0.55, 45.5, True), 2: (2.5, 45.5, True)})
+
+        self.assertEqual([property_id for _, property_id in cache.closest(0.5, 45.5, 1)], [1])
+        # the closest property is nearer than any point outside of the cell
+        self.assertEqual(cache.loads, [[(0, 45)]])
+        self.assertEqual([property_id for _, property_id in cache.closest(0.5, 45.5, 2)], [1, 2])
+        self.assertEqual(len(cache.loads), 3)
+
+    def test_covered_distance_is_lower_bound(self):
+        generator = random.Random(5)
+        cache = InMemorySpatialCache({}, cell_size=0.5)
+        for _ in range(2000):
+            x, y, ring = generator.uniform(-180, 180), generator.uniform(-80, 80), generator.randint(0, 3)
+            center_x, center_y = cache.cell(x, y)
+            covered = cache._covered_distance(x, y, center_x, center_y, ring)
+            outside_x, outside_y = x, y
+            while max(abs(cache.cell(outside_x, outside_y)[0] - center_x),
+                      abs(cache.cell(outside_x, outside_y)[1] - center_y)) <= ring:
+                outside_x, outside_y = x + generator.uniform(-3, 3), max(min(y + generator.uniform(-3, 3), 89), -89)
+            self.assertLessEqual(covered, sphere_distance(x, y, outside_x, outside_y))
+
+    def test_expired_cells_are_reloaded(self):
+        properties = {1: (0.5, 45.5, True)}
+        cache = InMemorySpatialCache(properties, max_rings=0)
+        cache.closest(0.5, 45.5, 5)
+        properties[2] = (0.51, 45.5, True)
+        self.assertEqual(len(cache.closest(0.5, 45.5, 5, max_distance=1000)), 1)
+
+        cache.cells[(0, 45)].loaded_at -= cache.ttl + 1
+
+        self.assertEqual(len(cache.closest(0.5, 45.5, 5, max_distance=1000)), 2)
+        self.assertEqual(len(cache.loads), 2)
+
+    def test_least_recently_used_cells_are_evicted(self):
+        properties = {i: (float(cell_x) + 0.5, 45.5, True) for i, cell_x in enumerate([0, 0, 5, 5, 9, 9])}
+        cache = InMemorySpatialCache(properties, max_rings=0, max_properties=4)
+        for x in (0.5, 5.5, 0.5, 9.5):
+            cache.closest(x, 45.5, 1)
+
+        self.assertEqual(list(cache.cells), [(0, 45), (9, 45)])
+        self.assertEqual(cache.size, 4)
+        self.assertEqual(sorted(cache.cell_of), [0, 1, 4, 5])
+        cache.closest(5.5, 45.5, 1)
+        self.assertEqual(cache.loads[-1], [(5, 45)])
+
+    def test_changed_property_moves_between_cells(self):
+        cache = InMemorySpatialCache({1: (0.5, 45.5, True), 2: (1.5, 45.5, True)}, max_rings=0)
+        cache.closest(0.5, 45.5, 1)
+        cache.closest(1.5, 45.5, 1)
+
+        cache.property_changed(1, 1.6, 45.5, False)
+        self.assertEqual((cache.cell_of[1], cache.size), ((1, 45), 2))
+        self.assertNotIn(1, cache.cells[(0, 45)].properties)
+        self.assertEqual(cache.cells[(1, 45)].properties[1], (1, 1.6, 45.5, False))
+
+        # to a cell which isn't cached
+        cache.property_changed(1, 7.5, 45.5, True)
+        self.assertNotIn(1, cache.cell_of)
+        self.assertEqual(cache.size, 1)
+        cache.property_deleted(2)
+        self.assertEqual((cache.size, cache.cell_of), (0, {}))
+        self.assertEqual(cache.cells[(1, 45)].properties, {})
+
+    def test_lookup_beyond_rings_falls_back(self):
+        cache = InMemorySpatialCache({1: (9.5, 45.5, True)}, max_rings=1)
+
+        self.assertIsNone(cache.closest(0.5, 45.5, 1))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertEqual(cache.closest(0.5, 45.5, 1, max_distance=1000), [])
+
+    def test_bumped_generation_clears_cache(self):
+        cache = InMemorySpatialCache({1: (0.5, 45.5, True)}, max_rings=0, sync_interval=0)
+        cache.closest(0.5, 45.5, 1)
+        cache.closest(0.5, 45.5, 1)
+        self.assertEqual(len(cache.loads), 1)
+
+        cache.stored_generation += 1
+        cache.closest(0.5, 45.5, 1)
+
+        self.assertEqual(len(cache.loads), 2)
+
+
+class DemandGraphTest(SimpleTestCase):
+    def test_components_and_reachability_same_as_networkx(self):
+        generator = random.Random(3)
+        for _ in range(300):
+            cities = range(generator.randint(1, 5))
+            applications = [
+                ApplicationNode(id=i, length_of_stay=6, city_id=generator.choice([*cities, None]),
+                                preferred_city_ids=tuple(generator.sample(cities, generator.randint(0, len(cities)))),
+                                property_type_id=generator.choice([1, 2]),
+                                accepted_property_type_ids=tuple(generator.sample([1, 2], generator.randint(0, 2))))
+                for i in range(generator.randint(1, 12))
+            ]
+            for edge_constraints in ((), (AcceptedPropertyType(),)):
+                graph = DemandGraph(applications, edge_constraints)
+                networkx_graph = nx.DiGraph()
+                networkx_graph.add_nodes_from(graph.nodes())
+                networkx_graph.add_edges_from((node, successor) for node in graph.nodes()
+                                              for successor in graph.successors(node))
+                components = sorted(sorted(component)
+                                    for component in nx.strongly_connected_components(networkx_graph))
+                self.assertEqual(sorted(graph.strongly_connected_components()), components)
+                for node in graph.nodes():
+                    on_cycle = {node} if any(node in c and len(c) > 1 for c in components) else set()
+                    self.assertEqual(graph.reachable(node), nx.descendants(networkx_graph, node) | on_cycle)
+                    self.assertEqual(graph.reachable(node, reverse=True),
+                                     nx.ancestors(networkx_graph, node) | on_cycle)
+
+    def test_components_without_constraints_dont_expand_edges(self):
+        graph = DemandGraph([ApplicationNode(id=i, length_of_stay=6, city_id=0, preferred_city_ids=(0,))
+                             for i in range(100)])
+        expanded = []
+        successors = graph.successors
+        graph.successors = lambda node: expanded.append(node) or successors(node)
+
+        self.assertEqual(graph.strongly_connected_components(), [list(range(100))])
+        self.assertEqual(graph.reachable(0), set(range(100)))
+        # only the successors of the node itself
+        self.assertEqual(expanded, [0])
+
+
+class SearchBudgetTest(SimpleTestCase):
+    def complete_graph_successors(self, size: int):
+        return lambda node: (successor for successor in range(size) if successor != node)
+
+    def test_search_stops_after_expansions(self):
+        budget = SearchBudget(expansions=10)
+        cycles = list(iter_simple_cycles(self.complete_graph_successors(6), range(6), 6, budget))
+        self.assertTrue(budget.exhausted)
+        self.assertEqual(budget.expanded, 11)
+        # the shortest cycles come first
+        self.assertTrue(cycles)
+        self.assertTrue(all(len(cycle) == 2 for cycle in cycles))
+        self.assertLess(len(cycles), len(list(iter_simple_cycles(self.complete_graph_successors(6), range(6), 6))))
+
+    def test_deadline(self):
+        budget = SearchBudget(seconds=60)
+        self.assertTrue(budget.check())
+        budget.deadline = time.time() - 1
+        self.assertFalse(budget.check())
+        self.assertTrue(budget.exhausted)
+
+        graph = DemandGraph([ApplicationNode(id=i, length_of_stay=6, city_id=i, preferred_city_ids=(1 - i,))
+                             for i in range(2)])
+        self.assertEqual(graph.strongly_connected_components(), [[0, 1]])
+        self.assertEqual(graph.strongly_connected_components(budget), [])
+
+    def test_split_divides_remaining_expansions(self):
+        budget = SearchBudget(seconds=60, expansions=103)
+        for _ in range(10):
+            budget.expand()
+        for parts in (1, 4, 7, 200):
+            shares = budget.split(parts)
+            self.assertEqual(len(shares), parts)
+            self.assertEqual(sum(share.expansions or 0 for share in shares), 93)
+            self.assertLessEqual(max(share.expansions or 0 for share in shares)
+                                 - min(share.expansions or 0 for share in shares), 1)
+            self.assertTrue(all(share.deadline == budget.deadline and share.expanded == 0 for share in shares))
+        self.assertTrue(all(share.expansions is None for share in SearchBudget(seconds=60).split(3)))
+
+
+class SimpleCyclesTest(SimpleTestCase):
+    def test_same_cycles_as_networkx(self):
+        generator = random.Random(0)
+        for _ in range(300):
+            graph = random_demand_graph(generator)
+            networkx_graph = nx.DiGraph()
+            networkx_graph.add_nodes_from(graph.nodes())
+            networkx_graph.add_edges_from((node, successor) for node in graph.nodes()
+                                          for successor in graph.successors(node))
+            expected = {canonical_cycle(cycle) for cycle in nx.simple_cycles(networkx_graph)}
+
+            cycles = [canonical_cycle(cycle) for cycle in iter_simple_cycles(graph.successors, graph.nodes())]
+
+            self.assertEqual(len(cycles), len(set(cycles)))
+            self.assertEqual(set(cycles), expected)
+            bounded = {canonical_cycle(cycle) for cycle in iter_simple_cycles(graph.successors, graph.nodes(), 3)}
+            self.assertEqual(bounded, {cycle for cycle in expected if len(cycle) <= 3})
+
+    def test_limit_counts_stored_cycles(self):
+        cycles = [[1, 2], [1, 3], [2, 3], [3, 4]]
+        self.assertEqual(list(limit_cycles_per_node(cycles, 1, {3: 1})), [[1, 2]])
+
+    def test_bounded_search_same_cycles_as_limit(self):
+        generator = random.Random(1)
+        for _ in range(300):
+            graph = random_demand_graph(generator)
+            limit, max_length = generator.randint(1, 4), generator.choice([None, 2, 3, 4])
+            counts = {node: generator.randint(0, 2) for node in graph.nodes() if generator.random() < 0.3}
+            expected = list(limit_cycles_per_node(iter_simple_cycles(graph.successors, graph.nodes(), max_length),
+                                                  limit, counts))
+            self.assertEqual(list(iter_simple_cycles(graph.successors, graph.nodes(), max_length, limit=limit,
+                                                     counts=counts)), expected)
+            expected = list(limit_cycles_per_node(iter_cycles_through(graph.successors, 0, max_length), limit, counts))
+            self.assertEqual(list(iter_cycles_through(graph.successors, 0, max_length, limit=limit, counts=counts)),
+                             expected)
+
+    def test_limit_bounds_expansions(self):
+        expanded = []
+
+        def successors(node):
+            expanded.append(node)
+            return (successor for successor in range(14) if successor != node)
+
+        cycles = list(iter_simple_cycles(successors, range(14), 5, limit=10))
+        bounded = len(expanded)
+        expanded.clear()
+        self.assertEqual(cycles, list(limit_cycles_per_node(iter_simple_cycles(successors, range(14), 5), 10)))
+        self.assertEqual(max(sum(node in cycle for cycle in cycles) for node in range(14)), 10)
+        self.assertLess(bounded * 100, len(expanded))
+
+
+class PackComponentCyclesTest(SimpleTestCase):
+    def test_cycles_are_limited_before_packing(self):
+        # everybody wants the city all the properties are in
+        applications = [ApplicationNode(id=i, length_of_stay=6, city_id=0, preferred_city_ids=(0,)) for i in range(12)]
+        limited, unlimited = SearchBudget(expansions=10 ** 8), SearchBudget(expansions=10 ** 8)
+
+        packed = find_component_cycles(applications, 5, disjoint=True, budget=limited, max_cycles_per_application=3)
+
+        self.assertEqual(packed, pack_disjoint_cycles(list(iter_component_cycles(
+            applications, 5, budget=SearchBudget(expansions=10 ** 8), max_cycles_per_application=3))))
+        self.assertEqual(sorted(node for cycle in packed for node in cycle), list(range(12)))
+        find_component_cycles(applications, 5, disjoint=True, budget=unlimited)
+        self.assertLess(limited.expanded * 100, unlimited.expanded)
+
+
+class ParallelMatchingTest(SimpleTestCase):
+    def test_same_cycles_for_any_number_of_workers(self):
+        generator = random.Random(2)
+        applications = [ApplicationNode(id=i, length_of_stay=generator.choice([6, 12]), city_id=generator.randrange(6),
+                                        preferred_city_ids=tuple(generator.sample(range(6), 2)))
+                        for i in range(60)]
+        for options in ({}, {"disjoint": True}, {"top_k": 2}):
+            with self.subTest(**options):
+                cycles = [
+                    MatchingAlgorithm(workers=workers, constraints=[SameLengthOfStay()], max_cycle_length=4,
+                                      max_cycles_per_application=5, budget_seconds=None, budget_expansions=None,
+                                      **options).find_matching_application_sets(applications)
+                    for workers in (1, 3)
+                ]
+                self.assertTrue(cycles[0])
+                self.assertEqual(cycles[1], cycles[0])
+
+
+class PackDisjointCyclesTest(SimpleTestCase):
+    def brute_force_coverage(self, cycles) -> int:
+        best = 0
+        for size in range(1, len(cycles) + 1):
+            for subset in itertools.combinations(cycles, size):
+                nodes = [node for cycle in subset for node in cycle]
+                if len(nodes) == len(set(nodes)):
+                    best = max(best, len(nodes))
+        return best
+
+    def assert_disjoint(self, packed):
+        nodes = [node for cycle in packed for node in cycle]
+        self.assertEqual(len(nodes), len(set(nodes)))
+
+    def test_exact_packing_matches_brute_force(self):
+        generator = random.Random(0)
+        for _ in range(200):
+            cycles = [generator.sample(range(10), generator.randint(2, 4)) for _ in range(generator.randint(1, 10))]
+
+            packed = pack_disjoint_cycles(cycles)
+
+            self.assert_disjoint(packed)
+            self.assertEqual(sum(map(len, packed)), self.brute_force_coverage(cycles))
+            # original order is kept
+            remaining = iter(cycles)
+            self.assertTrue(all(cycle in remaining for cycle in packed))
+
+    def test_greedy_packing_above_exact_limit(self):
+        # the longest cycle blocks the three short ones covering more applications
+        cycles = [[1, 2, 3], [1, 4], [2, 5], [3, 6]]
+        self.assertEqual(pack_disjoint_cycles(cycles), [[1, 4], [2, 5], [3, 6]])
+        self.assertEqual(pack_disjoint_cycles(cycles, exact_limit=3), [[1, 2, 3]])
+
+        generator = random.Random(1)
+        cycles = [generator.sample(range(40), generator.randint(2, 5)) for _ in range(EXACT_PACKING_LIMIT * 2)]
+        packed = pack_disjoint_cycles(cycles)
+        self.assert_disjoint(packed)
+        # maximal: every other cycle overlaps a packed one
+        covered = {node for cycle in packed for node in cycle}
+        self.assertTrue(all(not covered.isdisjoint(cycle) for cycle in cycles))
+
+
+class TopCyclesTest(SimpleTestCase):
+    def test_same_as_full_enumeration(self):
+        generator = random.Random(0)
+        for _ in range(200):
+            graph = random_demand_graph(generator)
+            weights = {(node, successor): weight for node in graph.nodes()
+                       for successor, weight in graph.weighted_successors(node)}
+            node, k, max_length = generator.choice(graph.nodes()), generator.randint(1, 4), generator.randint(2, 5)
+            enumerated = sorted(
+                ((sum(weights[edge] for edge in zip(cycle, cycle[1:] + cycle[:1])) / len(cycle), -len(cycle))
+                 for cycle in iter_cycles_through(graph.successors, node, max_length)),
+                reverse=True
+            )
+            budget = SearchBudget()
+
+            top = find_top_cycles_through(graph.weighted_successors, node, k, max_length, budget=budget)
+
+            # ties of score and length may be broken either way, so only the ranks are compared
+            self.assertEqual([(round(score, 9), -len(cycle)) for score, cycle in top],
+                             [(round(score, 9), length) for score, length in enumerated[:k]])
+            for score, cycle in top:
+                self.assertEqual(cycle[0], node)
+                self.assertEqual(len(set(cycle)), len(cycle))
+                self.assertAlmostEqual(score, sum(weights[edge] for edge in zip(cycle, cycle[1:] + cycle[:1]))
+                                       / len(cycle))
+
+    def test_pruning_skips_branches(self):
+        # a complete graph of applications preferring the cities of the others, the best cycles are pairs
+        applications = [ApplicationNode(id=i, length_of_stay=6, city_id=i,
+                                        preferred_city_ids=tuple(c for c in range(8) if c != i)) for i in range(8)]
+        graph = DemandGraph(applications)
+        pruned, full = SearchBudget(), SearchBudget()
+
+        top = find_top_cycles_through(graph.weighted_successors, 0, 1, 8, budget=pruned)
+        find_top_cycles_through(graph.weighted_successors, 0, len(list(iter_cycles_through(graph.successors, 0, 8))),
+                                8, budget=full)
+
+        self.assertEqual(top, [(1.0, [0, 1])])
+        self.assertLess(pruned.expanded, full.expanded / 10)
+
+    def test_component_cycles_limited_per_application(self):
+        applications = [ApplicationNode(id=i, length_of_stay=6, city_id=i,
+                                        preferred_city_ids=tuple(c for c in range(8) if c != i)) for i in range(8)]
+        ranked = find_component_top_cycles(applications, 4, 5)
+
+        limited = find_component_top_cycles(applications, 4, 5, max_cycles_per_application=2)
+
+        self.assertEqual(limited, list(limit_cycles_per_node(ranked, 2)))
+        self.assertEqual(max(sum(i in cycle for cycle in limited) for i in range(8)), 2)
+        self.assertGreater(max(sum(i in cycle for cycle in ranked) for i in range(8)), 2)
+        self.assertEqual(find_component_cycles(applications, 4, top_k=5, max_cycles_per_application=2), limited)
+
+
+class InMemoryQuerySet:
+    """Just enough of a queryset for `paginate`, conditions are evaluated in Python"""
+
+    def __init__(self, items):
+        self.items = list(items)
+
+    def filter(self, condition: Q):
+        return InMemoryQuerySet(item for item in self.items if self.matches(item, condition))
+
+    def order_by(self, *keys):
+        items = list(self.items)
+        for key in reversed(keys):
+            items.sort(key=lambda item: getattr(item, key.lstrip("-")), reverse=key.startswith("-"))
+        return InMemoryQuerySet(items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def matches(self, item, condition: Q) -> bool:
+        results = [self.matches(item, child) if isinstance(child, Q) else self.lookup(item, *child)
+                   for child in condition.children]
+        return (all(results) if condition.connector == Q.AND else any(results)) != condition.negated
+
+    def lookup(self, item, name: str, value) -> bool:
+        field_name, _, lookup = name.partition("__")
+        return {"": operator.eq, "gt": operator.gt, "lt": operator.lt}[lookup](getattr(item, field_name), value)
+
+
+class KeysetPaginationTest(SimpleTestCase):
+    KEYS = ("distance", "id")
+
+    def setUp(self):
+        generator = random.Random(0)
+        # few distinct distances, so that pages break inside runs of equal distances
+        self.items = [SimpleNamespace(id=i, distance=float(generator.randint(0, 3))) for i in range(1, 24)]
+        generator.shuffle(self.items)
+        self.ordered = sorted(self.items, key=lambda item: (item.distance, item.id))
+
+    def cursor(self, item) -> str:
+        return encode_cursor(key_values(item, self.KEYS))
+
+    def test_beyond_orders_by_all_keys(self):
+        pivot = SimpleNamespace(id=10, distance=2.0)
+        queryset = InMemoryQuerySet(self.items)
+        after = queryset.filter(beyond(self.KEYS, [2.0, 10]))
+        before = queryset.filter(beyond(self.KEYS, [2.0, 10], descending=True))
+        self.assertTrue(all((item.distance, item.id) > (pivot.distance, pivot.id) for item in after.items))
+        self.assertTrue(all((item.distance, item.id) < (pivot.distance, pivot.id) for item in before.items))
+        self.assertEqual(len(after.items) + len(before.items),
+                         sum((item.distance, item.id) != (pivot.distance, pivot.id) for item in self.items))
+
+    def test_forward_pages(self):
+        pages, after = [], None
+        while True:
+            page = paginate(InMemoryQuerySet(self.items), self.KEYS, first=5, after=after)
+            pages.append(page)
+            if not page.has_next_page:
+                break
+            after = self.cursor(page.items[-1])
+
+        self.assertEqual([item for page in pages for item in page.items], self.ordered)
+        self.assertEqual([page.has_previous_page for page in pages], [False] + [True] * (len(pages) - 1))
+        self.assertEqual(len(pages), 5)
+
+    def test_backward_pages(self):
+        pages, before = [], None
+        while True:
+            page = paginate(InMemoryQuerySet(self.items), self.KEYS, last=5, before=before)
+            pages.insert(0, page)
+            if not page.has_previous_page:
+                break
+            before = self.cursor(page.items[0])
+
+        self.assertEqual([item for page in pages for item in page.items], self.ordered)
+        self.assertEqual([page.has_next_page for page in pages], [True] * (len(pages) - 1) + [False])
+
+    def test_page_between_cursors(self):
+        page = paginate(InMemoryQuerySet(self.items), self.KEYS, first=100, after=self.cursor(self.ordered[3]),
+                        before=self.cursor(self.ordered[9]))
+        self.assertEqual(page.items, self.ordered[4:9])
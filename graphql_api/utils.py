@@ -1,12 +1,13 @@
 
 import logging
-from typing import Tuple
+from typing import Iterable, Iterator, Tuple
 import itertools
 
 from django.contrib.gis.geos import Point
-from opencage.geocoder import OpenCageGeocode
 
-from work_around import settings
+from graphql_api.city_resolver import city_resolver
+from graphql_api.geocoder import geocoder
+from graphql_api.geocoding import geocoding_cache
 
 logger = logging.getLogger(__name__)
 
@@ -16,12 +17,22 @@ class GeographyPoint(Point):
         super().__init__(*args, **kwargs, srid=4326)
 
 
-geocoder = OpenCageGeocode(settings.OPEN_CAGE_API_KEY)
+def get_city(coordinates):
+    city = city_resolver.resolve(coordinates)
+    if city is None:
+        city = geocoding_cache.get_city(coordinates, reverse_geocode_city)
+        if city is not None:
+            city_resolver.add(city)
+    return city
 
 
-def get_city(coordinates):
+def reverse_geocode_city(coordinates):
     from graphql_api.models import City
-    place_components = geocoder.reverse_geocode(coordinates.x, coordinates.y)[0]
+    results = geocoder.reverse_geocode(coordinates.x, coordinates.y)
+    if not results:
+        # nothing at the coordinates (e.g. at sea), cached like a place without a city
+        return None
+    place_components = results[0]
     city_coordinates = place_components["geometry"]
     place_components = place_components["components"]
     try:
@@ -29,7 +40,12 @@ def get_city(coordinates):
                                          place_components.get("suburb",
                                                               place_components.get("county")))
         city_name = city_name or place_components["region"]
-        city, _ = City.objects.get_or_create(name=city_name, country=place_components["country"])
+        city, _ = City.objects.get_or_create(name=city_name, country=place_components["country"], defaults={
+            "coordinates": GeographyPoint(city_coordinates["lat"], city_coordinates["lng"])
+        })
+        if city.coordinates is None:
+            city.coordinates = GeographyPoint(city_coordinates["lat"], city_coordinates["lng"])
+            city.save(update_fields=["coordinates"])
     except KeyError as e:
         logger.exception(e)
         return None
@@ -41,3 +57,14 @@ def pairwise(iterable):
     first = next(b, None)
     return zip(a, b)
 
+
+def chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
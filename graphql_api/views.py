@@ -2,6 +2,8 @@ import logging
 
 from graphene_django.views import GraphQLView
 
+from graphql_api.loaders import RelationLoader
+
 logger = logging.getLogger(__name__)
 
 DEFAULT_CONTEXT_VARIABLES = {}
@@ -13,6 +15,10 @@ def set_default_request_context_variables(request):
 
 
 class WorkAroundGraphQLView(GraphQLView):
+    def get_context(self, request):
+        request.loader = RelationLoader()
+        return request
+
     def execute_graphql_request(self, request, *args, **kwargs):
         set_default_request_context_variables(request)
         result = super().execute_graphql_request(request, *args, **kwargs)
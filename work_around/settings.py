@@ -23,6 +23,39 @@ env = environ.Env(
     DATABASE_PASSWORD=(str, 'workaround1234'),
     DATABASE_PORT=(str, '5432'),
     OPEN_CAGE_API_KEY=(str, '5dd1b2de544444e7aefb94afd0ce71e5'),
+    OPEN_CAGE_URL=(str, 'https://api.opencagedata.com/geocode/v1/json'),
+    GEOCODER_TIMEOUT=(float, 5),
+    GEOCODER_MAX_TRIES=(int, 3),
+    GEOCODER_MAX_TIME=(float, 15),
+    GEOCODER_BREAKER_THRESHOLD=(int, 5),
+    GEOCODER_BREAKER_RESET=(float, 60),
+    MATCHING_INCREMENTAL=(bool, True),
+    MATCHING_MAX_CYCLE_LENGTH=(int, 5),
+    MATCHING_MAX_CYCLES_PER_APPLICATION=(int, 100),
+    MATCHING_WORKERS=(int, 1),
+    MATCHING_DISJOINT=(bool, False),
+    MATCHING_TOP_K=(int, 0),
+    MATCHING_BUDGET_SECONDS=(float, 0),
+    MATCHING_BUDGET_EXPANSIONS=(int, 0),
+    MATCHING_JOB_TIMEOUT=(float, 3600),
+    MATCHING_CONSTRAINTS=(list, ["graphql_api.constraints.SameLengthOfStay"]),
+    PAGINATION_DEFAULT_PAGE_SIZE=(int, 20),
+    PAGINATION_MAX_PAGE_SIZE=(int, 100),
+    CLOSEST_PROPERTIES_LIMIT=(int, 50),
+    GEOCODING_CACHE_PRECISION=(int, 3),
+    GEOCODING_CACHE_TTL=(float, 30 * 24 * 3600),
+    GEOCODING_CACHE_SIZE=(int, 10000),
+    GEOCODING_MAX_ATTEMPTS=(int, 8),
+    GEOCODING_RETRY_DELAY=(float, 60),
+    GEOCODING_RETRY_MAX_DELAY=(float, 24 * 3600),
+    OFFLINE_CITY_RADIUS=(float, 15),
+    CITY_GAZETTEER_PATH=(str, ''),
+    SPATIAL_CACHE_ENABLED=(bool, False),
+    SPATIAL_CACHE_CELL_SIZE=(float, 0.05),
+    SPATIAL_CACHE_MAX_PROPERTIES=(int, 100000),
+    SPATIAL_CACHE_TTL=(float, 60),
+    SPATIAL_CACHE_MAX_RINGS=(int, 8),
+    SPATIAL_CACHE_SYNC_INTERVAL=(float, 1),
 )
 
 environ.Env.read_env()
@@ -173,7 +206,73 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
 GRAPHENE = {
-    "SCHEMA": "graphql_api.schema.schema"
+    "SCHEMA": "graphql_api.schema.schema",
+    "MIDDLEWARE": ["graphql_api.loaders.RelationLoaderMiddleware"],
 }
 
 OPEN_CAGE_API_KEY = env("OPEN_CAGE_API_KEY")
+OPEN_CAGE_URL = env("OPEN_CAGE_URL")
+# Timeout of a geocoder request in seconds, failed requests are retried with jittered backoff at most
+# GEOCODER_MAX_TRIES times within GEOCODER_MAX_TIME seconds. After GEOCODER_BREAKER_THRESHOLD failed calls in a row
+# the geocoder isn't called for GEOCODER_BREAKER_RESET seconds, see graphql_api.geocoder.
+GEOCODER_TIMEOUT = env("GEOCODER_TIMEOUT")
+GEOCODER_MAX_TRIES = env("GEOCODER_MAX_TRIES")
+GEOCODER_MAX_TIME = env("GEOCODER_MAX_TIME")
+GEOCODER_BREAKER_THRESHOLD = env("GEOCODER_BREAKER_THRESHOLD")
+GEOCODER_BREAKER_RESET = env("GEOCODER_BREAKER_RESET")
+# Reverse geocoding cache, see graphql_api.geocoding. 3 decimal places of coordinates are about 100 meters, the TTL
+# is in seconds.
+GEOCODING_CACHE_PRECISION = env("GEOCODING_CACHE_PRECISION")
+GEOCODING_CACHE_TTL = env("GEOCODING_CACHE_TTL")
+GEOCODING_CACHE_SIZE = env("GEOCODING_CACHE_SIZE")
+# Geocoding of a pending property which failed is retried after GEOCODING_RETRY_DELAY seconds, doubled after every
+# failure up to GEOCODING_RETRY_MAX_DELAY, the property is given up (left with no city) after GEOCODING_MAX_ATTEMPTS
+# failed attempts.
+GEOCODING_MAX_ATTEMPTS = env("GEOCODING_MAX_ATTEMPTS")
+GEOCODING_RETRY_DELAY = env("GEOCODING_RETRY_DELAY")
+GEOCODING_RETRY_MAX_DELAY = env("GEOCODING_RETRY_MAX_DELAY")
+# Properties get the nearest known city within this radius in kilometers (0 disables), see
+# graphql_api.city_resolver, OpenCage is asked only when there is none. Cities in the database are known without a
+# gazetteer, the optional gazetteer is a CSV file with name, country, latitude and longitude columns.
+OFFLINE_CITY_RADIUS = env("OFFLINE_CITY_RADIUS")
+CITY_GAZETTEER_PATH = env("CITY_GAZETTEER_PATH")
+
+# When enabled, a new application only searches for cycles passing through itself and existing recommendations
+# are kept. Otherwise all unaccepted recommendations are recomputed over the whole application table.
+MATCHING_INCREMENTAL = env("MATCHING_INCREMENTAL")
+
+# Bounds of the cycle search, 0 disables the bound. Longer swap chains are impractical and the number of simple
+# cycles grows exponentially with the size of a group.
+MATCHING_MAX_CYCLE_LENGTH = env("MATCHING_MAX_CYCLE_LENGTH")
+MATCHING_MAX_CYCLES_PER_APPLICATION = env("MATCHING_MAX_CYCLES_PER_APPLICATION")
+# Number of processes searching strongly connected components of the application graph in parallel
+MATCHING_WORKERS = env("MATCHING_WORKERS")
+# Recommend only vertex-disjoint cycles, i.e. at most one pending recommendation per application
+MATCHING_DISJOINT = env("MATCHING_DISJOINT")
+# Ranked matching, only the given number of best cycles per application by preferred city order (0 disables)
+MATCHING_TOP_K = env("MATCHING_TOP_K")
+# Budget of one matching search (0 disables), when exhausted the cycles found so far are used
+MATCHING_BUDGET_SECONDS = env("MATCHING_BUDGET_SECONDS")
+MATCHING_BUDGET_EXPANSIONS = env("MATCHING_BUDGET_EXPANSIONS")
+# Seconds after which a running matching job is considered abandoned by a dead worker and is claimed again
+MATCHING_JOB_TIMEOUT = env("MATCHING_JOB_TIMEOUT")
+# Hard constraints of matching, see graphql_api.constraints. Only the length of stay is matched by default, others
+# are opted in by a comma separated list, e.g. adding graphql_api.constraints.AcceptedPropertyType
+MATCHING_CONSTRAINTS = env("MATCHING_CONSTRAINTS")
+
+# Page size of connections when neither `first` nor `last` is given and the largest page size allowed
+PAGINATION_DEFAULT_PAGE_SIZE = env("PAGINATION_DEFAULT_PAGE_SIZE")
+PAGINATION_MAX_PAGE_SIZE = env("PAGINATION_MAX_PAGE_SIZE")
+# Number of properties returned by `closestProperties` without a `limit`
+CLOSEST_PROPERTIES_LIMIT = env("CLOSEST_PROPERTIES_LIMIT")
+
+# In-process grid cache answering `closestProperties`, see graphql_api.spatial_cache. Cell size is in degrees, the
+# TTL in seconds bounds staleness caused by writes of other processes, lookups needing more rings of cells around
+# the queried point go to the database. Writes bypassing the signals (bulk imports) are picked up within
+# SPATIAL_CACHE_SYNC_INTERVAL seconds.
+SPATIAL_CACHE_ENABLED = env("SPATIAL_CACHE_ENABLED")
+SPATIAL_CACHE_CELL_SIZE = env("SPATIAL_CACHE_CELL_SIZE")
+SPATIAL_CACHE_MAX_PROPERTIES = env("SPATIAL_CACHE_MAX_PROPERTIES")
+SPATIAL_CACHE_TTL = env("SPATIAL_CACHE_TTL")
+SPATIAL_CACHE_MAX_RINGS = env("SPATIAL_CACHE_MAX_RINGS")
+SPATIAL_CACHE_SYNC_INTERVAL = env("SPATIAL_CACHE_SYNC_INTERVAL")